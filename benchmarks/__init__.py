@@ -0,0 +1,5 @@
+'''
+Benchmarks of the enzyme pipeline, phase by phase
+
+Usage: python -m benchmarks --help
+'''
@@ -0,0 +1,58 @@
+import sys
+import json
+import time
+import argparse
+import platform
+
+import numpy as np
+
+from .schemes import SCHEMES
+from .pipeline import run_benchmarks
+
+def parse_grid(s):
+    grid = tuple(int(n) for n in s.split('x'))
+    if len(grid) == 1:
+        grid = grid * 3
+    assert len(grid) == 3
+    return grid
+
+parser = argparse.ArgumentParser(prog='python -m benchmarks',
+        description='Time each phase of the enzyme pipeline')
+parser.add_argument('--schemes', nargs='+', default=sorted(SCHEMES),
+                    choices=sorted(SCHEMES))
+parser.add_argument('--grids', nargs='+', type=parse_grid,
+                    default=[(16,16,16), (32,32,32), (64,64,64)],
+                    help='grid sizes, e.g., 32 or 64x32x16')
+parser.add_argument('--repeat', type=int, default=3,
+                    help='number of executions and code generations, '
+                         'the fastest is reported')
+parser.add_argument('--no-execute', action='store_true',
+                    help='skip compilation and execution')
+parser.add_argument('--runtime-grid', action='store_true',
+                    help='compile programs that read the grid size at run '
+                         'time instead of specializing them to each grid')
+parser.add_argument('--recompute-cost', type=float, default=0,
+                    help='cost of a flop recomputed at a neighbor relative '
+                         'to a double carried between stages')
+parser.add_argument('--no-coarsen', action='store_true',
+                    help='solve the uncoarsened decomposition graph')
+parser.add_argument('--output', default=None,
+                    help='JSON output file; defaults to stdout')
+args = parser.parse_args()
+
+results = run_benchmarks(args.schemes, args.grids, args.repeat,
+                         not args.no_execute, not args.runtime_grid,
+                         args.recompute_cost, not args.no_coarsen)
+report = {
+    'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'python': platform.python_version(),
+    'numpy': np.__version__,
+    'platform': platform.platform(),
+    'results': results,
+}
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+else:
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
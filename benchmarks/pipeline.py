@@ -0,0 +1,126 @@
+import time
+import shutil
+
+import numpy as np
+
+from enzyme import analysis, symbolic_value, symbolic_variable, executor
+from enzyme.c_code import generate_c_code, peak_scratch_doubles
+
+from .schemes import SCHEMES
+
+class Timer(object):
+    '''
+    Accumulates wall clock seconds of named phases
+    '''
+    def __init__(self):
+        self.seconds = {}
+
+    def __call__(self, phase, func, *args):
+        t0 = time.time()
+        result = func(*args)
+        self.seconds[phase] = self.seconds.get(phase, 0.) + time.time() - t0
+        return result
+
+
+def benchmark_decomposition(scheme, recompute_cost=0, coarsen=True):
+    '''
+    Time the grid independent phases: tracing, graph construction,
+    coarsening, the quarkflow solve, stage construction and C code
+    generation
+    '''
+    timer = Timer()
+    func, inputs = scheme()
+    source_values, sink_values = timer(
+            'trace', symbolic_variable.trace, func, inputs)
+    all_values, weights, edges = timer(
+            'graph', symbolic_value.build_decomposition_graph,
+            source_values, sink_values)
+    costs = timer('graph', symbolic_value.recompute_costs,
+                  all_values, analysis.recompute_op_cost(recompute_cost))
+    num_solved = len(all_values)
+    if coarsen:
+        coarse = timer('coarsen', symbolic_value.coarsen_decomposition_graph,
+                       all_values, sink_values, weights, edges, costs)
+        cde = timer('solve', symbolic_value.decompose_graph,
+                    coarse.weights, coarse.edges, None, coarse.costs)
+        c, d, e = timer('coarsen', coarse.project, *cde)
+        num_solved = len(coarse.weights) - 1
+    else:
+        c, d, e = timer('solve', symbolic_value.decompose_graph,
+                        weights, edges, None, costs)
+    stages = timer('stages', symbolic_value.build_stages,
+                   all_values, source_values, sink_values, c, d)
+    unique, stage_indices = executor.unique_stages(stages)
+    timer('codegen', lambda: [generate_c_code(s) for s in unique])
+    info = {
+        'num_values': len(all_values),
+        'num_edges': len(edges),
+        'num_solved_values': num_solved,
+        'carried_doubles': symbolic_value.carried_doubles(weights, c, d),
+        'num_stages': len(stages),
+        'num_unique_stages': len(unique),
+        'scratch_doubles': [peak_scratch_doubles(s) for s in unique],
+    }
+    return stages, timer.seconds, info
+
+
+def benchmark_codegen(stages, repeat=1):
+    '''
+    Time the C code generation of the unique stages alone, the fastest
+    of repeat runs, and measure the size of the generated code
+    '''
+    unique, stage_indices = executor.unique_stages(stages)
+    seconds = []
+    for i in range(repeat):
+        t0 = time.time()
+        code = [generate_c_code(s) for s in unique]
+        seconds.append(time.time() - t0)
+    return {'seconds': min(seconds),
+            'code_bytes': sum([len(c) for c in code]),
+            'code_lines': sum([c.count('\n') for c in code])}
+
+
+def benchmark_execution(stages, grid, repeat=1, fixed_grid=True):
+    '''
+    Time the grid dependent phases: generating and writing the sources,
+    gcc and execution.  If fixed_grid is False, the program reads the
+    grid size at run time.
+    '''
+    timer = Timer()
+    unique, stage_indices = executor.unique_stages(stages)
+    x = [np.random.random(tuple(grid) + v.shape)
+         for v in unique[stage_indices[0]].source_values]
+    path = executor.make_build_dir()
+    try:
+        timer('generate', executor.generate_code, path, unique,
+              stage_indices, x, True, fixed_grid)
+        timer('gcc', executor.compile_code, path)
+        execute_seconds = []
+        for i in range(repeat):
+            t0 = time.time()
+            executor.run(path, unique, x, stage_indices=stage_indices)
+            execute_seconds.append(time.time() - t0)
+    finally:
+        shutil.rmtree(path)
+    timer.seconds['execute'] = min(execute_seconds)
+    return timer.seconds
+
+
+def run_benchmarks(schemes, grids, repeat=1, execute=True, fixed_grid=True,
+                   recompute_cost=0, coarsen=True):
+    results = []
+    for name in schemes:
+        stages, seconds, info = benchmark_decomposition(
+                SCHEMES[name], recompute_cost, coarsen)
+        result = {'scheme': name, 'phases': seconds, 'runs': [],
+                  'codegen': benchmark_codegen(stages, repeat)}
+        result.update(info)
+        if execute:
+            for grid in grids:
+                result['runs'].append({
+                    'grid': list(grid),
+                    'fixed_grid': fixed_grid,
+                    'phases': benchmark_execution(stages, grid, repeat,
+                                                  fixed_grid)})
+        results.append(result)
+    return results
@@ -0,0 +1,166 @@
+import numpy as np
+import enzyme
+
+# ============================================================================ #
+#                                 heat equation                                #
+# ============================================================================ #
+
+def heat_midpoint():
+    im, ip = enzyme.im, enzyme.ip
+    jm, jp = enzyme.jm, enzyme.jp
+    km, kp = enzyme.km, enzyme.kp
+    def step(u):
+        dx, dt = 0.1, 0.01
+        uh = u + 0.5 * dt / dx**2 * (im(u) + ip(u) - 2 * u +
+                                     jm(u) + jp(u) - 2 * u +
+                                     km(u) + kp(u) - 2 * u)
+        return u + dt / dx**2 * (im(uh) + ip(uh) - 2 * uh +
+                                 jm(uh) + jp(uh) - 2 * uh +
+                                 km(uh) + kp(uh) - 2 * uh)
+    return step, enzyme.stencil_array()
+
+# ============================================================================ #
+#                               Euler equation                                 #
+# ============================================================================ #
+
+def euler_rk4():
+    DISS_COEFF = 0.0025
+    gamma, R = 1.4, 287.
+    T0, p0, M0 = 300., 101325., 0.25
+
+    rho0 = p0 / (R * T0)
+    c0 = np.sqrt(gamma * R * T0)
+    u0 = c0 * M0
+    W0 = np.array([np.sqrt(rho0), np.sqrt(rho0) * u0, 0., 0., p0])
+
+    Lx, Ly, Lz = 40., 10., 5.
+    dx = dy = dz = 0.05
+    dt = dx / c0 * 0.5
+
+    x = (enzyme.builtin.I + 0.5) * dx - 0.2 * Lx
+    y = (enzyme.builtin.J + 0.5) * dy - 0.5 * Ly
+    z = (enzyme.builtin.K + 0.5) * dz - 0.5 * Lz
+
+    obstacle = enzyme.exp(-((x**2 + y**2 + z**2) / 1)**64)
+    fan = 2 * (enzyme.cos((x / Lx + 0.2) * np.pi)**64 +
+               enzyme.sin((y / Ly) * np.pi)**64)
+
+    im, ip = enzyme.im, enzyme.ip
+    jm, jp = enzyme.jm, enzyme.jp
+    km, kp = enzyme.km, enzyme.kp
+    ones, zeros = enzyme.ones, enzyme.zeros
+
+    def diffx(w):
+        return (ip(w) - im(w)) / (2 * dx)
+
+    def diffy(w):
+        return (jp(w) - jm(w)) / (2 * dy)
+
+    def diffz(w):
+        return (kp(w) - km(w)) / (2 * dz)
+
+    def dissipation(r, u, dc):
+        laplace = lambda u: (ip(u) + im(u) +
+                             jp(u) + jm(u) +
+                             kp(u) + km(u)) / 6. - u
+        return laplace(dc * r * r * laplace(u))
+
+    def rhs(w):
+        r, rux, ruy, ruz, p = w
+        ux, uy, uz = rux / r, ruy / r, ruz / r
+
+        mass = diffx(r * rux) + diffy(r * ruy) + diffz(r * ruz)
+        momentum_x = (diffx(rux*rux) + (r*rux) * diffx(ux)) / 2.0 \
+                   + (diffy(ruy*rux) + (r*ruy) * diffy(ux)) / 2.0 \
+                   + (diffz(ruz*rux) + (r*ruz) * diffz(ux)) / 2.0 \
+                   + diffx(p)
+        momentum_y = (diffx(rux*ruy) + (r*rux) * diffx(uy)) / 2.0 \
+                   + (diffy(ruy*ruy) + (r*ruy) * diffy(uy)) / 2.0 \
+                   + (diffz(ruz*ruy) + (r*ruz) * diffz(uy)) / 2.0 \
+                   + diffy(p)
+        momentum_z = (diffx(rux*ruz) + (r*rux) * diffx(uz)) / 2.0 \
+                   + (diffy(ruy*ruz) + (r*ruy) * diffy(uz)) / 2.0 \
+                   + (diffz(ruz*ruz) + (r*ruz) * diffz(uz)) / 2.0 \
+                   + diffz(p)
+        energy = gamma * (diffx(p * ux) + diffy(p * uy) + diffz(p * uz)) \
+               - (gamma - 1) * (ux * diffx(p) + uy * diffy(p) + uz * diffz(p))
+
+        one = ones(r.shape)
+        dissipation_x = dissipation(r, ux, DISS_COEFF) * c0 / dx
+        dissipation_y = dissipation(r, uy, DISS_COEFF) * c0 / dy
+        dissipation_z = dissipation(r, uz, DISS_COEFF) * c0 / dz
+        dissipation_p = dissipation(one, p, DISS_COEFF) * c0 / dx
+
+        momentum_x += dissipation_x
+        momentum_y += dissipation_y
+        momentum_z += dissipation_z
+        energy += dissipation_p \
+                - (gamma - 1) * (ux * dissipation_x +
+                                 uy * dissipation_y +
+                                 uz * dissipation_z)
+
+        rhs_w = zeros(w.shape)
+        rhs_w[0] = 0.5 * mass / r
+        rhs_w[1] = momentum_x / r
+        rhs_w[2] = momentum_y / r
+        rhs_w[3] = momentum_z / r
+        rhs_w[-1] = energy
+
+        rhs_w[1:3] += 0.1 * c0 * obstacle * w[1:3]
+        rhs_w += 0.1 * c0 * (w - W0) * fan
+        return rhs_w
+
+    def step(w):
+        dw0 = -dt * rhs(w)
+        dw1 = -dt * rhs(w + 0.5 * dw0)
+        dw2 = -dt * rhs(w + 0.5 * dw1)
+        dw3 = -dt * rhs(w + dw2)
+        return w + (dw0 + dw3) / 6 + (dw1 + dw2) / 3
+    return step, enzyme.stencil_array(5)
+
+# ============================================================================ #
+#                              synthetic graphs                                #
+# ============================================================================ #
+
+def deep(depth=16):
+    '''
+    A chain of depth explicit diffusion steps, one stage each
+    '''
+    def step(u):
+        for i in range(depth):
+            u = u + 0.1 * (enzyme.im(u) + enzyme.ip(u) +
+                           enzyme.jm(u) + enzyme.jp(u) +
+                           enzyme.km(u) + enzyme.kp(u) - 6 * u)
+        return u
+    return step, enzyme.stencil_array()
+
+def wide(width=64):
+    '''
+    width coupled components updated in two stages
+    '''
+    def step(u):
+        v = u * enzyme.sum(u) / width
+        v = v + enzyme.ip(v) - enzyme.im(v) + enzyme.jp(u) - enzyme.jm(u)
+        return u + 0.1 * (enzyme.kp(v) - enzyme.km(v)) * enzyme.roll(v, 1)
+    return step, enzyme.stencil_array(width)
+
+def multistep(scheme, steps):
+    '''
+    steps time steps of scheme traced into one graph
+    '''
+    def multistep_scheme():
+        step, inputs = scheme()
+        def steps_func(u):
+            for i in range(steps):
+                u = step(u)
+            return u
+        return steps_func, inputs
+    return multistep_scheme
+
+SCHEMES = {
+    'heat': heat_midpoint,
+    'euler': euler_rk4,
+    'deep': deep,
+    'wide': wide,
+    'euler4': multistep(euler_rk4, 4),
+}
@@ -1,2 +1,3 @@
 from .symbolic_variable import *
 from .executor import execute
+from .snapshots import load_snapshots
@@ -0,0 +1,306 @@
+from . import operators
+from .symbolic_value import _is_like_sa_value, builtin
+from .operators.op_base import BinaryOp, BinaryFunction, UnitaryFunction
+from .operators.stencil import access_name, access_offset
+
+BYTES_PER_DOUBLE = 8
+CENTER = ''
+
+TRANSCENDENTAL_OPS = (operators.sin, operators.cos, operators.exp,
+                      operators.pow, operators.log, operators.tanh)
+
+# cost of a transcendental function in equivalent floating point operations
+TRANSCENDENTAL_COST = 20
+
+# minimum weighted flops per grid point, counting the evaluations at
+# neighbors, that a field must cost to be precomputed instead of
+# recomputed in every sweep; about the cost of a transcendental function
+HOIST_MIN_FLOPS = TRANSCENDENTAL_COST
+
+# ============================================================================ #
+#                               value analysis                                 #
+# ============================================================================ #
+
+def active_access(name, ndim=3):
+    '''
+    The neighbor access name on a grid of ndim dimensions, whose axes
+    beyond the first ndim have a single cell, so that the offset along
+    them is dropped; CENTER if no offset is left, i.e., the identity.
+    '''
+    return access_name(access_offset(name)[:ndim])
+
+def missing_axis_values(stage, ndim=3):
+    '''
+    Values of stage computed from the index, builtin.J or K, along an axis
+    beyond the first ndim.  The index varies across a neighbor access
+    along the axis even though the grid data does not.
+    '''
+    indices = [builtin.I, builtin.J, builtin.K][ndim:]
+    values = set(v for v in stage.triburary_values if v in indices)
+    for v in stage.sorted_values:
+        if any([v_inp in values for v_inp in v.owner.inputs
+                if _is_like_sa_value(v_inp)]):
+            values.add(v)
+    return values
+
+def evaluation_points(stage, ndim=3):
+    '''
+    For each value of stage, the set of points at which the generated code
+    needs it: CENTER for the grid point itself, and the names of the
+    neighbor accesses, e.g., 'ip', through which it is read.
+    On a grid of ndim dimensions, see active_access, except for values
+    computed from the index along a missing axis, see missing_axis_values,
+    which keep the offset of the access along it.
+    '''
+    points = dict((v, set()) for v in
+                  stage.source_values + stage.triburary_values +
+                  stage.sorted_values)
+    missing = missing_axis_values(stage, ndim)
+    for v in stage.sink_values:
+        points[v].add(CENTER)
+    for r in stage.reductions:
+        points[r.value].add(CENTER)
+    for v in reversed(stage.sorted_values):
+        op = v.owner
+        for v_inp in op.inputs:
+            if not _is_like_sa_value(v_inp):
+                continue
+            access = CENTER
+            if op.access_neighbor:
+                access = active_access(op.name,
+                                       3 if v_inp in missing else ndim)
+            if access != CENTER:
+                if points[v]:
+                    points[v_inp].add(access)
+            else:
+                points[v_inp].update(points[v])
+    return points
+
+# ============================================================================ #
+#                                 op counting                                  #
+# ============================================================================ #
+
+def op_flops(op):
+    '''
+    Floating point operations performed by op at a single grid point
+    '''
+    if isinstance(op, (BinaryOp, BinaryFunction, UnitaryFunction,
+                       operators.where)):
+        return op.output.size
+    elif isinstance(op, operators.sum):
+        return op.inputs[0].size - op.output.size
+    else:
+        return 0
+
+def recompute_op_cost(recompute_cost):
+    '''
+    The cost of computing an op once, in doubles carried between stages,
+    given recompute_cost, the cost of one weighted flop in the same
+    units, see symbolic_value.recompute_costs; None if it is zero
+    '''
+    if not recompute_cost:
+        return None
+    return lambda op: recompute_cost * weighted_op_flops(op)
+
+def is_transcendental(op):
+    return isinstance(op, TRANSCENDENTAL_OPS)
+
+def weighted_op_flops(op, transcendental_cost=TRANSCENDENTAL_COST):
+    if is_transcendental(op):
+        return transcendental_cost * op_flops(op)
+    return op_flops(op)
+
+def stage_flops(stage):
+    '''
+    Floating point operations per grid point in the generated code of stage,
+    including the recomputation at neighbors
+    '''
+    return StageCost(stage).total_flops
+
+def stage_bytes(stage):
+    '''
+    Bytes moved between memory and the processor per grid point when
+    sweeping through stage, assuming neighbors are served from cache
+    '''
+    num_inputs = sum([v.size for v in stage.source_values])
+    num_outputs = sum([v.size for v in stage.sink_values])
+    return (num_inputs + num_outputs) * BYTES_PER_DOUBLE
+
+# ============================================================================ #
+#                          state independent values                            #
+# ============================================================================ #
+
+def state_independent_values(stage):
+    '''
+    Values of stage computed without neighbor access from the triburary
+    values and constants only, i.e., the same at every time step.
+    Returns a dictionary mapping each such value to whether it varies in
+    space, i.e., depends on builtin.I, J or K.
+    '''
+    spatial = set([builtin.I, builtin.J, builtin.K])
+    independent = dict((v, v in spatial) for v in stage.triburary_values)
+    for v in stage.sorted_values:
+        if v.owner.access_neighbor:
+            continue
+        inputs = [v_inp for v_inp in v.owner.inputs
+                  if _is_like_sa_value(v_inp)]
+        if all([v_inp in independent for v_inp in inputs]):
+            independent[v] = any([independent[v_inp] for v_inp in inputs])
+    for v in stage.triburary_values:
+        del independent[v]
+    return independent
+
+def hoistable_values(stage, min_flops=HOIST_MIN_FLOPS, ndim=3):
+    '''
+    Spatially varying state independent values of stage that are worth
+    computing once and storing, in the order they are computed.
+    Only values read by the rest of the stage are returned, not the
+    values they are computed from; a value computed from a hoisted value
+    is only hoisted if its own operations are worth storing.
+    On a grid of ndim dimensions, which is not padded along the missing
+    axes, values computed from the index along a missing axis and read
+    at an offset along it are not hoisted.
+    '''
+    independent = state_independent_values(stage)
+    frontier = set(v for v in stage.sink_values if v in independent)
+    for v in stage.sorted_values:
+        if v not in independent:
+            for v_inp in v.owner.inputs:
+                if _is_like_sa_value(v_inp) and v_inp in independent:
+                    frontier.add(v_inp)
+    points = evaluation_points(stage, ndim)
+    missing = missing_axis_values(stage, ndim)
+    cones, hoisted = {}, []
+    for v in stage.sorted_values:
+        if v not in independent:
+            continue
+        cones[v] = set([v])
+        for v_inp in v.owner.inputs:
+            if _is_like_sa_value(v_inp) and v_inp in cones:
+                cones[v].update(cones[v_inp])
+        if v in frontier and independent[v] and not (v in missing and any(
+                [any(access_offset(p)[ndim:]) for p in points[v]])):
+            cone_flops = sum([weighted_op_flops(u.owner) for u in cones[v]])
+            if cone_flops * len(points[v]) / float(v.size) >= min_flops:
+                hoisted.append(v)
+                # values computed from v read it from storage
+                cones[v] = set()
+    return hoisted
+
+# ============================================================================ #
+#                                 cost model                                   #
+# ============================================================================ #
+
+class StageCost(object):
+    '''
+    Static cost of a stage per grid point
+
+    flops: floating point operations by op name, including recomputation
+           of values at neighbors
+    unique_flops: floating point operations by op name if every value
+                  were computed only once
+    bytes_read: bytes of source values read, counting each neighbor read
+    bytes_written: bytes of sink values written
+    '''
+    def __init__(self, stage):
+        points = evaluation_points(stage)
+        self.flops, self.unique_flops = {}, {}
+        self.transcendental = self.unique_transcendental = 0
+        for v in stage.sorted_values:
+            flops = op_flops(v.owner)
+            if flops == 0:
+                continue
+            name = v.owner.name
+            n_points = len(points[v])
+            self.flops[name] = self.flops.get(name, 0) + flops * n_points
+            self.unique_flops[name] = self.unique_flops.get(name, 0) + flops
+            if is_transcendental(v.owner):
+                self.transcendental += flops * n_points
+                self.unique_transcendental += flops
+        self.bytes_read = BYTES_PER_DOUBLE * sum(
+                [v.size * len(points[v]) for v in stage.source_values])
+        self.bytes_written = BYTES_PER_DOUBLE * sum(
+                [v.size for v in stage.sink_values])
+
+    @property
+    def total_flops(self):
+        return sum(self.flops.values())
+
+    @property
+    def total_bytes(self):
+        return self.bytes_read + self.bytes_written
+
+    @property
+    def recompute_factor(self):
+        '''
+        Ratio between the flops actually performed and the flops if
+        no value were recomputed at neighbors
+        '''
+        unique_flops = sum(self.unique_flops.values())
+        return self.total_flops / float(unique_flops) if unique_flops else 1.
+
+    def weighted_flops(self, transcendental_cost=TRANSCENDENTAL_COST):
+        '''
+        Flops with each transcendental function counted as
+        transcendental_cost floating point operations
+        '''
+        return (self.total_flops +
+                (transcendental_cost - 1) * self.transcendental)
+
+    @property
+    def arithmetic_intensity(self):
+        return self.weighted_flops() / float(self.total_bytes)
+
+    def roofline(self, peak_bandwidth, peak_flops,
+                 transcendental_cost=TRANSCENDENTAL_COST):
+        '''
+        Roofline estimate on a machine with peak_bandwidth (bytes/s) and
+        peak_flops (flops/s)
+        '''
+        flops = self.weighted_flops(transcendental_cost)
+        compute_seconds = flops / float(peak_flops)
+        memory_seconds = self.total_bytes / float(peak_bandwidth)
+        seconds = max(compute_seconds, memory_seconds)
+        intensity = flops / float(self.total_bytes)
+        return {
+            'arithmetic_intensity': intensity,
+            'ridge_intensity': peak_flops / float(peak_bandwidth),
+            'attainable_flops': min(peak_flops, intensity * peak_bandwidth),
+            'bound': 'compute' if compute_seconds > memory_seconds
+                     else 'bandwidth',
+            'seconds_per_cell': seconds,
+            'cells_per_second': 1. / seconds,
+        }
+
+    def __repr__(self):
+        return ('{0} flops ({1} transcendental, recompute factor {2:.2f}), '
+                '{3} bytes read, {4} bytes written per cell').format(
+                    self.total_flops, self.transcendental,
+                    self.recompute_factor, self.bytes_read, self.bytes_written)
+
+
+def roofline_report(stages, peak_bandwidth, peak_flops,
+                    transcendental_cost=TRANSCENDENTAL_COST):
+    '''
+    Per stage cost and roofline estimate, e.g.,
+    roofline_report(stages, peak_bandwidth=20E9, peak_flops=100E9)
+    '''
+    # c_code imports this module for its value analysis
+    from .c_code import peak_scratch_doubles
+    report = []
+    for i, s in enumerate(stages):
+        cost = StageCost(s)
+        entry = {
+            'stage': i,
+            'flops': dict(cost.flops),
+            'transcendental': cost.transcendental,
+            'total_flops': cost.total_flops,
+            'bytes_read': cost.bytes_read,
+            'bytes_written': cost.bytes_written,
+            'recompute_factor': cost.recompute_factor,
+            'scratch_doubles': peak_scratch_doubles(s),
+        }
+        entry.update(cost.roofline(peak_bandwidth, peak_flops,
+                                   transcendental_cost))
+        report.append(entry)
+    return report
@@ -5,94 +5,492 @@ import numpy as np
 
 from .symbolic_variable import *
 from .symbolic_variable import _is_like_sa_value
+from .symbolic_value import parameter_value
+from .operators.stencil import access_name, access_offset
+from .analysis import CENTER, active_access, evaluation_points
+from .analysis import missing_axis_values
 
 def name_generator():
     for i in itertools.count():
         yield 'var_{0}'.format(i)
 
 def define_constant(v, name):
-    v = np.ravel(np.array(v, float));
-    c_code = 'double {0}[{1}];\n'.format(name, v.size);
-    for i in range(v.size):
-        c_code += '{0}[{1}] = {2};\n'.format(name, i, v[i])
-    return c_code
+    '''
+    A constant array with a static initializer, set up once instead of
+    at every grid point
+    '''
+    v = np.ravel(np.array(v, float))
+    return 'static const double {0}[{1}] = {{{2}}};\n'.format(
+            name, v.size, ', '.join(['{0}'.format(x) for x in v]))
 
-def copy_to_output(name, size):
-    c_code = ''
-    for i in range(size):
-        c_code += 'sink[{0}] = {1}[{0}];\n'.format(i, name)
-    return c_code
+def copy_to_output(view, offset=0):
+    return ''.join(['sink[{0}] = {1};\n'.format(offset + i,
+                                                element_ref(element))
+                    for i, element in enumerate(view)])
 
-def generate_c_code_for_op(op, name_gen):
-    c_code = ''
+def field_offsets(values):
+    '''
+    Offsets of the fields holding values in the doubles of a grid point,
+    each field following the previous
+    '''
+    offsets, n = [], 0
+    for v in values:
+        offsets.append(n)
+        n += v.size
+    return offsets
+
+# accumulation of an element into the partial result of a reduction
+REDUCE_STATEMENTS = {'sum': 'reduce[{0}] += {1};\n',
+                     'max': 'reduce[{0}] = fmax(reduce[{0}], {1});\n',
+                     'min': 'reduce[{0}] = fmin(reduce[{0}], {1});\n'}
+
+def accumulate_reduction(kind, offset, view):
+    '''
+    Code accumulating the elements of view into the partial results of
+    a reduction of kind, starting at offset
+    '''
+    statement = REDUCE_STATEMENTS[kind]
+    return ''.join([statement.format(offset + i, element_ref(element))
+                    for i, element in enumerate(view)])
+
+# ============================================================================ #
+#                                element views                                 #
+# ============================================================================ #
+
+# The elements of a value are referred to by views, lists of (C array name,
+# index, suffix) for each element.  suffix is None if the array has neighbor
+# variants, and otherwise the suffix of the array it refers to, e.g., '_ip'
+# for an element read through neighbor access.  Ops that only rearrange
+# elements, e.g., getitem and reshape, and neighbor access produce views of
+# their inputs instead of copies.
+
+def array_view(name, size, has_variants=True, offset=0):
+    suffix = None if has_variants else ''
+    return [(name, offset + i, suffix) for i in range(size)]
+
+def element_ref(element, suffix=''):
+    name, i, fixed_suffix = element
+    if fixed_suffix is not None:
+        suffix = fixed_suffix
+    return '{0}{1}[{2}]'.format(name, suffix, i)
+
+def view_refs(view, suffix=''):
+    return [element_ref(element, suffix) for element in view]
+
+def neighbor_view(view, op_name):
+    return [(name, i, '_' + op_name if suffix is None else suffix)
+            for name, i, suffix in view]
+
+def view_arrays(view):
+    return set([name for name, i, suffix in view])
+
+def view_elements(view, suffix=''):
+    '''
+    The (C array name, suffix, index) of each element referred to by view
+    '''
+    return set([(name, suffix if fixed_suffix is None else fixed_suffix, i)
+                for name, i, fixed_suffix in view])
+
+# ============================================================================ #
+#                             scratch allocation                               #
+# ============================================================================ #
+
+class Step(object):
+    '''
+    Generated code of one op, the names of the arrays it reads, and the
+    array it computes, if any, with its size including neighbor variants
+    and the suffixes of the variants.  elements are the array elements
+    the code references, as (name, suffix, index).
+    '''
+    def __init__(self, c_code, reads=(), array=None, size=0, suffixes=('',),
+                 elements=()):
+        self.c_code = c_code
+        self.reads = reads
+        self.array = array
+        self.size = size
+        self.suffixes = suffixes
+        self.elements = elements
+
+def allocate_scratch(steps, live_out):
+    '''
+    Offsets of the arrays computed by steps in a scratch buffer, where an
+    array reuses the space of arrays no longer read; and the size of the
+    buffer.  Arrays named in live_out are read after the last step.
+    '''
+    last_use = {}
+    for t, step in enumerate(steps):
+        if step.array is not None:
+            last_use[step.array] = t
+        for name in step.reads:
+            last_use[name] = t
+    for name in live_out:
+        last_use[name] = len(steps)
+    free, offsets, expiring, peak = [], {}, {}, 0
+    for t, step in enumerate(steps):
+        if step.array is not None:
+            offsets[step.array], peak = _take(free, step.size, peak)
+            expiring.setdefault(last_use[step.array], []).append(step)
+        # inputs are released after the output is allocated, an op may
+        # write its output before it has read all its inputs
+        for expired in expiring.pop(t, []):
+            _release(free, offsets[expired.array], expired.size)
+    return offsets, peak
+
+def _take(free, size, peak):
+    '''
+    First fit in the sorted list free of (offset, size) blocks, growing the
+    buffer of size peak if no block fits
+    '''
+    for k, (offset, block_size) in enumerate(free):
+        if block_size >= size:
+            if block_size == size:
+                del free[k]
+            else:
+                free[k] = (offset + size, block_size - size)
+            return offset, peak
+    if free and _end(free[-1]) == peak:
+        offset = free.pop()[0]
+        return offset, offset + size
+    return peak, peak + size
+
+def _end(block):
+    offset, size = block
+    return offset + size
+
+def _release(free, offset, size):
+    k = 0
+    while k < len(free) and free[k][0] < offset:
+        k += 1
+    free.insert(k, (offset, size))
+    # merge with the following and the preceding blocks
+    if k + 1 < len(free) and _end(free[k]) == free[k+1][0]:
+        free[k] = (offset, size + free.pop(k+1)[1])
+    if k > 0 and _end(free[k-1]) == free[k][0]:
+        free[k-1] = (free[k-1][0], free[k-1][1] + free.pop(k)[1])
+
+def generate_scratch_code(steps, live_out):
+    '''
+    The code of steps, with the arrays they compute pointing into a
+    scratch buffer; and the number of doubles in the buffer
+    '''
+    offsets, peak = allocate_scratch(steps, live_out)
+    c_code = ['double scratch[{0}];\n\n'.format(peak)] if peak else []
+    for step in steps:
+        if step.array is not None:
+            variant_size = step.size // len(step.suffixes)
+            for k, suffix in enumerate(step.suffixes):
+                c_code.append('double * const {0}{1} = scratch + {2};\n'
+                              .format(step.array, suffix, offsets[step.array] +
+                                      k * variant_size))
+        c_code.append(step.c_code)
+    return ''.join(c_code), peak
+
+# ============================================================================ #
+#                               code generation                                #
+# ============================================================================ #
+
+# stands for the suffix of the grid point in code generated once for all
+# the grid points an op is computed at; never appears in C code otherwise
+SUFFIX_MARK = '$'
+
+def generate_c_code_for_op(op, name_gen, views, suffixes=('',), ndim=3,
+                           missing=()):
+    '''
+    views is the table of the elements of each value; suffixes are those
+    of the grid points the output of op is computed at, '' for the grid
+    point itself and, e.g., '_ip' for a neighbor.  On a grid of ndim < 3
+    dimensions, the offset of a neighbor access along the missing axes is
+    dropped, see analysis.active_access, unless it reads one of the
+    missing values, see analysis.missing_axis_values.
+    Returns the Step computing op.
+    '''
+    c_code = []
     v = op.output
-    assert not hasattr(v, '_name')
-    input_names = []
-    v.has_neighbor = not op.access_neighbor
+    assert v not in views
+    input_views = []
     for inp in op.inputs:
         if _is_like_sa_value(inp):
-            input_names.append(inp._name)
-            v.has_neighbor = v.has_neighbor and inp.has_neighbor
+            input_views.append(views[inp])
         else:
             const_name = next(name_gen)
-            c_code += define_constant(inp, const_name) + '\n'
-            input_names.append(const_name)
+            c_code.append(define_constant(inp, const_name) + '\n')
+            input_views.append(array_view(const_name, np.size(inp), False))
+    reads = set()
+    for view in input_views:
+        reads.update(view_arrays(view))
+    element_map = op.element_map()
+    if op.access_neighbor:
+        access = active_access(op.name,
+                               3 if op.inputs[0] in missing else ndim)
+        views[v] = neighbor_view(input_views[0], access) if access \
+                   else input_views[0]
+        return Step(''.join(c_code), reads)
+    elif element_map is not None:
+        positions, indices = [np.ravel(a).tolist() for a in element_map]
+        views[v] = [input_views[p][i] for p, i in zip(positions, indices)]
+        return Step(''.join(c_code), reads)
     output_name = next(name_gen)
-    c_code += op.c_code(input_names, output_name) + '\n'
-    if v.has_neighbor:
-        for a in ['_im', '_ip', '_jm', '_jp', '_km', '_kp']:
-            input_nbr_names = []
-            for inp, name in zip(op.inputs, input_names):
-                if _is_like_sa_value(inp):
-                    input_nbr_names.append(name + a)
-                else:
-                    input_nbr_names.append(name)
-            c_code += op.c_code(input_nbr_names, output_name + a) + '\n'
-    v._name = output_name
-    return c_code
+    # the code is generated once, with SUFFIX_MARK in place of the suffix
+    # of the arrays with neighbor variants, and specialized to each suffix
+    input_refs = [view_refs(view, SUFFIX_MARK) for view in input_views]
+    op_code = op.c_code(input_refs, output_name + SUFFIX_MARK) + '\n'
+    elements = set()
+    for a in suffixes:
+        c_code.append(op_code.replace(SUFFIX_MARK, a))
+        for view in input_views:
+            elements.update(view_elements(view, a))
+    views[v] = array_view(output_name, v.size)
+    return Step(''.join(c_code), reads, output_name, v.size * len(suffixes),
+                tuple(suffixes), elements)
+
+def suffix_offset(suffix):
+    '''
+    The offset (di, dj, dk) of the grid point of a suffix, e.g., '_ip2'
+    '''
+    return access_offset(suffix[1:])
 
-def initialize_default_values(values):
+def grid_offset(suffix, ndim=3):
+    '''
+    The offset of the grid data read at the grid point of suffix on a grid
+    of ndim dimensions, none along the missing axes, where suffix keeps
+    the offset for the index values, see analysis.missing_axis_values
+    '''
+    return suffix_offset(suffix)[:ndim] + (0,) * (3 - ndim)
+
+def initialize_default_values(values, names, params=None, suffixes=('',)):
+    '''
+    params maps the name of each parameter to its offset in the
+    parameter vector passed to the program at run time.  A variant is
+    declared for each of the suffixes of the grid points the code reads.
+    '''
+    if params is None:
+        params = {}
     c_code = ''
     for v in values:
-        if v is builtin.ZERO.value:
-            for suffix in ['', '_ip', '_im', '_jp', '_jm', '_km', '_kp']:
+        for suffix in suffixes:
+            shift = suffix_offset(suffix)
+            if isinstance(v, parameter_value):
+                c_code += 'const double * {0}{1} = params + {2};\n'.format(
+                                       names[v], suffix, params[v.name])
+            elif v is builtin.ZERO.value:
                 c_code += 'const double {0}{1}[1] = {{0.0f}};\n'.format(
-                                       v._name, suffix)
-        elif v is builtin.I.value:
-            for suffix, shift in zip(['','_ip','_im','_jp','_jm','_km','_kp'],
-                                     [0,   +1,   -1,   0,     0,    0,    0]):
-                c_code += ('const double {0}{1}[1] = ' +
-                           '{{(double)(i+({2}))}};\n').format(
-                                       v._name, suffix, shift)
-        elif v is builtin.J.value:
-            for suffix, shift in zip(['','_ip','_im','_jp','_jm','_km','_kp'],
-                                     [0,   0,     0,   +1,   -1,    0,    0]):
+                                       names[v], suffix)
+            elif v in (builtin.I.value, builtin.J.value, builtin.K.value):
+                axis = [builtin.I.value, builtin.J.value,
+                        builtin.K.value].index(v)
                 c_code += ('const double {0}{1}[1] = ' +
-                           '{{(double)(j+({2}))}};\n').format(
-                                       v._name, suffix, shift)
-        elif v is builtin.K.value:
-            for suffix, shift in zip(['','_ip','_im','_jp','_jm','_km','_kp'],
-                                     [0,    0,    0,    0,    0,   -1,   +1]):
-                c_code += ('const double {0}{1}[1] = ' +
-                           '{{(double)(k+({2}))}};\n').format(
-                                       v._name, suffix, shift)
+                           '{{(double)({2}+({3}))}};\n').format(
+                                       names[v], suffix, 'ijk'[axis],
+                                       shift[axis])
+    return c_code + '\n'
+
+def needed_values(stage, precomputed):
+    '''
+    Values the sinks and reductions of stage are computed from, excluding
+    the values used only to compute precomputed values
+    '''
+    needed = set(stage.sink_values)
+    needed.update([r.value for r in stage.reductions])
+    for v in reversed(stage.sorted_values):
+        if v in needed and v not in precomputed:
+            needed.update([v_inp for v_inp in v.owner.inputs
+                           if _is_like_sa_value(v_inp)])
+    return needed
+
+def reference_precomputed(offset, name, suffixes=('',)):
+    c_code = ''
+    for suffix in suffixes:
+        c_code += 'const double * {0}{1} = precomputed{1} + {2};\n'.format(
+                name, suffix, offset)
     return c_code + '\n'
 
-def generate_c_code(stage):
-    assert len(stage.source_values) == 1
-    assert len(stage.sink_values) == 1
-    init_values = stage.source_values + stage.triburary_values
-    names = ['source'] + ['triburary_{0}'.format(i)
-                            for i in range(len(stage.triburary_values))]
-    for v, name in zip(init_values, names):
-        assert not hasattr(v, '_name')
-        v._name = name
-        v.has_neighbor = True
-    c_code = initialize_default_values(init_values)
+def evaluation_suffixes(stage, needed, ndim=3):
+    '''
+    For each needed value of stage, the sorted suffixes of the grid points
+    the generated code computes it at
+    '''
+    points = evaluation_points(stage, ndim)
+    return dict((v, sorted(['' if p == CENTER else '_' + p
+                            for p in points[v]])) for v in needed)
+
+def stage_suffixes(stage, ndim=3):
+    '''
+    The sorted suffixes of all grid points the generated code of stage
+    reads at, including the grid point itself
+    '''
+    return _grid_suffixes(_all_evaluation_suffixes(stage, ndim))
+
+def _all_evaluation_suffixes(stage, ndim=3):
+    values = set(stage.source_values + stage.triburary_values +
+                 stage.sorted_values)
+    return evaluation_suffixes(stage, values, ndim)
+
+def _grid_suffixes(value_suffixes):
+    suffixes = set([''])
+    for s in value_suffixes.values():
+        suffixes.update(s)
+    return sorted(suffixes, key=lambda s: (len(s), s))
+
+def reduction_offsets(stage):
+    '''
+    Offsets of the partial results of the reductions of stage when it
+    computes them alone
+    '''
+    return field_offsets([r.value for r in stage.reductions])
+
+def generate_c_code(stage, precomputed=None, params=None, ndim=3,
+                    reduced=None):
+    '''
+    C code computing the sinks of stage from its sources at one grid point.
+    The fields of the sources, and those of the sinks, follow each other
+    in the doubles of a grid point, see field_offsets, and are read and
+    written in place.
+    precomputed maps values stored in the precomputed workspace to their
+    offsets in it; these values are read instead of computed.
+    params maps parameter names to their offsets in the parameter vector.
+    On a grid of ndim < 3 dimensions, neighbor accesses along the missing
+    axes are the identity.
+    The code accumulates each reduction of stage into the array reduce,
+    at the offset in reduced, by default reduction_offsets(stage).
+    '''
+    return _generate_c_code(stage, precomputed, params, ndim, reduced)[0]
+
+def generate_stage_code(stage, precomputed=None, params=None, ndim=3,
+                        reduced=None):
+    '''
+    The C code of generate_c_code, and the source halo it reads, see
+    source_halo
+    '''
+    c_code, peak, halo = _generate_c_code(stage, precomputed, params, ndim,
+                                          reduced)
+    return c_code, halo
+
+def peak_scratch_doubles(stage, precomputed=None, ndim=3):
+    '''
+    Doubles per grid point in the scratch buffer of the generated code
+    '''
+    return _generate_c_code(stage, precomputed, ndim=ndim)[1]
+
+def source_halo(stage, precomputed=None, ndim=3):
+    '''
+    The elements of the source read by the generated code through each
+    neighbor access, as a dictionary mapping the name of the access,
+    e.g., 'ip', to the sorted flat indices of the elements.  Accesses
+    that read no element are left out.
+    '''
+    return _generate_c_code(stage, precomputed, ndim=ndim)[2]
+
+def _generate_c_code(stage, precomputed=None, params=None, ndim=3,
+                     reduced=None):
+    if precomputed is None:
+        precomputed = {}
+    # the source fields are read in place from the doubles of a grid point
+    views = dict((v, array_view('source', v.size, offset=offset))
+                 for v, offset in zip(stage.source_values,
+                                      field_offsets(stage.source_values)))
+    names = dict((v, 'triburary_{0}'.format(i))
+                 for i, v in enumerate(stage.triburary_values))
+    for v in stage.triburary_values:
+        views[v] = array_view(names[v], v.size)
+    suffixes = _all_evaluation_suffixes(stage, ndim)
+    grid_suffixes = _grid_suffixes(suffixes)
+    c_code = declare_sources(grid_suffixes, ndim)
+    c_code += initialize_default_values(stage.triburary_values, names, params,
+                                        grid_suffixes)
+    if precomputed:
+        c_code += declare_precomputed(grid_suffixes, ndim)
+    needed = needed_values(stage, precomputed)
+    missing = missing_axis_values(stage, ndim)
     name_gen = name_generator()
+    steps = []
+    for v in stage.sorted_values:
+        if v in precomputed:
+            name = next(name_gen)
+            views[v] = array_view(name, v.size)
+            steps.append(Step(reference_precomputed(precomputed[v], name,
+                                                    grid_suffixes)))
+        elif v in needed:
+            steps.append(generate_c_code_for_op(v.owner, name_gen, views,
+                                                suffixes[v], ndim, missing))
+    if reduced is None:
+        reduced = reduction_offsets(stage)
+    live_out, elements = set(), set()
+    for v in stage.sink_values:
+        live_out.update(view_arrays(views[v]))
+    for r in stage.reductions:
+        live_out.update(view_arrays(views[r.value]))
+    scratch_code, peak = generate_scratch_code(steps, live_out)
+    c_code += scratch_code
+    for v, offset in zip(stage.sink_values,
+                         field_offsets(stage.sink_values)):
+        c_code += copy_to_output(views[v], offset)
+        elements.update(view_elements(views[v]))
+    for r, offset in zip(stage.reductions, reduced):
+        c_code += accumulate_reduction(r.kind, offset, views[r.value])
+        elements.update(view_elements(views[r.value]))
+    for step in steps:
+        elements.update(step.elements)
+    halo = {}
+    for name, suffix, i in elements:
+        access = access_name(grid_offset(suffix, ndim))
+        if name == 'source' and access:
+            halo.setdefault(access, set()).add(i)
+    halo = dict((a, sorted(ind)) for a, ind in halo.items())
+    return c_code, peak, halo
+
+def grid_point(suffix, ndim=3):
+    '''
+    The C expressions of the indices of the grid data of suffix
+    '''
+    return ','.join(['{0}{1:+d}'.format(a, n) if n else a
+                     for a, n in zip('ijk', grid_offset(suffix, ndim))])
+
+def declare_sources(suffixes=('',), ndim=3):
+    '''
+    The source pointer at the grid point of each suffix, given by the
+    SOURCE(di,dj,dk) macro of the stage template
+    '''
+    c_code = ''
+    for suffix in suffixes:
+        c_code += 'const double * source{0} = SOURCE({1});\n'.format(
+                suffix, ','.join([str(n) for n in grid_offset(suffix, ndim)]))
+    return c_code + '\n'
+
+def declare_precomputed(suffixes=('',), ndim=3):
+    c_code = ''
+    for suffix in suffixes:
+        offset = grid_point(suffix, ndim)
+        c_code += ('const double * precomputed{0} = p_precomputed + ' +
+                   'OFFSET({1},NUM_PRECOMPUTED);\n').format(suffix, offset)
+    return c_code + '\n'
+
+def generate_precompute_code(stage, precomputed, params=None):
+    '''
+    C code computing, at one grid point, the precomputed values of stage
+    and storing them at their offsets in the precomputed workspace
+    '''
+    needed = set(precomputed)
+    for v in reversed(stage.sorted_values):
+        if v in needed:
+            needed.update([v_inp for v_inp in v.owner.inputs
+                           if _is_like_sa_value(v_inp)])
+    init_values = [v for v in stage.triburary_values if v in needed]
+    init_names = ['triburary_{0}'.format(i) for i in range(len(init_values))]
+    names = dict(zip(init_values, init_names))
+    views = dict((v, array_view(names[v], v.size)) for v in init_values)
+    c_code = initialize_default_values(init_values, names, params)
+    name_gen = name_generator()
+    steps = []
+    for v in stage.sorted_values:
+        if v in needed:
+            steps.append(generate_c_code_for_op(v.owner, name_gen, views))
+    live_out = set()
+    for v in precomputed:
+        live_out.update(view_arrays(views[v]))
+    c_code += generate_scratch_code(steps, live_out)[0]
     for v in stage.sorted_values:
-        c_code += generate_c_code_for_op(v.owner, name_gen)
-    c_code += copy_to_output(v._name, v.size)
-    for v in init_values + stage.sorted_values:
-        del v._name
+        if v in precomputed:
+            for i, ref in enumerate(view_refs(views[v])):
+                c_code += 'precomputed[{0}] = {1};\n'.format(
+                        precomputed[v] + i, ref)
     return c_code
@@ -1,70 +1,648 @@
+#define _POSIX_C_SOURCE 200809L
 #include<math.h>
 #include<stdio.h>
 #include<inttypes.h>
 #include<string.h>
 #include<stdlib.h>
+#include<time.h>
+
+${DEFINES}
+#ifdef ENZYME_SNAPSHOT
+#include<pthread.h>
+#endif
+#ifdef ENZYME_OUT_OF_CORE
+#include<fcntl.h>
+#include<unistd.h>
+#include<sys/mman.h>
+#endif
 
 #include "workspace.h"
 ${INCLUDE}
 
-const uint64_t NI = ${NI};
-const uint64_t NJ = ${NJ};
-const uint64_t NK = ${NK};
+${GRID_SIZE}
 const uint64_t MAX_VARS = ${MAX_VARS};
 const uint64_t NUM_INPUTS = ${NUM_INPUTS};
 const uint64_t NUM_OUTPUTS = ${NUM_OUTPUTS};
+// the doubles of a grid point hold the fields one after another; the
+// program reads and writes each field as a separate grid array
+const uint64_t NUM_INPUT_FIELDS = ${NUM_INPUT_FIELDS};
+const uint64_t INPUT_FIELD_SIZES[] = {${INPUT_FIELD_SIZES}};
+const uint64_t NUM_OUTPUT_FIELDS = ${NUM_OUTPUT_FIELDS};
+const uint64_t OUTPUT_FIELD_SIZES[] = {${OUTPUT_FIELD_SIZES}};
+const uint64_t NUM_PRECOMPUTED = ${NUM_PRECOMPUTED};
+const uint64_t NUM_PARAMS = ${NUM_PARAMS};
+const uint64_t NUM_REDUCED = ${NUM_REDUCED};
+
+// the stages are run num_steps times, with a snapshot of the state
+// written every snapshot_every steps if the program writes snapshots;
+// the final state is written back unless write_output is 0
+uint64_t num_steps, snapshot_every, write_output;
+
+#ifdef ENZYME_PROFILE
+FILE * profile_file;
+
+double profile_clock()
+{
+    struct timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return t.tv_sec + 1E-9 * t.tv_nsec;
+}
+
+void profile_record(const char * phase, double seconds)
+{
+    fprintf(profile_file, "%s %.9e\n", phase, seconds);
+}
+#endif
 
+int read_grid_size()
+{
+    uint64_t grid_size[3];
+    if (fread(grid_size, sizeof(uint64_t), 3, stdin) != 3) return 0;
+    if ((ENZYME_NDIM < 3 && grid_size[2] != 1) ||
+        (ENZYME_NDIM < 2 && grid_size[1] != 1)) return 0;
+#ifdef ENZYME_RUNTIME_GRID
+    NI = grid_size[0];
+    NJ = grid_size[1];
+    NK = grid_size[2];
+    return 1;
+#else
+    return grid_size[0] == NI && grid_size[1] == NJ && grid_size[2] == NK;
+#endif
+}
+
+int read_steps()
+{
+    uint64_t steps[3];
+    if (fread(steps, sizeof(uint64_t), 3, stdin) != 3) return 0;
+    num_steps = steps[0];
+    snapshot_every = steps[1];
+    write_output = steps[2];
+    return 1;
+}
+
+#ifdef ENZYME_SNAPSHOT
+// snapshots are copied out of the workspace into one of two buffers,
+// and written by a background thread while the stages go on
+typedef struct {
+    const char * dir;
+    pthread_t thread;
+    pthread_mutex_t lock;
+    pthread_cond_t cond;
+    double * buffer[2];
+    uint64_t step[2];   // the step of the snapshot in each buffer, 0 if free
+    int next;           // the buffer the next snapshot is copied into
+    int done;
+} SnapshotWriter;
+
+SnapshotWriter snapshots;
+
+// write the snapshot in buffer as a .npy file of doubles
+void snapshot_write(const double * buffer, uint64_t step)
+{
+    char path[4096], header[256];
+    snprintf(path, sizeof(path), "%s/snapshot_%08" PRIu64 ".npy",
+             snapshots.dir, step);
+    int n = snprintf(header, sizeof(header), "{'descr': '<f8', "
+                     "'fortran_order': False, 'shape': (%" PRIu64 ", %"
+                     PRIu64 ", %" PRIu64 "%s), }", NI, NJ, NK, SNAPSHOT_SHAPE);
+    // magic string, version, header length, header padded to 64 bytes
+    while ((10 + n + 1) % 64) header[n++] = ' ';
+    header[n++] = '\n';
+    unsigned char preamble[10] = {0x93, 'N', 'U', 'M', 'P', 'Y', 1, 0,
+                                  n % 256, n / 256};
+    FILE * f = fopen(path, "wb");
+    if (f == NULL) {
+        fprintf(stderr, "cannot write %s\n", path);
+        exit(1);
+    }
+    fwrite(preamble, 1, 10, f);
+    fwrite(header, 1, n, f);
+    fwrite(buffer, sizeof(double), NI*NJ*NK*NUM_OUTPUTS, f);
+    fclose(f);
+}
+
+void * snapshot_writer_thread(void * arg)
+{
+    int b = 0;
+    pthread_mutex_lock(&snapshots.lock);
+    while (1) {
+        while (snapshots.step[b] == 0 && !snapshots.done)
+            pthread_cond_wait(&snapshots.cond, &snapshots.lock);
+        if (snapshots.step[b] == 0) break;
+        pthread_mutex_unlock(&snapshots.lock);
+        snapshot_write(snapshots.buffer[b], snapshots.step[b]);
+        pthread_mutex_lock(&snapshots.lock);
+        snapshots.step[b] = 0;
+        pthread_cond_broadcast(&snapshots.cond);
+        b = 1 - b;
+    }
+    pthread_mutex_unlock(&snapshots.lock);
+    return NULL;
+}
+
+void snapshot_init(const char * dir)
+{
+    snapshots.dir = dir;
+    for (int b = 0; b < 2; ++b) {
+        snapshots.buffer[b] = (double *)malloc(
+                sizeof(double)*NI*NJ*NK*NUM_OUTPUTS);
+        snapshots.step[b] = 0;
+    }
+    snapshots.next = 0;
+    snapshots.done = 0;
+    pthread_mutex_init(&snapshots.lock, NULL);
+    pthread_cond_init(&snapshots.cond, NULL);
+    pthread_create(&snapshots.thread, NULL, snapshot_writer_thread, NULL);
+}
+
+// copy the state after step to a free buffer for the writer thread
+void snapshot(Workspace * p, uint64_t step)
+{
+    PROFILE_START(t_snapshot);
+    int b = snapshots.next;
+    pthread_mutex_lock(&snapshots.lock);
+    while (snapshots.step[b] != 0)
+        pthread_cond_wait(&snapshots.cond, &snapshots.lock);
+    pthread_mutex_unlock(&snapshots.lock);
+    FOR_IJK {
+        double * src = p->sink_workspace + OFFSET(i,j,k,NUM_OUTPUTS);
+        double * dest = snapshots.buffer[b] + NUM_OUTPUTS*(k+j*NK+i*NK*NJ);
+        memcpy(dest, src, NUM_OUTPUTS * sizeof(double));
+    }
+    pthread_mutex_lock(&snapshots.lock);
+    snapshots.step[b] = step;
+    pthread_cond_broadcast(&snapshots.cond);
+    pthread_mutex_unlock(&snapshots.lock);
+    snapshots.next = 1 - b;
+    PROFILE_STOP(t_snapshot, "snapshot");
+}
+
+// wait for the writer thread to write the remaining snapshots
+void snapshot_finalize()
+{
+    PROFILE_START(t_wait);
+    pthread_mutex_lock(&snapshots.lock);
+    snapshots.done = 1;
+    pthread_cond_broadcast(&snapshots.cond);
+    pthread_mutex_unlock(&snapshots.lock);
+    pthread_join(snapshots.thread, NULL);
+    PROFILE_STOP(t_wait, "snapshot_wait");
+}
+#endif
+
+#ifdef ENZYME_MASK
+// the grid is divided into blocks of up to ENZYME_MASK_BLOCK cells along
+// each axis.  The last stage of a step sweeps the active blocks, and each
+// earlier stage the blocks swept by the next stage dilated by the blocks
+// its neighbor accesses reach, periodically, so that the halos read at
+// the boundary of the active region are computed.  The state of the
+// other blocks is left as it is.
+typedef struct {
+    int64_t n[3];           // blocks along each axis
+    int64_t size[3];        // cells of a block along each axis
+    int64_t num_blocks;
+    unsigned char * active; // whether the last stage sweeps each block
+    unsigned char * swept;
+    unsigned char * reached;
+    double * change;        // largest update of the state in each block
+    int64_t * blocks[MASK_NUM_STAGES];
+    uint64_t num_swept[MASK_NUM_STAGES];
+    // the active blocks are those whose state changed by at least
+    // threshold, and the blocks they reach, rebuilt every every steps
+    double threshold;
+    uint64_t every;
+} Mask;
+
+Mask mask;
+// the widest neighbor access along each axis of each stage of a step
+const int64_t mask_halos[MASK_NUM_STAGES][3] = MASK_STAGE_HALOS;
+
+// the blocks along axis reached by neighbor accesses up to halo cells
+// wide; one more if the last block is partial, as it is crossed
+// periodically
+int64_t mask_reach(int64_t halo, int axis)
+{
+    uint64_t n_cells[3] = {NI, NJ, NK};
+    if (halo == 0) return 0;
+    return (halo + mask.size[axis] - 1) / mask.size[axis] +
+           (n_cells[axis] % mask.size[axis] != 0);
+}
+
+// set out to the blocks within reach[axis] blocks of a block of in
+void mask_dilate(const unsigned char * in, unsigned char * out,
+                 const int64_t reach[3])
+{
+    const int64_t * n = mask.n;
+    memset(out, 0, mask.num_blocks);
+    for (int64_t bi = 0; bi < n[0]; ++bi)
+    for (int64_t bj = 0; bj < n[1]; ++bj)
+    for (int64_t bk = 0; bk < n[2]; ++bk) {
+        if (!in[(bi*n[1] + bj)*n[2] + bk]) continue;
+        for (int64_t di = -reach[0]; di <= reach[0]; ++di)
+        for (int64_t dj = -reach[1]; dj <= reach[1]; ++dj)
+        for (int64_t dk = -reach[2]; dk <= reach[2]; ++dk)
+            out[(WRAP(bi+di,n[0])*n[1] + WRAP(bj+dj,n[1]))*n[2] +
+                WRAP(bk+dk,n[2])] = 1;
+    }
+}
+
+// the cell ranges of the blocks swept by each stage
+void mask_build()
+{
+    unsigned char * swept = mask.swept;
+    memcpy(swept, mask.active, mask.num_blocks);
+    for (int s = MASK_NUM_STAGES - 1; s >= 0; --s) {
+        int64_t * block = mask.blocks[s];
+        mask.num_swept[s] = 0;
+        for (int64_t b = 0; b < mask.num_blocks; ++b) {
+            if (!swept[b]) continue;
+            int64_t first[3] = {b / (mask.n[1]*mask.n[2]),
+                                b / mask.n[2] % mask.n[1], b % mask.n[2]};
+            uint64_t n_cells[3] = {NI, NJ, NK};
+            for (int axis = 0; axis < 3; ++axis) {
+                int64_t i0 = first[axis] * mask.size[axis];
+                int64_t i1 = i0 + mask.size[axis];
+                *block++ = i0;
+                *block++ = i1 < (int64_t)n_cells[axis] ? i1 : n_cells[axis];
+            }
+            mask.num_swept[s]++;
+        }
+        if (s > 0) {
+            int64_t reach[3];
+            for (int axis = 0; axis < 3; ++axis)
+                reach[axis] = mask_reach(mask_halos[s][axis], axis);
+            mask_dilate(swept, mask.reached, reach);
+            memcpy(swept, mask.reached, mask.num_blocks);
+        }
+    }
+}
+
+// read the active cells, a byte per cell, the threshold and how often
+// the active blocks are rebuilt, and move the input to the state
+void mask_init(Workspace * p)
+{
+    uint64_t n_cells[3] = {NI, NJ, NK};
+    mask.num_blocks = 1;
+    for (int axis = 0; axis < 3; ++axis) {
+        mask.size[axis] = n_cells[axis] < ENZYME_MASK_BLOCK ?
+                          n_cells[axis] : ENZYME_MASK_BLOCK;
+        mask.n[axis] = (n_cells[axis] + mask.size[axis] - 1) / mask.size[axis];
+        mask.num_blocks *= mask.n[axis];
+    }
+    mask.active = (unsigned char *)calloc(mask.num_blocks, 1);
+    mask.swept = (unsigned char *)malloc(mask.num_blocks);
+    mask.reached = (unsigned char *)malloc(mask.num_blocks);
+    mask.change = (double *)calloc(mask.num_blocks, sizeof(double));
+    for (int s = 0; s < MASK_NUM_STAGES; ++s)
+        mask.blocks[s] = (int64_t *)malloc(sizeof(int64_t)*6*mask.num_blocks);
+    unsigned char * cells = (unsigned char *)malloc(NI*NJ*NK);
+    int r = fread(cells, 1, NI*NJ*NK, stdin);
+    FOR_IJK {
+        if (cells[k + j*NK + i*NK*NJ])
+            mask.active[(i/mask.size[0]*mask.n[1] + j/mask.size[1])*mask.n[2]
+                        + k/mask.size[2]] = 1;
+    }
+    free(cells);
+    r = fread(&mask.threshold, sizeof(double), 1, stdin);
+    r = fread(&mask.every, sizeof(uint64_t), 1, stdin);
+    mask_build();
+
+    p->state = (double *)malloc(sizeof(double)*NUM_PADDED_CELLS*NUM_INPUTS);
+    memcpy(p->state, p->sink_workspace,
+           sizeof(double)*NUM_PADDED_CELLS*NUM_INPUTS);
+    p->sink_workspace = p->state;
+}
+
+// sweep the blocks of stage s of the step
+void mask_select(Workspace * p, int s)
+{
+    p->blocks = mask.blocks[s];
+    p->num_blocks = mask.num_swept[s];
+}
+
+// copy the state computed in the active blocks to the state, recording
+// the largest update of each block, and rebuild the active blocks every
+// mask.every steps
+void mask_update(Workspace * p, uint64_t step)
+{
+    PROFILE_START(t_mask);
+    const int64_t * block = mask.blocks[MASK_NUM_STAGES - 1];
+    memset(mask.change, 0, sizeof(double)*mask.num_blocks);
+    for (uint64_t b = 0; b < mask.num_swept[MASK_NUM_STAGES - 1]; ++b) {
+        double change = 0;
+        for (int64_t i = block[0]; i < block[1]; ++i)
+        for (int64_t j = block[2]; j < block[3]; ++j)
+        for (int64_t k = block[4]; k < block[5]; ++k) {
+            const double * src = p->sink_workspace + OFFSET(i,j,k,NUM_INPUTS);
+            double * dest = p->state + OFFSET(i,j,k,NUM_INPUTS);
+            for (uint64_t e = 0; e < NUM_INPUTS; ++e) {
+                change = fmax(change, fabs(src[e] - dest[e]));
+                dest[e] = src[e];
+            }
+        }
+        mask.change[(block[0]/mask.size[0]*mask.n[1] + block[2]/mask.size[1])
+                    *mask.n[2] + block[4]/mask.size[2]] = change;
+        block += 6;
+    }
+    // the next stage reads the state, and the source is a half of the
+    // workspace, also used by workspace_finalize to unpack the fields
+    p->sink_workspace = p->state;
+    p->source_workspace = p->workspace;
+    if (mask.every && step % mask.every == 0) {
+        // the blocks still changing, and those the changes can reach
+        // by the next rebuild
+        int64_t reach[3];
+        for (int axis = 0; axis < 3; ++axis) {
+            int64_t halo = 0;
+            for (int s = 0; s < MASK_NUM_STAGES; ++s)
+                halo += mask_halos[s][axis];
+            reach[axis] = mask_reach(halo * mask.every, axis);
+        }
+        for (int64_t b = 0; b < mask.num_blocks; ++b)
+            mask.swept[b] = mask.change[b] >= mask.threshold;
+        mask_dilate(mask.swept, mask.active, reach);
+        mask_build();
+    }
+    PROFILE_STOP(t_mask, "mask");
+}
+#endif
+
+#ifdef ENZYME_OUT_OF_CORE
+const char * input_path;
+const char * output_path;
+const char * scratch_prefix;
+
+// map the file at path holding n doubles, creating it if writable
+double * map_file(const char * path, uint64_t n, int writable)
+{
+    int fd = open(path, writable ? O_RDWR | O_CREAT | O_TRUNC : O_RDONLY,
+                  0644);
+    if (fd < 0 || (writable && ftruncate(fd, n * sizeof(double)))) {
+        fprintf(stderr, "cannot open %s\n", path);
+        exit(1);
+    }
+    void * data = mmap(NULL, n * sizeof(double),
+                       writable ? PROT_READ | PROT_WRITE : PROT_READ,
+                       MAP_SHARED, fd, 0);
+    close(fd);
+    if (data == MAP_FAILED) {
+        fprintf(stderr, "cannot map %s\n", path);
+        exit(1);
+    }
+    posix_madvise(data, n * sizeof(double), POSIX_MADV_SEQUENTIAL);
+    return (double *)data;
+}
+
+// a scratch file, removed as soon as it is mapped
+double * map_scratch(const char * suffix, uint64_t n)
+{
+    char path[4096];
+    snprintf(path, sizeof(path), "%s%s", scratch_prefix, suffix);
+    double * data = map_file(path, n, 1);
+    unlink(path);
+    return data;
+}
+
+void workspace_init(Workspace * p)
+{
+    uint64_t n_cells = NI*NJ*NK;
+    p->input = map_file(input_path, n_cells*NUM_INPUTS, 0);
+    p->output = map_file(output_path, n_cells*NUM_OUTPUTS, 1);
+    p->scratch[0] = map_scratch("0", n_cells*MAX_VARS);
+    p->scratch[1] = map_scratch("1", n_cells*MAX_VARS);
+    p->source_workspace = NULL;
+    p->sink_workspace = (double *)p->input;
+    p->window = (double *)malloc(
+            sizeof(double)*WINDOW_PLANES*PLANE_CELLS*MAX_VARS);
+    p->precomputed_workspace = NUM_PRECOMPUTED == 0 ? NULL :
+            map_scratch("p", NUM_PADDED_CELLS*NUM_PRECOMPUTED);
+    p->params = (double *)malloc(sizeof(double)*(NUM_PARAMS+1));
+    int r = fread(p->params, sizeof(double), NUM_PARAMS, stdin);
+}
+
+// the sink of the previous stage, initially the input, becomes the source
+void workspace_stream(Workspace * p, int last)
+{
+    p->source_workspace = p->sink_workspace;
+    p->sink_workspace = last ? p->output :
+            p->source_workspace == p->scratch[0] ? p->scratch[1] :
+                                                   p->scratch[0];
+}
+
+// fill the width layers of periodic ghost cells of a plane of the window
+// read through neighbor access in j or k; the k faces are filled along
+// the j ghost cells too, for accesses offset in both j and k
+void plane_sync(double * plane, uint64_t NJ, uint64_t NK, uint64_t n,
+                int face, int64_t width, uint64_t first, uint64_t count)
+{
+    double * src = plane + first;
+    size_t bytes = count * sizeof(double);
+    for (int64_t w = 1; w <= width; ++w) {
+        switch (face) {
+        case FACE_JM:
+            for (int64_t k = 0; k < NK; ++k)
+                memcpy(src+PLANE_OFFSET(-w,k,n),
+                       src+PLANE_OFFSET(WRAP(-w,NJ),k,n), bytes);
+            break;
+        case FACE_JP:
+            for (int64_t k = 0; k < NK; ++k)
+                memcpy(src+PLANE_OFFSET(NJ-1+w,k,n),
+                       src+PLANE_OFFSET(WRAP(w-1,NJ),k,n), bytes);
+            break;
+        case FACE_KM:
+            for (int64_t j = -PAD_J; j < (int64_t)NJ + PAD_J; ++j)
+                memcpy(src+PLANE_OFFSET(j,-w,n),
+                       src+PLANE_OFFSET(j,WRAP(-w,NK),n), bytes);
+            break;
+        case FACE_KP:
+            for (int64_t j = -PAD_J; j < (int64_t)NJ + PAD_J; ++j)
+                memcpy(src+PLANE_OFFSET(j,NK-1+w,n),
+                       src+PLANE_OFFSET(j,WRAP(w-1,NK),n), bytes);
+            break;
+        }
+    }
+}
+
+void workspace_finalize(Workspace * p)
+{
+    munmap(p->output, NI*NJ*NK*NUM_OUTPUTS*sizeof(double));
+}
+#else
 void workspace_init(Workspace * p)
 {
-    int64_t n_grid = (NI+2)*(NJ+2)*(NK+2);
+    int64_t n_grid = NUM_PADDED_CELLS;
     p->workspace = (double *)malloc(sizeof(double)*n_grid*MAX_VARS*2);
     p->source_workspace = p->workspace;
     p->sink_workspace = p->workspace + n_grid*MAX_VARS;
-    int r = fread(p->workspace, sizeof(double), NI*NJ*NK*NUM_INPUTS, stdin);
+    p->precomputed_workspace = (double *)malloc(
+            sizeof(double)*n_grid*NUM_PRECOMPUTED);
+    p->params = (double *)malloc(sizeof(double)*(NUM_PARAMS+1));
+    int r = fread(p->params, sizeof(double), NUM_PARAMS, stdin);
+    for (uint64_t f = 0, first = 0; f < NUM_INPUT_FIELDS; ++f) {
+        uint64_t n = INPUT_FIELD_SIZES[f];
+        PROFILE_START(t_read);
+        r = fread(p->workspace, sizeof(double), NI*NJ*NK*n, stdin);
+        PROFILE_STOP(t_read, "read");
 
-    FOR_IJK {
-        double * src = p->workspace + NUM_INPUTS * (k + j*NK + i*NK*NJ);
-        double * dest = p->sink_workspace + OFFSET(i,j,k,NUM_INPUTS);
-        memcpy(dest, src, NUM_INPUTS * sizeof(double));
+        PROFILE_START(t_layout);
+        FOR_IJK {
+            double * src = p->workspace + n * (k + j*NK + i*NK*NJ);
+            double * dest = p->sink_workspace + OFFSET(i,j,k,NUM_INPUTS)
+                          + first;
+            memcpy(dest, src, n * sizeof(double));
+        }
+        PROFILE_STOP(t_layout, "layout_in");
+        first += n;
     }
 }
 
-void workspace_swap_sync(Workspace * p, uint64_t n)
+void workspace_swap(Workspace * p)
 {
     double * sink = p->source_workspace;
-    double * src = p->sink_workspace;
-    p->source_workspace = src;
+    p->source_workspace = p->sink_workspace;
     p->sink_workspace = sink;
-
-    FOR_IJ {
-        memcpy(src+OFFSET(i,j,-1,n), src+OFFSET(i,j,NK-1,n), n*sizeof(double));
-        memcpy(src+OFFSET(i,j,NK,n), src+OFFSET(i,j,0,n), n*sizeof(double));
-    }
-    FOR_IK {
-        memcpy(src+OFFSET(i,-1,k,n), src+OFFSET(i,NJ-1,k,n), n*sizeof(double));
-        memcpy(src+OFFSET(i,NJ,k,n), src+OFFSET(i,0,k,n), n*sizeof(double));
+#ifdef ENZYME_MASK
+    // the stages read the state but only write the two halves of the
+    // workspace, the state is updated by mask_update
+    if (sink == p->state) {
+        double * half = p->workspace + NUM_PADDED_CELLS*MAX_VARS;
+        p->sink_workspace = p->source_workspace == half ? p->workspace : half;
     }
-    FOR_JK {
-        memcpy(src+OFFSET(-1,j,k,n), src+OFFSET(NI-1,j,k,n), n*sizeof(double));
-        memcpy(src+OFFSET(NI,j,k,n), src+OFFSET(0,j,k,n), n*sizeof(double));
+#endif
+}
+
+// fill width layers of the periodic ghost cells of one face, e.g.,
+// FACE_IM for accesses offset down along i, with count of the n variables
+// starting from first.  The faces of an axis are filled along the ghost
+// cells of the axes before it, for accesses offset along several axes.
+void workspace_sync(Workspace * p, uint64_t n, int face, int64_t width,
+                    uint64_t first, uint64_t count)
+{
+    double * src = p->source_workspace + first;
+    size_t bytes = count * sizeof(double);
+    const int64_t I0 = -PAD_I, I1 = NI + PAD_I, J0 = -PAD_J, J1 = NJ + PAD_J;
+    for (int64_t w = 1; w <= width; ++w) {
+        int64_t im = WRAP(-w,NI), ip = WRAP(w-1,NI);
+        int64_t jm = WRAP(-w,NJ), jp = WRAP(w-1,NJ);
+        int64_t km = WRAP(-w,NK), kp = WRAP(w-1,NK);
+        switch (face) {
+        case FACE_IM:
+            FOR_JK memcpy(src+OFFSET(-w,j,k,n), src+OFFSET(im,j,k,n), bytes);
+            break;
+        case FACE_IP:
+            FOR_JK memcpy(src+OFFSET(NI-1+w,j,k,n), src+OFFSET(ip,j,k,n),
+                          bytes);
+            break;
+        case FACE_JM:
+            for (int64_t i = I0; i < I1; ++i)
+            for (int64_t k = 0; k < NK; ++k)
+                memcpy(src+OFFSET(i,-w,k,n), src+OFFSET(i,jm,k,n), bytes);
+            break;
+        case FACE_JP:
+            for (int64_t i = I0; i < I1; ++i)
+            for (int64_t k = 0; k < NK; ++k)
+                memcpy(src+OFFSET(i,NJ-1+w,k,n), src+OFFSET(i,jp,k,n), bytes);
+            break;
+        case FACE_KM:
+            for (int64_t i = I0; i < I1; ++i)
+            for (int64_t j = J0; j < J1; ++j)
+                memcpy(src+OFFSET(i,j,-w,n), src+OFFSET(i,j,km,n), bytes);
+            break;
+        case FACE_KP:
+            for (int64_t i = I0; i < I1; ++i)
+            for (int64_t j = J0; j < J1; ++j)
+                memcpy(src+OFFSET(i,j,NK-1+w,n), src+OFFSET(i,j,kp,n), bytes);
+            break;
+        }
     }
 }
 
 void workspace_finalize(Workspace * p)
 {
-    FOR_IJK {
-        double * src = p->sink_workspace + OFFSET(i,j,k,NUM_OUTPUTS);
-        double * dest = p->source_workspace + NUM_OUTPUTS * (k+j*NK+i*NK*NJ);
-        memcpy(dest, src, NUM_OUTPUTS * sizeof(double));
+    if (!write_output) return;
+    for (uint64_t f = 0, first = 0; f < NUM_OUTPUT_FIELDS; ++f) {
+        uint64_t n = OUTPUT_FIELD_SIZES[f];
+        PROFILE_START(t_layout);
+        FOR_IJK {
+            double * src = p->sink_workspace + OFFSET(i,j,k,NUM_OUTPUTS)
+                         + first;
+            double * dest = p->source_workspace + n * (k+j*NK+i*NK*NJ);
+            memcpy(dest, src, n * sizeof(double));
+        }
+        PROFILE_STOP(t_layout, "layout_out");
+        PROFILE_START(t_write);
+        int r = fwrite(p->source_workspace, sizeof(double), NI*NJ*NK*n,
+                       stdout);
+        PROFILE_STOP(t_write, "write");
+        first += n;
     }
-    int r = fwrite(p->source_workspace, sizeof(double),
-                   NI*NJ*NK*NUM_OUTPUTS, stdout);
 }
+#endif
 
-int main()
+int main(int argc, char ** argv)
 {
+    int num_path_args = 0;
+#ifdef ENZYME_OUT_OF_CORE
+    if (argc < 4) {
+        fprintf(stderr, "usage: %s input output scratch_prefix\n", argv[0]);
+        return 1;
+    }
+    input_path = argv[1];
+    output_path = argv[2];
+    scratch_prefix = argv[3];
+    num_path_args = 3;
+#endif
+#ifdef ENZYME_SNAPSHOT
+    if (argc < 2) {
+        fprintf(stderr, "usage: %s snapshot_dir\n", argv[0]);
+        return 1;
+    }
+    num_path_args = 1;
+#endif
+#ifdef ENZYME_PROFILE
+    profile_file = fopen(argc > 1 + num_path_args ? argv[1 + num_path_args]
+                                                  : "profile.txt", "w");
+#endif
+    if (!read_grid_size()) {
+        fprintf(stderr, "grid size does not match the compiled program\n");
+        return 1;
+    }
+    if (!read_steps()) {
+        fprintf(stderr, "cannot read the number of steps\n");
+        return 1;
+    }
     Workspace buf;
     workspace_init(&buf);
-    ${STAGES}
+#ifdef ENZYME_MASK
+    mask_init(&buf);
+#endif
+    buf.reduce_partials = (double *)malloc(sizeof(double)*(NI*NUM_REDUCED+1));
+    buf.reductions = (double *)malloc(
+            sizeof(double)*(num_steps*NUM_REDUCED+1));
+#ifdef ENZYME_SNAPSHOT
+    snapshot_init(argv[1]);
+#endif
+    PROFILE_START(t_precompute);
+    precompute(NI,NJ,NK,&buf);
+    PROFILE_STOP(t_precompute, "precompute");
+    for (uint64_t step = 1; step <= num_steps; ++step) {
+        buf.step = step - 1;
+        ${STAGES}
+#ifdef ENZYME_MASK
+        mask_update(&buf, step);
+#endif
+#ifdef ENZYME_SNAPSHOT
+        if (snapshot_every && step % snapshot_every == 0) {
+            snapshot(&buf, step);
+        }
+#endif
+    }
+#ifdef ENZYME_SNAPSHOT
+    snapshot_finalize();
+#endif
     workspace_finalize(&buf);
+    fwrite(buf.reductions, sizeof(double), num_steps*NUM_REDUCED, stdout);
+#ifdef ENZYME_PROFILE
+    fclose(profile_file);
+#endif
 }
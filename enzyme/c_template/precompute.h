@@ -0,0 +1,17 @@
+#include<math.h>
+#include<inttypes.h>
+#include<string.h>
+
+void precompute(uint64_t NI, uint64_t NJ, uint64_t NK, Workspace * p)
+{
+    const uint64_t NUM_PRECOMPUTED = ${NUM_PRECOMPUTED};
+    if (NUM_PRECOMPUTED == 0) return;
+
+    double * p_precomputed = p->precomputed_workspace;
+    const double * params = p->params;
+
+    FOR_IJK_PADDED {
+        double * precomputed = p_precomputed + OFFSET(i,j,k,NUM_PRECOMPUTED);
+        ${CODE}
+    }
+}
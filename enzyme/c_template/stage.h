@@ -7,21 +7,29 @@ void ${STAGE_NAME}(uint64_t NI, uint64_t NJ, uint64_t NK, Workspace * p)
     const uint64_t NUM_INPUTS = ${NUM_INPUTS};
     const uint64_t NUM_OUTPUTS = ${NUM_OUTPUTS};
     const uint64_t MAX_VARS = ${MAX_VARS};
+    const uint64_t NUM_PRECOMPUTED = ${NUM_PRECOMPUTED};
+    const uint64_t NUM_REDUCED = ${NUM_REDUCED};
 
-    workspace_swap_sync(p, NUM_INPUTS);
+    workspace_swap(p);
+    PROFILE_START(t_sync);
+    ${SYNC}
+    PROFILE_STOP(t_sync, "sync");
 
     double * p_source = p->source_workspace;
     double * p_sink = p->sink_workspace;
+    const double * p_precomputed = p->precomputed_workspace;
+    const double * params = p->params;
 
-    FOR_IJK {
-        const double * source =    p_source + OFFSET(i,  j,k,NUM_INPUTS);
-        const double * source_ip = p_source + OFFSET(i+1,j,k,NUM_INPUTS);
-        const double * source_im = p_source + OFFSET(i-1,j,k,NUM_INPUTS);
-        const double * source_jp = p_source + OFFSET(i,j+1,k,NUM_INPUTS);
-        const double * source_jm = p_source + OFFSET(i,j-1,k,NUM_INPUTS);
-        const double * source_kp = p_source + OFFSET(i,j,k+1,NUM_INPUTS);
-        const double * source_km = p_source + OFFSET(i,j,k-1,NUM_INPUTS);
+    PROFILE_START(t_sweep);
+    ${REDUCE_INIT}
+// the source at the grid point offset by (di,dj,dk)
+#define SOURCE(di,dj,dk) (p_source + OFFSET(i+(di),j+(dj),k+(dk),NUM_INPUTS))
+    FOR_ACTIVE_IJK {
+        double * reduce = p->reduce_partials + i*NUM_REDUCED;
         double * sink = p_sink + OFFSET(i,j,k,NUM_OUTPUTS);
         ${CODE}
     }
+#undef SOURCE
+    ${REDUCE_COMBINE}
+    PROFILE_STOP(t_sweep, "sweep");
 }
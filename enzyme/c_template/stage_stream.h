@@ -0,0 +1,59 @@
+#include<math.h>
+#include<inttypes.h>
+#include<string.h>
+
+// copy the i-plane i, wrapped periodically, of the source into the window
+// and fill its ghost cells read through neighbor access in j and k
+static void ${STAGE_NAME}_load(uint64_t NI, uint64_t NJ, uint64_t NK,
+                               Workspace * p, int64_t i)
+{
+    const uint64_t NUM_INPUTS = ${NUM_INPUTS};
+    const double * src = p->source_workspace +
+                         WRAP(i, NI) * NJ * NK * NUM_INPUTS;
+    double * plane = p->window +
+                     WRAP(i, WINDOW_PLANES) * PLANE_CELLS * NUM_INPUTS;
+    for (int64_t j = 0; j < NJ; ++j) {
+        memcpy(plane + PLANE_OFFSET(j,0,NUM_INPUTS), src + j*NK*NUM_INPUTS,
+               NK * NUM_INPUTS * sizeof(double));
+    }
+    ${SYNC}
+}
+
+void ${STAGE_NAME}(uint64_t NI, uint64_t NJ, uint64_t NK, Workspace * p)
+{
+    const uint64_t NUM_INPUTS = ${NUM_INPUTS};
+    const uint64_t NUM_OUTPUTS = ${NUM_OUTPUTS};
+    const uint64_t MAX_VARS = ${MAX_VARS};
+    const uint64_t NUM_PRECOMPUTED = ${NUM_PRECOMPUTED};
+    const uint64_t NUM_REDUCED = ${NUM_REDUCED};
+    const int64_t WINDOW = ${WINDOW};
+
+    double * p_sink = p->sink_workspace;
+    const double * p_precomputed = p->precomputed_workspace;
+    const double * params = p->params;
+
+    // the planes within WINDOW of plane i are in the window when i is swept
+    PROFILE_START(t_sync);
+    for (int64_t i = -WINDOW; i < WINDOW; ++i) {
+        ${STAGE_NAME}_load(NI, NJ, NK, p, i);
+    }
+    PROFILE_STOP(t_sync, "sync");
+
+    PROFILE_START(t_sweep);
+    ${REDUCE_INIT}
+// the source at the grid point offset by (di,dj,dk)
+#define SOURCE(di,dj,dk) (p->window + PLANE_CELLS * NUM_INPUTS * \
+                          WRAP(i+(di), WINDOW_PLANES) + \
+                          PLANE_OFFSET(j+(dj),k+(dk),NUM_INPUTS))
+    for (int64_t i = 0; i < NI; ++i) {
+        double * reduce = p->reduce_partials + i*NUM_REDUCED;
+        ${STAGE_NAME}_load(NI, NJ, NK, p, i + WINDOW);
+        FOR_JK {
+            double * sink = p_sink + NUM_OUTPUTS * (k + NK*(j + NJ*i));
+            ${CODE}
+        }
+    }
+#undef SOURCE
+    ${REDUCE_COMBINE}
+    PROFILE_STOP(t_sweep, "sweep");
+}
@@ -5,11 +5,47 @@ typedef struct {
     double * workspace;
     double * source_workspace;
     double * sink_workspace;
+    double * precomputed_workspace;
+    double * params;
+    // out of core: the files mapped to memory that the stages stream
+    // through, and a window of three padded i-planes of the source
+    const double * input;
+    double * output;
+    double * scratch[2];
+    double * window;
+    // partial results of the reductions of each i-plane, and the
+    // reductions of each step, the current one being step
+    double * reduce_partials;
+    double * reductions;
+    uint64_t step;
+    // with an activity mask: the state, only updated in the active
+    // blocks, and the cell ranges (i0, i1, j0, j1, k0, k1) of the
+    // num_blocks blocks swept by the current stage
+    double * state;
+    const int64_t * blocks;
+    uint64_t num_blocks;
 } Workspace;
 
+enum {FACE_IM, FACE_IP, FACE_JM, FACE_JP, FACE_KM, FACE_KP};
+
 void workspace_init(Workspace * p);
-void workspace_swap_sync(Workspace * p, uint64_t n);
+void workspace_swap(Workspace * p);
+void workspace_sync(Workspace * p, uint64_t n, int face, int64_t width,
+                    uint64_t first, uint64_t count);
 void workspace_finalize(Workspace * p);
+void workspace_stream(Workspace * p, int last);
+void plane_sync(double * plane, uint64_t NJ, uint64_t NK, uint64_t n,
+                int face, int64_t width, uint64_t first, uint64_t count);
+
+#ifdef ENZYME_PROFILE
+double profile_clock();
+void profile_record(const char * phase, double seconds);
+#define PROFILE_START(t) double t = profile_clock()
+#define PROFILE_STOP(t, phase) profile_record(phase, profile_clock() - t)
+#else
+#define PROFILE_START(t)
+#define PROFILE_STOP(t, phase)
+#endif
 
 #define FOR_IJK for (int64_t i = 0; i < NI; ++i) \
                 for (int64_t j = 0; j < NJ; ++j) \
@@ -20,7 +56,52 @@ void workspace_finalize(Workspace * p);
                for (int64_t k = 0; k < NK; ++k)
 #define FOR_JK for (int64_t j = 0; j < NJ; ++j) \
                for (int64_t k = 0; k < NK; ++k)
-#define OFFSET(i,j,k,n) n * (k+1 + (NK+2)*(j+1 + (NJ+2)*(i+1)))
+
+// the grid points swept by a stage, those of its active blocks if the
+// program has an activity mask
+#ifdef ENZYME_MASK
+#define FOR_ACTIVE_IJK \
+        for (const int64_t * block = p->blocks; \
+             block < p->blocks + 6 * p->num_blocks; block += 6) \
+        for (int64_t i = block[0]; i < block[1]; ++i) \
+        for (int64_t j = block[2]; j < block[3]; ++j) \
+        for (int64_t k = block[4]; k < block[5]; ++k)
+#else
+#define FOR_ACTIVE_IJK FOR_IJK
+#endif
+
+// the grid is padded with ENZYME_HALO_I, J and K ghost cells on each
+// side, as many as the widest neighbor access of any stage along each
+// axis; a grid of ENZYME_NDIM < 3 dimensions has a single cell along the
+// remaining axes, which are not padded
+#ifndef ENZYME_NDIM
+#define ENZYME_NDIM 3
+#endif
+#ifndef ENZYME_HALO_I
+#define ENZYME_HALO_I 1
+#define ENZYME_HALO_J 1
+#define ENZYME_HALO_K 1
+#endif
+#define PAD_I ENZYME_HALO_I
+#define PAD_J (ENZYME_NDIM > 1 ? ENZYME_HALO_J : 0)
+#define PAD_K (ENZYME_NDIM > 2 ? ENZYME_HALO_K : 0)
+
+// the periodic image of index i on an axis of n cells
+#define WRAP(i,n) ((((int64_t)(i)) % (int64_t)(n) + (int64_t)(n)) % (int64_t)(n))
+
+#define FOR_IJK_PADDED \
+        for (int64_t i = -PAD_I; i < (int64_t)NI + PAD_I; ++i) \
+        for (int64_t j = -PAD_J; j < (int64_t)NJ + PAD_J; ++j) \
+        for (int64_t k = -PAD_K; k < (int64_t)NK + PAD_K; ++k)
+#define OFFSET(i,j,k,n) n * (k+PAD_K + (NK+2*PAD_K)*(j+PAD_J + \
+                                                  (NJ+2*PAD_J)*(i+PAD_I)))
+#define NUM_PADDED_CELLS ((NI+2*PAD_I)*(NJ+2*PAD_J)*(NK+2*PAD_K))
+
+// an i-plane padded in j and k, of the window of an out of core stage,
+// which holds the planes within PAD_I of the plane being swept
+#define PLANE_CELLS ((NJ+2*PAD_J)*(NK+2*PAD_K))
+#define WINDOW_PLANES (2*PAD_I+1)
+#define PLANE_OFFSET(j,k,n) n * (k+PAD_K + (NK+2*PAD_K)*(j+PAD_J))
 
 
 #endif
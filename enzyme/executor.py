@@ -1,17 +1,43 @@
 import os
 import time
+import shutil
 import string
+import hashlib
 import tempfile
 from subprocess import check_call, Popen, PIPE
 
 import numpy as np
-from .c_code import generate_c_code
+from .c_code import generate_stage_code, generate_precompute_code
+from .c_code import stage_suffixes, grid_offset
+from .operators.stencil import access_offset
+from .symbolic_value import parameter_value
+from .analysis import hoistable_values
+from .profiling import read_profile
 
 _my_path = os.path.dirname(os.path.abspath(__file__))
 _tmp_path = os.path.join(_my_path, 'tmp_c_code')
 if not os.path.exists(_tmp_path): os.mkdir(_tmp_path)
 
+# A profile-guided program, see execute, is built by running an
+# instrumented program on the leading PGO_TRAINING_CELLS cells of the
+# grid along each axis, for at most PGO_TRAINING_STEPS steps, and
+# recompiling it with the recorded profile, which is cached with the
+# program.  It reads the grid size at run time, so that the training
+# run and the real run share one program.
+
+# cells along each axis of the grid of a profile-guided training run
+PGO_TRAINING_CELLS = 16
+# most steps of a profile-guided training run
+PGO_TRAINING_STEPS = 2
+
+# cells along each axis of the blocks of an activity mask
+MASK_BLOCK = 8
+
 def unique_stages(stages):
+    '''
+    The structurally distinct stages, each compiled into one function;
+    and the index of the distinct stage for each stage in stages
+    '''
     unique_stage_list = []
     unique_stage_dict = {}
     stage_indices = []
@@ -22,41 +48,558 @@ def unique_stages(stages):
         stage_indices.append(unique_stage_dict[s])
     return unique_stage_list, stage_indices
 
-def execute(stages, x):
+def precomputed_offsets(stages, hoist=True, ndim=3):
+    '''
+    For each stage, the offsets of its hoisted values in the precomputed
+    workspace on a grid of ndim dimensions; and the number of precomputed
+    doubles per grid point
+    '''
+    offsets, num_precomputed = [], 0
+    for s in stages:
+        offsets.append({})
+        if hoist:
+            for v in hoistable_values(s, ndim=ndim):
+                offsets[-1][v] = num_precomputed
+                num_precomputed += v.size
+    return offsets, num_precomputed
+
+def parameter_offsets(stages):
+    '''
+    The offset of each parameter, by name, in the parameter vector passed
+    to the program; and the size of the vector
+    '''
+    offsets, shapes, num_params = {}, {}, 0
+    for s in stages:
+        for v in s.triburary_values:
+            if not isinstance(v, parameter_value):
+                continue
+            if v.name in offsets:
+                if shapes[v.name] != v.shape:
+                    raise ValueError('Parameter {0} has shapes {1} and {2}'
+                                     .format(v.name, shapes[v.name], v.shape))
+                continue
+            offsets[v.name], shapes[v.name] = num_params, v.shape
+            num_params += v.size
+    return offsets, shapes, num_params
+
+def parameter_vector(offsets, shapes, num_params, params):
+    vector = np.zeros(num_params)
+    for name in offsets:
+        if name not in params:
+            raise ValueError('No value given for parameter {0}'.format(name))
+        value = np.asarray(params[name], np.float64)
+        if value.shape != shapes[name]:
+            raise ValueError('Parameter {0} has shape {1}, given {2}'.format(
+                             name, shapes[name], value.shape))
+        vector[offsets[name]:offsets[name] + value.size] = value.ravel()
+    return vector
+
+def reduction_layout(stages, stage_indices):
+    '''
+    For each stage, the offsets of its reductions in the vector of the
+    reductions of one step; the name, kind, offset and shape of each
+    reduction in the vector, in order; and the size of the vector
+    '''
+    offsets, layout, num_reduced = [], [], 0
+    names = set()
+    for k, s in enumerate(stages):
+        offsets.append([])
+        if s.reductions and list(stage_indices).count(k) > 1:
+            raise ValueError('A stage computing reductions {0} is run more '
+                             'than once in a step'.format(
+                             ', '.join([r.name for r in s.reductions])))
+        for r in s.reductions:
+            if r.name in names:
+                raise ValueError('Two reductions are named {0}'.format(
+                                 r.name))
+            names.add(r.name)
+            offsets[-1].append(num_reduced)
+            layout.append((r.name, r.kind, num_reduced, r.value.shape))
+            num_reduced += r.value.size
+    return offsets, layout, num_reduced
+
+def reduction_arrays(vector, layout, steps):
+    '''
+    The reductions, by name, from the vector of the reductions of all
+    steps written by the program; each has a leading axis of the steps
+    '''
+    num_reduced = sum([int(np.prod(shape)) for _, _, _, shape in layout])
+    vector = np.asarray(vector).reshape([steps, num_reduced])
+    reduced = {}
+    for name, kind, offset, shape in layout:
+        size = int(np.prod(shape))
+        reduced[name] = vector[:, offset:offset + size].reshape(
+                (steps,) + tuple(shape))
+    return reduced
+
+def num_doubles(values):
+    return sum([v.size for v in values])
+
+def input_fields(stage, x):
+    '''
+    The grid arrays of the source fields of stage; x is one grid array
+    for a stage with a single source, or a list of them, one per source
+    '''
+    fields = list(x) if isinstance(x, (tuple, list)) else [x]
+    if len(fields) != len(stage.source_values):
+        raise ValueError('The stage has {0} source fields, given {1}'.format(
+                         len(stage.source_values), len(fields)))
+    grid = fields[0].shape[:3]
+    for f, v in zip(fields, stage.source_values):
+        if f.shape[:3] != grid or np.prod(f.shape[3:]) != v.size:
+            raise ValueError('Field of shape {0} given for a value of '
+                             'shape {1} on a grid of shape {2}'.format(
+                             f.shape, v.shape, grid))
+    return fields
+
+def output_fields(stage, grid, data, dtype=np.float64):
+    '''
+    The grid arrays of the sink fields of stage from data, a flat array
+    holding them one after another, or a grid array holding the fields
+    of each grid point one after another; one array for a single sink
+    '''
+    fields, first = [], 0
+    n_cells = int(np.prod(grid))
+    for v in stage.sink_values:
+        if data.ndim == 1:
+            field = data[first * n_cells:(first + v.size) * n_cells]
+        else:
+            field = data[..., first:first + v.size]
+        fields.append(field.astype(dtype, copy=False).reshape(grid + v.shape))
+        first += v.size
+    return fields[0] if len(fields) == 1 else tuple(fields)
+
+def grid_ndim(shape, ndim=None):
+    '''
+    The number of dimensions of a grid of shape (NI, NJ, NK); the axes
+    after the first ndim must have a single cell.  If ndim is None, it is
+    the fewest dimensions that hold the grid.  The program does not pad
+    the missing axes with ghost cells: neighbor access along them reads
+    the grid data at the grid point itself, while the index values,
+    builtin.J and K, still change across it, as on a periodic grid of
+    one cell.
+    '''
+    shape = tuple(shape[:3])
+    if ndim is None:
+        ndim = 3
+        while ndim > 1 and shape[ndim - 1] == 1:
+            ndim -= 1
+    if ndim not in (1, 2, 3):
+        raise ValueError('ndim must be 1, 2 or 3, given {0}'.format(ndim))
+    if any([n != 1 for n in shape[ndim:]]):
+        raise ValueError('A {0}D grid cannot have shape {1}'.format(
+                         ndim, shape))
+    return ndim
+
+def execute(stages, x, profile=False, hoist=True, params=None,
+            fixed_grid=True, ndim=None, out_of_core=False, scratch_dir=None,
+            steps=1, snapshot_every=0, snapshot_dir=None, output=True,
+            pgo=False, active=None, threshold=None, mask_every=4):
+    '''
+    Compile and run the stages on the grid data x, one grid array for
+    each source field of the first stage, or a single array if it has
+    one; the result has one grid array for each sink field of the last
+    stage, or is a single array.  The fields are kept side by side at
+    each grid point, and each stage reads and writes them in place.
+
+    profile: also return a ProfileReport of the run
+    hoist: compute the expensive fields that depend only on builtin.I,
+           J, K and constants once, before the first stage
+    params: the value of each enzyme.parameter by name; the compiled
+            program is reused for other values
+    fixed_grid: compile the grid size into the program instead of
+                passing it at run time
+    ndim: the dimensions of the grid, 1, 2 or 3, deduced from the shape
+          of x by default, see grid_ndim
+    out_of_core, scratch_dir: stream the grid through the stages from
+                              files in scratch_dir, see run_out_of_core
+    steps: times the stages are run, each mapping the state to the next
+    snapshot_every, snapshot_dir: write the state every snapshot_every
+                                  steps to snapshot_dir, see load_snapshots
+    output: return the result, otherwise only the reductions
+    pgo: build with profile-guided optimization, see PGO_TRAINING_CELLS
+    active, threshold, mask_every: sweep only the active blocks of an
+                                   activity mask, see mask_input
+    The values of the reductions of the stages, see global_sum, after
+    each of the steps are returned by name after the result.
+    '''
     if callable(stages):
         stages = (stages,)
+    if params is None:
+        params = {}
+    if snapshot_every and snapshot_dir is None:
+        raise ValueError('snapshot_every requires a snapshot_dir')
+    if snapshot_every and out_of_core:
+        raise ValueError('Snapshots are not supported out of core')
+    mask = active is not None or threshold is not None
+    if mask and out_of_core:
+        raise ValueError('Activity masks are not supported out of core')
     stages, stage_indices = unique_stages(stages)
+    _, layout, num_reduced = reduction_layout(stages, stage_indices)
+    if not output and not num_reduced:
+        raise ValueError('Without output, the stages must compute reductions')
+    if mask and num_reduced:
+        raise ValueError('Reductions are not supported with an activity mask')
+    first_stage, last_stage = stages[stage_indices[0]], stages[stage_indices[-1]]
+    fields = input_fields(first_stage, x)
+    if (steps != 1 or mask) and [v.size for v in last_stage.sink_values] \
+            != [v.size for v in first_stage.source_values]:
+        raise ValueError('Multiple steps and activity masks need stages '
+                         'mapping the state to a state of the same fields')
+    offsets, shapes, num_params = parameter_offsets(stages)
+    param_vector = parameter_vector(offsets, shapes, num_params, params)
+    ndim = grid_ndim(fields[0].shape, ndim)
+    mask_bytes = None
+    if mask:
+        mask_bytes = mask_input(fields[0].shape[:3], active, threshold,
+                                mask_every)
+    t_compile = time.time()
+    snapshot = bool(snapshot_every)
+    train = None
+    if pgo:
+        fixed_grid = False
+        training = [f[(slice(0, PGO_TRAINING_CELLS),) * ndim] for f in fields]
+        training_steps = min(steps, PGO_TRAINING_STEPS)
+        def train(path):
+            if out_of_core:
+                # the training result is not kept in scratch_dir
+                run_out_of_core(path, stages, training, param_vector, None,
+                                stage_indices, scratch_dir, training_steps,
+                                num_reduced, False)
+                return
+            training_snapshot_dir = tempfile.mkdtemp(prefix='enzyme-')
+            try:
+                run(path, stages, training, param_vector, None,
+                    stage_indices, training_steps, snapshot_every,
+                    training_snapshot_dir, num_reduced, output,
+                    mask_input(training[0].shape[:3]) if mask else None)
+            finally:
+                shutil.rmtree(training_snapshot_dir)
+    path = build(stages, stage_indices, fields, profile, hoist, fixed_grid,
+                 ndim, out_of_core, snapshot, mask=mask, train=train)
+    t_compile = time.time() - t_compile
+    if snapshot and not os.path.exists(snapshot_dir):
+        os.makedirs(snapshot_dir)
+    if out_of_core:
+        def run_program(profile_file=None):
+            return run_out_of_core(path, stages, fields, param_vector,
+                                   profile_file, stage_indices, scratch_dir,
+                                   steps, num_reduced, output)
+    else:
+        def run_program(profile_file=None):
+            return run(path, stages, fields, param_vector, profile_file,
+                       stage_indices, steps, snapshot_every, snapshot_dir,
+                       num_reduced, output, mask_bytes)
+    def results(y, *report):
+        if num_reduced:
+            y, reduced = y
+            y = ((y,) if output else ()) + \
+                (reduction_arrays(reduced, layout, steps),)
+        else:
+            y = (y,)
+        y += report
+        return y[0] if len(y) == 1 else y
+    if not profile:
+        return results(run_program())
+    profile_file = tempfile.NamedTemporaryFile(suffix='.txt', dir=path,
+                                               delete=False).name
+    try:
+        y = run_program(profile_file)
+        report = read_profile(profile_file, stages, stage_indices * steps,
+                              int(np.prod(fields[0].shape[:3])), t_compile)
+    finally:
+        os.remove(profile_file)
+    return results(y, report)
+
+def build(stages, stage_indices, x, profile=False, hoist=True,
+          fixed_grid=True, ndim=3, out_of_core=False, snapshot=False,
+          mask=False, train=None):
+    '''
+    Generate and compile the code, unless a program compiled from the same
+    code is found in the cache.  Returns the directory of the program.
+    If train is given, the program is built with profile-guided
+    optimization: train(path) runs the instrumented program compiled in
+    path, and the program is recompiled using the profile it recorded,
+    which is kept in the directory of the program.
+    '''
+    tmp_path = make_build_dir()
+    generate_code(tmp_path, stages, stage_indices, x, hoist, fixed_grid,
+                  ndim, out_of_core, snapshot, mask)
+    pgo = 'use' if train is not None else None
+    path = os.path.join(_tmp_path,
+                        'build-' + source_hash(tmp_path, profile, pgo))
+    if os.path.exists(os.path.join(path, 'main')):
+        shutil.rmtree(tmp_path)
+        return path
+    if train is not None:
+        compile_code(tmp_path, profile, 'generate')
+        train(tmp_path)
+    compile_code(tmp_path, profile, pgo)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        if os.path.exists(os.path.join(path, 'main')):
+            # compiled concurrently by another process
+            shutil.rmtree(tmp_path)
+        else:
+            # left without a program, e.g., by an interrupted build
+            shutil.rmtree(path)
+            os.rename(tmp_path, path)
+    return path
+
+def source_hash(path, profile=False, pgo=None):
+    sha = hashlib.sha1(' '.join(compile_command(profile, pgo)).encode())
+    for filename in sorted(os.listdir(path)):
+        sha.update(filename.encode())
+        with open(os.path.join(path, filename), 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+def make_build_dir():
     prefix = time.strftime('%Y%m%d-%H%M%S-', time.localtime())
-    tmp_path = tempfile.mkdtemp(prefix=prefix, dir=_tmp_path)
-    generate_main_c(tmp_path, stages, stage_indices, x)
-    generate_workspace_h(tmp_path)
-    generate_stage_h(tmp_path, stages)
-    check_call('gcc --std=c99 -O3 main.c -lm -o main'.split(), cwd=tmp_path)
-    in_bytes = np.asarray(x, np.float64, 'C').tobytes()
-    p = Popen('./main', cwd=tmp_path, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    return tempfile.mkdtemp(prefix=prefix, dir=_tmp_path)
+
+def generate_code(path, stages, stage_indices, x, hoist=True,
+                  fixed_grid=True, ndim=3, out_of_core=False, snapshot=False,
+                  mask=False):
+    offsets, num_precomputed = precomputed_offsets(stages, hoist, ndim)
+    params, _, num_params = parameter_offsets(stages)
+    reduced, _, num_reduced = reduction_layout(stages, stage_indices)
+    generate_main_c(path, stages, stage_indices, x, num_precomputed,
+                    num_params, fixed_grid, ndim, out_of_core, snapshot,
+                    num_reduced, mask)
+    generate_workspace_h(path)
+    generate_precompute_h(path, stages, offsets, num_precomputed, params)
+    generate_stage_h(path, stages, offsets, num_precomputed, params, ndim,
+                     out_of_core, reduced, num_reduced)
+
+def compile_command(profile=False, pgo=None):
+    '''
+    The command compiling main.c; pgo is None, 'generate' to instrument
+    the program to record a profile in its directory, or 'use' to
+    optimize it with the recorded profile
+    '''
+    command = 'gcc --std=c99 -O3 -pthread main.c -lm -o main'.split()
+    if profile:
+        command.append('-DENZYME_PROFILE')
+    if pgo is not None:
+        command.append('-fprofile-' + pgo)
+    if pgo == 'generate':
+        command.append('-fprofile-update=atomic')
+    return command
+
+def compile_code(path, profile=False, pgo=None):
+    check_call(compile_command(profile, pgo), cwd=path)
+
+def run_header(x, params, steps=1, snapshot_every=0, output=True):
+    '''
+    The grid size, the steps, whether to write the output, and the
+    parameter vector read by the program
+    '''
+    return (np.array(x.shape[:3], np.uint64).tobytes() +
+            np.array([steps, snapshot_every, output], np.uint64).tobytes() +
+            np.asarray(params, np.float64).tobytes())
+
+def mask_input(grid, active=None, threshold=None, every=4):
+    '''
+    The active cells, one byte each, the threshold and the steps between
+    rebuilds of the active blocks, read by a program with an activity
+    mask after the grid data.  The stages only sweep the blocks of
+    MASK_BLOCK cells along each axis that are active, and the state of
+    the other cells is left unchanged by the steps.  active is a boolean
+    array of the grid shape, a block being active if any of its cells
+    is, by default all of them.  If threshold is given, every steps the
+    active blocks become those whose state changed by at least threshold
+    in the last step, and the blocks the changes can reach before the
+    next rebuild.  The earlier stages of a step also sweep the blocks
+    the neighbor accesses of the later ones read.  The stages must map
+    the state to a state of the same fields, and neither reductions nor
+    out of core grids are supported with a mask.
+    '''
+    if active is None:
+        active = np.ones(grid, bool)
+    active = np.asarray(active, bool)
+    if active.shape != tuple(grid):
+        raise ValueError('The active cells of a grid of shape {0} cannot '
+                         'have shape {1}'.format(tuple(grid), active.shape))
+    if threshold is None:
+        threshold, every = 0., 0
+    return (np.asarray(active, np.uint8, 'C').tobytes() +
+            np.array([threshold], np.float64).tobytes() +
+            np.array([every], np.uint64).tobytes())
+
+def run(path, stages, x, params=(), profile_file=None, stage_indices=None,
+        steps=1, snapshot_every=0, snapshot_dir=None, num_reduced=0,
+        output=True, mask=None):
+    '''
+    Run the program in path on x, a grid array or a list of them, see
+    execute; params is the parameter vector,
+    profile_file where a profiling program writes its timers,
+    stage_indices the order in which the stages are invoked in each of
+    the steps, and snapshot_dir where a program compiled to write
+    snapshots writes one every snapshot_every steps.
+    If the program computes num_reduced reductions per step, the vector
+    of the reductions of all steps is returned after the result, which
+    is None if output is False.  A program with an activity mask reads
+    mask, see mask_input, after the grid data.
+    '''
+    if stage_indices is None:
+        stage_indices = range(len(stages))
+    fields = input_fields(stages[stage_indices[0]], x)
+    in_bytes = (run_header(fields[0], params, steps, snapshot_every, output) +
+                b''.join([np.asarray(f, np.float64, 'C').tobytes()
+                          for f in fields]) + (mask or b''))
+    command = ['./main']
+    if snapshot_every:
+        command.append(os.path.abspath(snapshot_dir))
+    if profile_file is not None:
+        command.append(profile_file)
+    p = Popen(command, cwd=path, stdin=PIPE, stdout=PIPE, stderr=PIPE)
     out_bytes, err = p.communicate(in_bytes)
     assert len(err.strip()) == 0
-    y = np.frombuffer(out_bytes, np.float64)
-    y_shape = x.shape[:3] + stages[-1].sink_values[0].shape
-    return np.asarray(y, x.dtype).reshape(y_shape)
-
-def generate_main_c(path, stages, stage_indices, x):
-    ni, nj, nk = x.shape[:3]
-    max_vars = max(max([s.source_values[0].size for s in stages]),
-                   max([s.sink_values[0].size for s in stages]))
-    assert np.prod(x.shape[3:]) == stages[0].source_values[0].size
-    num_inputs = stages[0].source_values[0].size
-    num_outputs = stages[-1].sink_values[0].size
+    out = np.frombuffer(out_bytes, np.float64)
+    reduced = out[len(out) - steps * num_reduced:]
+    y = None
+    if output:
+        y = output_fields(stages[stage_indices[-1]], fields[0].shape[:3],
+                          out[:len(out) - len(reduced)], fields[0].dtype)
+    return (y, reduced) if num_reduced else y
+
+def is_mapped_file(x):
+    '''
+    Whether x is a numpy.memmap of a whole file of doubles in C order
+    '''
+    return (isinstance(x, np.memmap) and x.filename is not None and
+            x.offset == 0 and x.dtype == np.float64 and
+            x.flags.c_contiguous and
+            os.path.getsize(x.filename) == x.nbytes)
+
+def run_out_of_core(path, stages, x, params=(), profile_file=None,
+                    stage_indices=None, scratch_dir=None, steps=1,
+                    num_reduced=0, output=True):
+    '''
+    Run the out of core program in path on x, a grid array or a list of
+    them, written to a file in scratch_dir, by default the system
+    temporary directory, i-plane by i-plane, with the fields side by
+    side, unless it is a single mapped file already, e.g., a
+    numpy.memmap, which the program reads directly.  The program streams
+    the grid through each stage in i-planes, so that only a window of
+    planes of the grid is in memory.
+    Returns the result mapped from a file in scratch_dir, which the
+    caller removes when done, or removed if output is False, and the
+    reductions as run does.
+    '''
+    if stage_indices is None:
+        stage_indices = range(len(stages))
+    fields = input_fields(stages[stage_indices[0]], x)
+    grid = fields[0].shape[:3]
+    work_dir = tempfile.mkdtemp(prefix='enzyme-', dir=scratch_dir)
+    output_file, failed = None, True
+    try:
+        if len(fields) == 1 and is_mapped_file(fields[0]):
+            input_file = fields[0].filename
+        else:
+            input_file = os.path.join(work_dir, 'input')
+            with open(input_file, 'wb') as f:
+                for i in range(grid[0]):
+                    planes = [np.reshape(x[i], grid[1:] + (-1,))
+                              for x in fields]
+                    np.concatenate(planes, -1).astype(np.float64).tofile(f)
+        fd, output_file = tempfile.mkstemp(prefix='enzyme-', suffix='.out',
+                                           dir=scratch_dir)
+        os.close(fd)
+        in_bytes = run_header(fields[0], params, steps)
+        command = ['./main', input_file, output_file,
+                   os.path.join(work_dir, 'scratch-')]
+        if profile_file is not None:
+            command.append(profile_file)
+        p = Popen(command, cwd=path, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        out_bytes, err = p.communicate(in_bytes)
+        assert len(err.strip()) == 0
+        failed = False
+    finally:
+        shutil.rmtree(work_dir)
+        if failed and output_file is not None:
+            os.remove(output_file)
+    reduced = np.frombuffer(out_bytes, np.float64)
+    y = None
+    if output:
+        last_stage = stages[stage_indices[-1]]
+        y = np.memmap(output_file, np.float64, 'r+',
+                      shape=grid + (num_doubles(last_stage.sink_values),))
+        y = output_fields(last_stage, grid, y)
+    else:
+        os.remove(output_file)
+    return (y, reduced) if num_reduced else y
+
+def max_doubles(stages):
+    '''
+    The most doubles per grid point of the sources or sinks of a stage
+    '''
+    return max([max(num_doubles(s.source_values), num_doubles(s.sink_values))
+                for s in stages])
+
+def generate_main_c(path, stages, stage_indices, x, num_precomputed,
+                    num_params=0, fixed_grid=True, ndim=3, out_of_core=False,
+                    snapshot=False, num_reduced=0, mask=False):
+    first_stage, last_stage = stages[stage_indices[0]], stages[stage_indices[-1]]
+    grid = input_fields(first_stage, x)[0].shape[:3]
+    if fixed_grid:
+        grid_size = '\n'.join(['const uint64_t N{0} = {1};'.format(n, size)
+                               for n, size in zip('IJK', grid)])
+    else:
+        grid_size = '#define ENZYME_RUNTIME_GRID\nuint64_t NI, NJ, NK;'
+    max_vars = max_doubles(stages)
+    num_inputs = num_doubles(first_stage.source_values)
+    num_outputs = num_doubles(last_stage.sink_values)
+    field_sizes = lambda values: ', '.join([str(v.size) for v in values])
+    halo_defines = ''.join(['\n#define ENZYME_HALO_{0} {1}'.format(axis, h)
+                            for axis, h in zip('IJK', grid_halo(stages, ndim))])
+    mask_halos = ', '.join(['{{{0}}}'.format(', '.join(map(str, stage_halo(
+                                stages[i], ndim)))) for i in stage_indices])
 
     names = ['stage_{0}'.format(i) for i in range(len(stages))]
-    include = '\n'.join(['#include "{0}.h"'.format(n) for n in names])
+    include = '\n'.join(['#include "{0}.h"'.format(n)
+                         for n in ['precompute'] + names])
     names = ['stage_{0}'.format(i) for i in stage_indices]
     stages = '\n'.join(['{0}(NI,NJ,NK,&buf);'.format(n) for n in names])
+    defines = '#define ENZYME_NDIM {0}'.format(ndim) + halo_defines
+    if out_of_core:
+        defines += '\n#define ENZYME_OUT_OF_CORE'
+        last = ['0'] * (len(names) - 1) + ['step == num_steps']
+        stages = '\n'.join(['workspace_stream(&buf, {0});\n{1}(NI,NJ,NK,&buf);'
+                            .format(is_last, n)
+                            for is_last, n in zip(last, names)])
+    if mask:
+        defines += ('\n#define ENZYME_MASK' +
+                    '\n#define ENZYME_MASK_BLOCK {0}'.format(MASK_BLOCK) +
+                    '\n#define MASK_NUM_STAGES {0}'.format(len(names)) +
+                    '\n#define MASK_STAGE_HALOS {{{0}}}'.format(mask_halos))
+        stages = '\n'.join(['mask_select(&buf, {0});\n{1}(NI,NJ,NK,&buf);'
+                            .format(s, n) for s, n in enumerate(names)])
+    if snapshot:
+        if len(last_stage.sink_values) == 1:
+            shape = last_stage.sink_values[0].shape
+        else:
+            shape = (num_outputs,)
+        shape = ''.join([', {0}'.format(n) for n in shape])
+        defines += ('\n#define ENZYME_SNAPSHOT' +
+                    '\n#define SNAPSHOT_SHAPE "{0}"'.format(shape))
 
     template = open(os.path.join(_my_path, 'c_template', 'main.c')).read()
     template = string.Template(template)
-    code = template.substitute(NI=ni, NJ=nj, NK=nk, MAX_VARS=max_vars,
+    code = template.substitute(DEFINES=defines,
+                               GRID_SIZE=grid_size, MAX_VARS=max_vars,
                                NUM_INPUTS=num_inputs, NUM_OUTPUTS=num_outputs,
+                               NUM_INPUT_FIELDS=len(first_stage.source_values),
+                               INPUT_FIELD_SIZES=field_sizes(
+                                       first_stage.source_values),
+                               NUM_OUTPUT_FIELDS=len(last_stage.sink_values),
+                               OUTPUT_FIELD_SIZES=field_sizes(
+                                       last_stage.sink_values),
+                               NUM_PRECOMPUTED=num_precomputed,
+                               NUM_PARAMS=num_params,
+                               NUM_REDUCED=num_reduced,
                                INCLUDE=include, STAGES=stages)
     with open(os.path.join(path, 'main.c'), 'wt') as f:
         f.write(code)
@@ -66,20 +609,144 @@ def generate_workspace_h(path):
     with open(os.path.join(path, 'workspace.h'), 'wt') as f:
         f.write(code)
 
-def generate_stage_h(path, stages):
+def generate_precompute_h(path, stages, offsets, num_precomputed, params=None):
+    template = open(os.path.join(_my_path, 'c_template', 'precompute.h')).read()
+    template = string.Template(template)
+    code = ''
+    for s, precomputed in zip(stages, offsets):
+        if precomputed:
+            code += '{\n' + generate_precompute_code(s, precomputed, params) + '}\n'
+    code = template.substitute(NUM_PRECOMPUTED=num_precomputed, CODE=code)
+    with open(os.path.join(path, 'precompute.h'), 'wt') as f:
+        f.write(code)
+
+def contiguous_runs(indices):
+    '''
+    The sorted indices as (first, count) runs of consecutive integers
+    '''
+    runs = []
+    for i in indices:
+        if runs and sum(runs[-1]) == i:
+            runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+        else:
+            runs.append((i, 1))
+    return runs
+
+FACES = ['im', 'ip', 'jm', 'jp', 'km', 'kp']
+
+def halo_faces(halo):
+    '''
+    For each face of the grid, e.g., 'im' for the ghost cells below i = 0,
+    the width of its ghost cells read, and the sorted source elements read
+    in them, given the source halo of each neighbor access, see
+    c_code.source_halo.  An access offset along several axes reads the
+    ghost cells of each of their faces.
+    '''
+    faces = {}
+    for access, indices in halo.items():
+        for axis, d in zip('ijk', access_offset(access)):
+            if d:
+                face = axis + ('p' if d > 0 else 'm')
+                width, elements = faces.get(face, (0, set()))
+                faces[face] = (max(width, abs(d)), elements.union(indices))
+    return dict((face, (width, sorted(elements)))
+                for face, (width, elements) in faces.items())
+
+def generate_sync_code(halo, out_of_core=False):
+    '''
+    Calls filling the ghost cells of the source elements in halo, see
+    c_code.source_halo; nothing for a stage without neighbor access.
+    Each face is filled as wide as the stage reads it, and the faces in
+    the order of the axes, see workspace_sync.  Out of core, the ghost
+    cells in i are filled by the window of planes, and those in j and k
+    of each plane when it enters the window.
+    '''
+    c_code = ''
+    faces = halo_faces(halo)
+    for face in FACES:
+        if out_of_core and face in ('im', 'ip'):
+            continue
+        width, elements = faces.get(face, (0, []))
+        for first, count in contiguous_runs(elements):
+            if out_of_core:
+                c_code += ('plane_sync(plane, NJ, NK, NUM_INPUTS, FACE_{0}, '
+                           '{1}, {2}, {3});\n').format(face.upper(), width,
+                                                      first, count)
+            else:
+                c_code += ('workspace_sync(p, NUM_INPUTS, FACE_{0}, '
+                           '{1}, {2}, {3});\n').format(face.upper(), width,
+                                                      first, count)
+    return c_code
+
+def grid_halo(stages, ndim=3):
+    '''
+    The ghost cells padding the grid along each axis, at least one, for
+    the widest neighbor access of the generated code of any stage
+    '''
+    halo = [1, 1, 1]
     for s in stages:
-        assert len(s.source_values) == len(s.sink_values) == 1
-    template = open(os.path.join(_my_path, 'c_template', 'stage.h')).read()
+        halo = [max(h, d) for h, d in zip(halo, stage_halo(s, ndim))]
+    return halo
+
+def stage_halo(stage, ndim=3):
+    '''
+    The widest neighbor access of the generated code of stage along
+    each axis, 0 if none
+    '''
+    halo = [0, 0, 0]
+    for suffix in stage_suffixes(stage, ndim):
+        halo = [max(h, abs(d)) for h, d in zip(halo,
+                                                grid_offset(suffix, ndim))]
+    return halo
+
+# initial partial result of each kind of reduction, and how two combine
+REDUCE_IDENTITY = {'sum': '0.0', 'max': '-INFINITY', 'min': 'INFINITY'}
+REDUCE_COMBINE = {'sum': 'acc += {0};', 'max': 'acc = fmax(acc, {0});',
+                  'min': 'acc = fmin(acc, {0});'}
+
+def generate_reduction_code(stage, reduced):
+    '''
+    Code initializing the partial results of the reductions of stage,
+    at the offsets in reduced, before the sweep, and combining them after.
+    Each i-plane accumulates its own partial results, which are combined
+    in the order of i, so that the result does not depend on how the
+    sweep is divided among threads.
+    '''
+    init, combine = '', ''
+    for r, offset in zip(stage.reductions, reduced):
+        for e in range(offset, offset + r.value.size):
+            init += ('for (int64_t i = 0; i < NI; ++i) '
+                     'p->reduce_partials[i*NUM_REDUCED+{0}] = {1};\n').format(
+                             e, REDUCE_IDENTITY[r.kind])
+            combine += ('{{\n    double acc = p->reduce_partials[{0}];\n'
+                        '    for (int64_t i = 1; i < NI; ++i) {1}\n'
+                        '    p->reductions[p->step*NUM_REDUCED+{0}] = acc;\n'
+                        '}}\n').format(e, REDUCE_COMBINE[r.kind].format(
+                                'p->reduce_partials[i*NUM_REDUCED+{0}]'
+                                .format(e)))
+    return init, combine
+
+def generate_stage_h(path, stages, offsets, num_precomputed, params=None,
+                     ndim=3, out_of_core=False, reduced=None, num_reduced=0):
+    template_name = 'stage_stream.h' if out_of_core else 'stage.h'
+    template = open(os.path.join(_my_path, 'c_template', template_name)).read()
     template = string.Template(template)
-    max_vars = max(max([s.source_values[0].size for s in stages]),
-                   max([s.sink_values[0].size for s in stages]))
+    max_vars = max_doubles(stages)
+    if reduced is None:
+        reduced = [[] for s in stages]
     for i, s in enumerate(stages):
         stage_name = 'stage_{0}'.format(i)
-        code = generate_c_code(s)
-        num_inputs = s.source_values[0].size
-        num_outputs = s.sink_values[0].size
+        code, halo = generate_stage_code(s, offsets[i], params, ndim,
+                                         reduced[i])
+        reduce_init, reduce_combine = generate_reduction_code(s, reduced[i])
+        num_inputs = num_doubles(s.source_values)
+        num_outputs = num_doubles(s.sink_values)
         code = template.substitute(
                 MAX_VARS=max_vars, STAGE_NAME=stage_name,
-                NUM_INPUTS=num_inputs, NUM_OUTPUTS=num_outputs, CODE=code)
+                NUM_PRECOMPUTED=num_precomputed, NUM_REDUCED=num_reduced,
+                NUM_INPUTS=num_inputs, NUM_OUTPUTS=num_outputs,
+                SYNC=generate_sync_code(halo, out_of_core), CODE=code,
+                REDUCE_INIT=reduce_init, REDUCE_COMBINE=reduce_combine,
+                WINDOW=max([abs(access_offset(a)[0]) for a in halo] + [0]))
         with open(os.path.join(path, stage_name + '.h'), 'wt') as f:
             f.write(code)
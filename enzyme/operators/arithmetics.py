@@ -6,90 +6,356 @@ import numpy as np
 
 from .op_base import infer_context
 from .op_base import OpBase, BinaryOp, BinaryFunction, UnitaryFunction
+from .op_base import ElementwiseOp, sum_shape, memoize, index_table
+from .op_base import broadcast_indices, tangent_sum, _shape, _context
 
 __all__ = ['add', 'sub', 'mul', 'truediv', 'pow', 'neg', 'sin', 'cos', 'exp',
-           'sum']
+           'sqrt', 'abs', 'log', 'tanh', 'minimum', 'maximum',
+           'less', 'less_equal', 'greater', 'greater_equal', 'equal',
+           'not_equal', 'where', 'sum']
+
+def _sin(x):
+    return infer_context(x).sin(x)
+
+def _cos(x):
+    return infer_context(x).cos(x)
+
+def _exp(x):
+    return infer_context(x).exp(x)
+
+def _sqrt(x):
+    return infer_context(x).sqrt(x)
+
+def _abs(x):
+    return infer_context(x).abs(x)
+
+def _log(x):
+    return infer_context(x).log(x)
+
+def _tanh(x):
+    return infer_context(x).tanh(x)
+
+def _minimum(x, y):
+    return _context(x, y).minimum(x, y)
+
+def _maximum(x, y):
+    return _context(x, y).maximum(x, y)
+
+def _where(condition, x, y):
+    return _context(condition, x, y).where(condition, x, y)
+
+def _compare(name, x, y):
+    '''
+    The comparison name, e.g., 'less', of x and y, which is 1.0 where true
+    and 0.0 where false as in the generated code, also on numpy arrays
+    '''
+    ctx = _context(x, y)
+    result = getattr(ctx, name)(x, y)
+    return result * 1. if ctx is np else result
+
+def _less(x, y):
+    return _compare('less', x, y)
+
+def _less_equal(x, y):
+    return _compare('less_equal', x, y)
+
+def _greater(x, y):
+    return _compare('greater', x, y)
+
+def _greater_equal(x, y):
+    return _compare('greater_equal', x, y)
+
+def _equal(x, y):
+    return _compare('equal', x, y)
+
+def _not_equal(x, y):
+    return _compare('not_equal', x, y)
+
+def _zero_partials(op, inputs, output):
+    return (None,) * len(inputs)
 
 class add(BinaryOp):
+    __slots__ = ()
+    linear = True
+
     def __init__(self, a, b):
         BinaryOp.__init__(self,
                           operator.add,
                           (a, b), name="add",
                           c_operator_str="+")
 
+    def tangent(self, partials, tangents):
+        return tangent_sum(self.output.shape, *tangents)
+
 class sub(BinaryOp):
+    __slots__ = ()
+    linear = True
+
     def __init__(self, a, b):
         BinaryOp.__init__(self,
                           operator.sub,
                           (a, b), name="sub",
                           c_operator_str="-")
 
+    def tangent(self, partials, tangents):
+        ta, tb = tangents
+        return tangent_sum(self.output.shape, ta,
+                           None if tb is None else -tb)
+
 class mul(BinaryOp):
+    __slots__ = ()
+
     def __init__(self, a, b):
         BinaryOp.__init__(self,
                           operator.mul,
                           (a, b), name="mul",
                           c_operator_str="*")
 
+    def partials(self, inputs, output):
+        a, b = inputs
+        return b, a
+
 class truediv(BinaryOp):
+    __slots__ = ()
+
     def __init__(self, a, b):
         BinaryOp.__init__(self,
                           operator.truediv,
                           (a, b), name="div",
                           c_operator_str="/")
 
+    def partials(self, inputs, output):
+        a, b = inputs
+        return 1. / b, -output / b
+
 class pow(BinaryFunction):
+    __slots__ = ()
+
     def __init__(self, a, b):
         BinaryFunction.__init__(self,
                                 operator.pow,
                                 (a, b), name="pow",
                                 c_function_str="pow")
 
+    def partials(self, inputs, output):
+        a, b = inputs
+        return b * a ** (b - 1), output * _context(a).log(a)
+
 class neg(UnitaryFunction):
+    __slots__ = ()
+    linear = True
+
     def __init__(self, a):
         UnitaryFunction.__init__(self,
                                  operator.neg,
                                  (a,), name="neg",
                                  c_function_str="-")
 
+    def tangent(self, partials, tangents):
+        ta, = tangents
+        return None if ta is None else -ta
+
 class sin(UnitaryFunction):
+    __slots__ = ()
+
     def __init__(self, a):
-        op = lambda x: infer_context(x).sin(x)
-        UnitaryFunction.__init__(self, op, (a,), name="sin",
+        UnitaryFunction.__init__(self, _sin, (a,), name="sin",
                                  c_function_str="sin")
 
+    def partials(self, inputs, output):
+        return _cos(inputs[0]),
+
 class cos(UnitaryFunction):
+    __slots__ = ()
+
     def __init__(self, a):
-        op = lambda x: infer_context(x).cos(x)
-        UnitaryFunction.__init__(self, op, (a,), name="cos",
+        UnitaryFunction.__init__(self, _cos, (a,), name="cos",
                                  c_function_str="cos")
 
+    def partials(self, inputs, output):
+        return -_sin(inputs[0]),
+
 class exp(UnitaryFunction):
+    __slots__ = ()
+
     def __init__(self, a):
-        op = lambda x: infer_context(x).exp(x)
-        UnitaryFunction.__init__(self, op, (a,), name="exp",
+        UnitaryFunction.__init__(self, _exp, (a,), name="exp",
                                  c_function_str="exp")
 
+    def partials(self, inputs, output):
+        return output,
+
+
+@memoize
+def sum_indices(shape, axis):
+    '''
+    The flat index of the output element each element of an array of
+    shape is added to when summing along axis, or all axes if None
+    '''
+    ind_out = np.zeros(shape, int)
+    if axis is not None:
+        out_shape = list(shape)
+        out_shape[axis] = 1
+        ind_out += index_table(tuple(out_shape))
+    return tuple(np.ravel(ind_out).tolist())
+
+class sqrt(UnitaryFunction):
+    __slots__ = ()
+
+    def __init__(self, a):
+        UnitaryFunction.__init__(self, _sqrt, (a,), name="sqrt",
+                                 c_function_str="sqrt")
+
+    def partials(self, inputs, output):
+        return 0.5 / output,
+
+class abs(UnitaryFunction):
+    __slots__ = ()
+
+    def __init__(self, a):
+        UnitaryFunction.__init__(self, _abs, (a,), name="abs",
+                                 c_function_str="fabs")
+
+    def partials(self, inputs, output):
+        return _where(_less(inputs[0], 0.), -1., 1.),
+
+class log(UnitaryFunction):
+    __slots__ = ()
+
+    def __init__(self, a):
+        UnitaryFunction.__init__(self, _log, (a,), name="log",
+                                 c_function_str="log")
+
+    def partials(self, inputs, output):
+        return 1. / inputs[0],
+
+class tanh(UnitaryFunction):
+    __slots__ = ()
+
+    def __init__(self, a):
+        UnitaryFunction.__init__(self, _tanh, (a,), name="tanh",
+                                 c_function_str="tanh")
+
+    def partials(self, inputs, output):
+        return 1. - output * output,
+
+# C fmin and fmax return the other argument if one is NaN, where numpy
+# minimum and maximum return NaN
+
+class minimum(BinaryFunction):
+    __slots__ = ()
+
+    def __init__(self, a, b):
+        BinaryFunction.__init__(self, _minimum, (a, b), name="minimum",
+                                c_function_str="fmin")
+
+    def partials(self, inputs, output):
+        first = _less_equal(*inputs)
+        return first, 1. - first
+
+class maximum(BinaryFunction):
+    __slots__ = ()
+
+    def __init__(self, a, b):
+        BinaryFunction.__init__(self, _maximum, (a, b), name="maximum",
+                                c_function_str="fmax")
+
+    def partials(self, inputs, output):
+        first = _greater_equal(*inputs)
+        return first, 1. - first
+
+# comparisons are 1.0 where true and 0.0 where false, in the generated code
+# as on numpy arrays, see _compare
+
+class less(BinaryOp):
+    __slots__ = ()
+    partials = _zero_partials
+
+    def __init__(self, a, b):
+        BinaryOp.__init__(self, _less, (a, b), name="less",
+                          c_operator_str="<")
+
+class less_equal(BinaryOp):
+    __slots__ = ()
+    partials = _zero_partials
+
+    def __init__(self, a, b):
+        BinaryOp.__init__(self, _less_equal, (a, b), name="less_equal",
+                          c_operator_str="<=")
+
+class greater(BinaryOp):
+    __slots__ = ()
+    partials = _zero_partials
+
+    def __init__(self, a, b):
+        BinaryOp.__init__(self, _greater, (a, b), name="greater",
+                          c_operator_str=">")
+
+class greater_equal(BinaryOp):
+    __slots__ = ()
+    partials = _zero_partials
+
+    def __init__(self, a, b):
+        BinaryOp.__init__(self, _greater_equal, (a, b), name="greater_equal",
+                          c_operator_str=">=")
+
+class equal(BinaryOp):
+    __slots__ = ()
+    partials = _zero_partials
+
+    def __init__(self, a, b):
+        BinaryOp.__init__(self, _equal, (a, b), name="equal",
+                          c_operator_str="==")
+
+class not_equal(BinaryOp):
+    __slots__ = ()
+    partials = _zero_partials
+
+    def __init__(self, a, b):
+        BinaryOp.__init__(self, _not_equal, (a, b), name="not_equal",
+                          c_operator_str="!=")
+
+
+class where(ElementwiseOp):
+    '''
+    Elements of a where condition is nonzero, and of b elsewhere, selected
+    without branching
+    '''
+    __slots__ = ()
+
+    def __init__(self, condition, a, b):
+        OpBase.__init__(self, _where, (condition, a, b), name='where')
+
+    def partials(self, inputs, output):
+        first = _not_equal(inputs[0], 0.)
+        return None, first, 1. - first
+
+    def c_code(self, input_refs, output_var_name):
+        c_refs, a_refs, b_refs = input_refs
+        indices = broadcast_indices(*[_shape(inp) for inp in self.inputs])
+        line = '{0}[{{0}}] = {{1}} ? {{2}} : {{3}};\n'.format(output_var_name)
+        return ''.join([line.format(i, c_refs[ic], a_refs[ia], b_refs[ib])
+                        for i, (ic, ia, ib) in enumerate(zip(*indices))])
 
 class sum(OpBase):
+    __slots__ = ('axis',)
+    key_attrs = ('axis',)
+    linear = True
+
     def __init__(self, a, axis=None):
         self.axis = copy.copy(axis)
         OpBase.__init__(self, lambda x: x.sum(self.axis),
                         (a,), name='sum')
 
-    def c_code(self, input_var_names, output_var_name):
+    def infer_shape(self, input_shape):
+        return sum_shape(input_shape, self.axis)
+
+    def c_code(self, input_refs, output_var_name):
         inp, out = self.inputs[0], self.output
-        ind_out = np.zeros(inp.shape, int)
-        if self.axis is not None:
-            shape = list(inp.shape)
-            shape[self.axis] = 1
-            i_out = np.arange(out.size).reshape(shape)
-            ind_out += i_out
-        lines = 'double {0}[{1}];\n'.format(output_var_name, out.size)
-        for i in range(out.size):
-            lines += '{0}[{1}] = 0.0;\n'.format(output_var_name, i)
-        for i_inp, i_out in enumerate(np.ravel(ind_out)):
-            lines += '{0}[{1}] += {2}[{3}];\n'.format(
-                    output_var_name, i_out, input_var_names[0], i_inp)
-        return lines
+        ind_out = sum_indices(inp.shape, self.axis)
+        lines = ['{0}[{1}] = 0.0;\n'.format(output_var_name, i)
+                 for i in range(out.size)]
+        lines += ['{0}[{1}] += {2};\n'.format(output_var_name, i_out, ref)
+                  for i_out, ref in zip(ind_out, input_refs[0])]
+        return ''.join(lines)
 
@@ -2,26 +2,39 @@ import copy
 
 import numpy as np
 
-from .op_base import OpBase
+from .op_base import OpBase, getitem_shape, _shape, memoize, index_table
 
 __all__ = ['getitem', 'setitem']
 
+@memoize
+def getitem_indices(shape, ind):
+    '''
+    The element map of indexing an array of shape with ind
+    '''
+    ind = np.ravel(index_table(shape)[ind])
+    return np.zeros(ind.size, int), ind
+
 class getitem(OpBase):
+    __slots__ = ('ind',)
+    key_attrs = ('ind',)
+    linear = True
+
     def __init__(self, a, ind):
         self.ind = copy.copy(ind)
         OpBase.__init__(self, lambda x: x[ind], (a,),
                         name='getitem[{0}]'.format(ind))
 
-    def c_code(self, input_var_names, output_var_name):
-        a, a_i = self.inputs[0], self.output
-        lines = 'double {0}[{1}];\n'.format(output_var_name, a_i.size)
-        ind = np.ravel(np.arange(a.size).reshape(a.shape)[self.ind])
-        for i_out, i_in in enumerate(ind):
-            lines += '{0}[{1}] = {2}[{3}];\n'.format(
-                    output_var_name, i_out, input_var_names[0], i_in)
-        return lines
+    def infer_shape(self, input_shape):
+        return getitem_shape(input_shape, self.ind)
+
+    def element_map(self):
+        return getitem_indices(self.inputs[0].shape, self.ind)
 
 class setitem(OpBase):
+    __slots__ = ('ind',)
+    key_attrs = ('ind',)
+    linear = True
+
     def __init__(self, a, ind, b):
         self.ind = copy.copy(ind)
         def op(x, a):
@@ -31,20 +44,11 @@ class setitem(OpBase):
         OpBase.__init__(self, op, (a, b), shape=a.shape,
                         name='setitem[{0}]'.format(ind))
 
-    def c_code(self, input_var_names, output_var_name):
+    def element_map(self):
         inp, out = self.inputs[1], self.output
-        lines = 'double {0}[{1}];\n'.format(output_var_name, out.size)
-        for i in range(out.size):
-            lines += '{1}[{0}] = {2}[{0}];\n'.format(
-                    i, output_var_name, input_var_names[0])
-        ind_out = np.ravel(np.arange(out.size).reshape(out.shape)[self.ind])
-        ind_in = np.empty(out.shape, int)
-        ind_in[self.ind] = np.arange(inp.size).reshape(inp.shape)
-        ind_in = np.ravel(ind_in[self.ind])
-        assert ind_in.size == ind_out.size
-        lines += '\n'
-        for i_in, i_out in zip(ind_in, ind_out):
-            lines += '{0}[{1}] = {2}[{3}];\n'.format(
-                    output_var_name, i_out, input_var_names[1], i_in)
-        return lines
-
+        positions = np.zeros(out.shape, int)
+        positions[self.ind] = 1
+        ind = np.arange(out.size).reshape(out.shape)
+        inp_shape = _shape(inp)
+        ind[self.ind] = np.arange(int(np.prod(inp_shape))).reshape(inp_shape)
+        return np.ravel(positions), np.ravel(ind)
@@ -1,4 +1,5 @@
 import copy
+import numbers
 import string
 
 import numpy as np
@@ -16,6 +17,110 @@ def infer_context(a):
         return a.__context__
 
 
+# ============================================================================ #
+#                               shape inference                                #
+# ============================================================================ #
+
+def broadcast_shapes(*shapes):
+    '''
+    Shape of the result of broadcasting arrays of the given shapes
+    '''
+    if all([shape == shapes[0] for shape in shapes[1:]]):
+        return tuple(shapes[0])
+    ndim = max([len(shape) for shape in shapes])
+    result = [1] * ndim
+    for shape in shapes:
+        for i, n in enumerate(shape, ndim - len(shape)):
+            if result[i] == 1:
+                result[i] = n
+            elif n != 1 and n != result[i]:
+                raise ValueError('shapes {0} cannot be broadcast together'
+                                 .format(' '.join(map(str, shapes))))
+    return tuple(result)
+
+def _is_basic_index(ind):
+    if ind is None or ind is Ellipsis or isinstance(ind, slice):
+        return True
+    return (isinstance(ind, (numbers.Integral, np.integer)) and
+            not isinstance(ind, (bool, np.bool_)))
+
+def getitem_shape(shape, ind):
+    '''
+    Shape of a[ind] for an array a of the given shape
+    '''
+    if not isinstance(ind, tuple):
+        ind = (ind,)
+    if not all([_is_basic_index(i) for i in ind]):
+        # advanced indexing, index an array of zero strides
+        dummy = np.lib.stride_tricks.as_strided(
+                np.zeros(1), shape, (0,) * len(shape))
+        return dummy[ind].shape
+    num_indexed = len([i for i in ind if i is not None and i is not Ellipsis])
+    if num_indexed > len(shape):
+        raise IndexError('too many indices for array')
+    num_ellipsis = len([i for i in ind if i is Ellipsis])
+    if num_ellipsis > 1:
+        raise IndexError('an index can only have a single ellipsis')
+    elif num_ellipsis == 0:
+        ind = ind + (Ellipsis,)
+    result, dim = [], 0
+    for i in ind:
+        if i is None:
+            result.append(1)
+        elif i is Ellipsis:
+            n = len(shape) - num_indexed
+            result.extend(shape[dim:dim+n])
+            dim += n
+        elif isinstance(i, slice):
+            result.append(len(range(*i.indices(shape[dim]))))
+            dim += 1
+        else:
+            if not -shape[dim] <= i < shape[dim]:
+                raise IndexError('index {0} is out of bounds for axis {1} '
+                                 'with size {2}'.format(i, dim, shape[dim]))
+            dim += 1
+    return tuple(result)
+
+def reshape_shape(shape, new_shape):
+    '''
+    Shape of a.reshape(new_shape) for an array a of the given shape
+    '''
+    if isinstance(new_shape, (numbers.Integral, np.integer)):
+        new_shape = (new_shape,)
+    new_shape = [int(n) for n in new_shape]
+    size = int(np.prod(shape))
+    if new_shape.count(-1) == 1:
+        known = int(np.prod([n for n in new_shape if n != -1]))
+        if known == 0 or size % known:
+            raise ValueError('cannot reshape array of size {0} into shape {1}'
+                             .format(size, tuple(new_shape)))
+        new_shape[new_shape.index(-1)] = size // known
+    if int(np.prod(new_shape)) != size or min(new_shape + [0]) < 0:
+        raise ValueError('cannot reshape array of size {0} into shape {1}'
+                         .format(size, tuple(new_shape)))
+    return tuple(new_shape)
+
+def _normalize_axis(axis, ndim):
+    if not -ndim <= axis < ndim:
+        raise ValueError('axis {0} is out of bounds for array of dimension {1}'
+                         .format(axis, ndim))
+    return axis % ndim
+
+def transpose_shape(shape, axes):
+    if axes is None:
+        return tuple(reversed(shape))
+    axes = [_normalize_axis(a, len(shape)) for a in axes]
+    if sorted(axes) != list(range(len(shape))):
+        raise ValueError('axes don\'t match array')
+    return tuple(shape[a] for a in axes)
+
+def sum_shape(shape, axis):
+    if axis is None:
+        return ()
+    axis = _normalize_axis(axis, len(shape))
+    return shape[:axis] + shape[axis+1:]
+
+
 # ============================================================================ #
 #                                   Op class                                   #
 # ============================================================================ #
@@ -28,110 +133,263 @@ class OpBase(object):
     Op(operation, inputs)
         operation: a function that takes a list of inputs as arguments
         inputs: a list of stencil array
+
+    Subclasses infer the output shape from the input shapes in infer_shape,
+    and list in key_attrs the attributes that parametrize the operation.
+    Ops that compute generate C code in c_code(input_refs, output_var_name),
+    where input_refs holds the C expression of each element of each input,
+    assigning the elements of the array output_var_name declared by the
+    caller; ops that only rearrange elements implement element_map instead.
     '''
+    __slots__ = ('py_operation', 'inputs', 'name', 'access_neighbor', 'output')
+    key_attrs = ()
+
     def __init__(self, py_operation, inputs, access_neighbor=False,
-                 shape_keeper=np.ones, shape=None, name=None):
+                 shape=None, name=None):
         self.py_operation = py_operation
-        self.inputs = []
-        for inp in inputs:
-            if _is_like_sa_value(inp):
-                self.inputs.append(inp)
-            else:
-                try:
-                    inp = np.array(inp, np.float64)
-                except (IndexError, TypeError):
-                    pass
-                self.inputs.append(inp)
+        self.inputs = [inp if _is_like_sa_value(inp) else _constant(inp)
+                       for inp in inputs]
         self.name = name
-
-        def produce_shape_keepers(a):
-            if _is_like_sa_value(a):
-                return shape_keeper(a.shape)
-            else:
-                return np.array(a, np.float64)
-        shape_keeper_inputs = tuple(map(produce_shape_keepers, self.inputs))
-        if shape is None:
-            shape = py_operation(*shape_keeper_inputs).shape
-
         self.access_neighbor = access_neighbor
+        if shape is None:
+            shape = self.infer_shape(*[_shape(inp) for inp in self.inputs])
         self.output = stencil_array_value(shape, self)
 
+    def infer_shape(self, *input_shapes):
+        '''
+        Shape of the output.  Ops that do not override this method are
+        evaluated on arrays of ones of the input shapes
+        '''
+        inputs = [np.ones(shape) for shape in input_shapes]
+        return np.shape(self.py_operation(*inputs))
+
+    def element_map(self):
+        '''
+        For ops whose output elements are elements of the inputs, the input
+        position and the flat element index each output element is taken
+        from; None for ops that compute
+        '''
+        return None
+
+    def structural_key(self):
+        '''
+        Hashable description of the operation, equal for operations that
+        compute the same output from the same inputs.  Inputs that are
+        stencil array values are left as None for the caller to identify.
+        '''
+        inputs = tuple(None if _is_like_sa_value(inp) else _freeze(inp)
+                       for inp in self.inputs)
+        attrs = tuple(_freeze(getattr(self, a)) for a in self.key_attrs)
+        return (type(self), self.access_neighbor, self.output.shape,
+                attrs, inputs)
+
     def perform(self, input_objects):
         assert len(input_objects) == len(self.inputs)
         return self.py_operation(*input_objects)
 
+    # ops linear in their inputs, e.g., neighbor access and indexing,
+    # perform the same operation on the tangents of the inputs
+    linear = False
+
+    def partials(self, input_objects, output_object):
+        '''
+        The derivative of the output with respect to each input, None if
+        zero, from input_objects and output_object, the values the op is
+        performed on and gives.  They are computed once and shared by the
+        tangents of all directions; linear ops need none.
+        '''
+        assert self.linear, 'no derivative for {0}'.format(self.name)
+        return None
+
+    def tangent(self, partials, input_tangents):
+        '''
+        Forward-mode derivative of the output in the direction in which
+        the inputs vary by input_tangents, None for a zero tangent, e.g.,
+        of a constant, given the partials.  Returns None if it is zero.
+        '''
+        if all([t is None for t in input_tangents]):
+            return None
+        if partials is not None:
+            return tangent_sum(self.output.shape, *[
+                    None if p is None or t is None else p * t
+                    for p, t in zip(partials, input_tangents)])
+        ctx = _context(*input_tangents)
+        input_tangents = [ctx.zeros(_shape(inp)) if t is None else t
+                          for inp, t in zip(self.inputs, input_tangents)]
+        return self.perform(input_tangents)
+
     def __repr__(self):
         return 'Operator {0}'.format(self.name)
 
 
+def _constant(a):
+    if isinstance(a, numbers.Number):
+        return float(a)
+    try:
+        return np.array(a, np.float64)
+    except (IndexError, TypeError):
+        return a
+
+def _freeze(a):
+    '''
+    Hashable equivalent of constants and of the indices, shapes and axes
+    that parametrize operations
+    '''
+    if isinstance(a, np.ndarray):
+        return ('ndarray', a.dtype.str, a.shape, a.tobytes())
+    elif isinstance(a, (tuple, list)):
+        return (type(a).__name__,) + tuple(_freeze(x) for x in a)
+    elif isinstance(a, slice):
+        return ('slice', _freeze(a.start), _freeze(a.stop), _freeze(a.step))
+    elif isinstance(a, np.generic):
+        return _freeze(a.item())
+    elif isinstance(a, float):
+        # distinguishes -0.0 from 0.0, and makes nan equal to itself
+        return ('float', repr(a))
+    return a
+
+def _shape(a):
+    if _is_like_sa_value(a):
+        return a.shape
+    return np.shape(a)
+
+def _context(*args):
+    '''
+    The context of the first of args that has one, e.g., a stencil array
+    mixed with constants, and numpy otherwise
+    '''
+    for a in args:
+        if hasattr(a, '__context__'):
+            return a.__context__
+    return np
+
+def tangent_sum(shape, *terms):
+    '''
+    The sum of the terms of a tangent that are not None, broadcast to
+    shape; None if all terms are None
+    '''
+    terms = [t for t in terms if t is not None]
+    if not terms:
+        return None
+    total = terms[0]
+    for t in terms[1:]:
+        total = total + t
+    total_shape = total.shape if hasattr(total, 'shape') else ()
+    if tuple(total_shape) != tuple(shape):
+        total = total + _context(total).zeros(shape)
+    return total
+
+
+class ElementwiseOp(OpBase):
+    '''
+    Op whose output is broadcast from its inputs
+    '''
+    __slots__ = ()
+
+    def infer_shape(self, *input_shapes):
+        return broadcast_shapes(*input_shapes)
+
+
+def memoize(func):
+    '''
+    Cache the results of func, a function of shapes, indices and axes,
+    keyed by its arguments, frozen if they are not hashable.  The results
+    are shared between calls, numpy arrays among them are made read-only.
+    '''
+    cache = {}
+    def memoized(*args):
+        try:
+            key = args
+            hash(key)
+        except TypeError:
+            key = _freeze(args)
+        if key not in cache:
+            result = func(*args)
+            for a in (result if isinstance(result, tuple) else (result,)):
+                if isinstance(a, np.ndarray):
+                    a.setflags(write=False)
+            cache[key] = result
+        return cache[key]
+    memoized.__doc__ = func.__doc__
+    memoized.__name__ = func.__name__
+    return memoized
+
+@memoize
+def index_table(shape):
+    '''
+    The flat index of each element of an array of shape
+    '''
+    return np.arange(int(np.prod(shape))).reshape(shape)
+
+@memoize
+def broadcast_indices(*shapes):
+    '''
+    For arrays of each of the shapes, the flat indices of their elements
+    combined into each element of their broadcast
+    '''
+    shape = broadcast_shapes(*shapes)
+    return tuple(tuple(np.ravel(np.broadcast_to(index_table(s), shape))
+                       .tolist()) for s in shapes)
+
 def binary_op_indices(a, b, c):
-    ind_a = np.ravel(np.arange(a.size).reshape(a.shape) +
-                     np.zeros(b.shape, int))
-    ind_b = np.ravel(np.zeros(a.shape, int) +
-                     np.arange(b.size).reshape(b.shape))
-    ind_c = np.arange(c.size)
-    assert ind_a.shape == ind_b.shape and ind_a.shape == ind_c.shape
-    return ind_a, ind_b, ind_c
+    ind_a, ind_b = broadcast_indices(_shape(a), _shape(b))
+    assert len(ind_a) == c.size
+    return ind_a, ind_b, range(c.size)
 
 
-class BinaryOp(OpBase):
+class BinaryOp(ElementwiseOp):
+    __slots__ = ('c_operator_str',)
+
     def __init__(self, py_operator, inputs, name, c_operator_str):
         assert len(inputs) == 2
         assert isinstance(c_operator_str, str)
         OpBase.__init__(self, py_operator, inputs, name=name)
         self.c_operator_str = c_operator_str
 
-    def c_code(self, input_var_names, output_var_name):
-        a_name, b_name = input_var_names
+    def c_code(self, input_refs, output_var_name):
+        a_refs, b_refs = input_refs
         c_name = output_var_name
         ind_a, ind_b, ind_c = binary_op_indices(
                 self.inputs[0], self.inputs[1], self.output)
-        lines = 'double {0}[{1}];\n'.format(c_name, self.output.size)
-        for ia, ib, ic in zip(ind_a, ind_b, ind_c):
-            lines += '{0}[{1}] = {2}[{3}] {6} {4}[{5}];\n'.format(
-                    c_name, ic,
-                    a_name, ia,
-                    b_name, ib,
-                    self.c_operator_str)
-        return lines
+        line = '{0}[{{0}}] = {{1}} {1} {{2}};\n'.format(
+                c_name, self.c_operator_str)
+        return ''.join([line.format(ic, a_refs[ia], b_refs[ib])
+                        for ia, ib, ic in zip(ind_a, ind_b, ind_c)])
+
 
+class BinaryFunction(ElementwiseOp):
+    __slots__ = ('c_function_str',)
 
-class BinaryFunction(OpBase):
     def __init__(self, py_operator, inputs, name, c_function_str):
         assert len(inputs) == 2
         assert isinstance(c_function_str, str)
         OpBase.__init__(self, py_operator, inputs, name=name)
         self.c_function_str = c_function_str
 
-    def c_code(self, input_var_names, output_var_name):
-        a_name, b_name = input_var_names
+    def c_code(self, input_refs, output_var_name):
+        a_refs, b_refs = input_refs
         c_name = output_var_name
         ind_a, ind_b, ind_c = binary_op_indices(
                 self.inputs[0], self.inputs[1], self.output)
-        lines = 'double {0}[{1}];\n'.format(c_name, self.output.size)
-        for ia, ib, ic in zip(ind_a, ind_b, ind_c):
-            lines += '{0}[{1}] = {6}({2}[{3}], {4}[{5}]);\n'.format(
-                    c_name, ic,
-                    a_name, ia,
-                    b_name, ib,
-                    self.c_function_str)
-        return lines
+        line = '{0}[{{0}}] = {1}({{1}}, {{2}});\n'.format(
+                c_name, self.c_function_str)
+        return ''.join([line.format(ic, a_refs[ia], b_refs[ib])
+                        for ia, ib, ic in zip(ind_a, ind_b, ind_c)])
+
 
+class UnitaryFunction(ElementwiseOp):
+    __slots__ = ('c_function_str',)
 
-class UnitaryFunction(OpBase):
     def __init__(self, py_operator, inputs, name, c_function_str):
         assert len(inputs) == 1
         assert isinstance(c_function_str, str)
         OpBase.__init__(self, py_operator, inputs, name=name)
         self.c_function_str = c_function_str
 
-    def c_code(self, input_var_names, output_var_name):
-        a_name, = input_var_names
+    def c_code(self, input_refs, output_var_name):
+        a_refs, = input_refs
         b_name = output_var_name
-        lines = 'double {0}[{1}];\n'.format(b_name, self.output.size)
-        for i in np.arange(self.output.size):
-            lines += '{0}[{1}] = {4}({2}[{3}]);\n'.format(
-                    b_name, i,
-                    a_name, i,
-                    self.c_function_str)
-        return lines
+        line = '{0}[{{0}}] = {1}({{1}});\n'.format(
+                b_name, self.c_function_str)
+        return ''.join([line.format(i, a_refs[i])
+                        for i in range(self.output.size)])
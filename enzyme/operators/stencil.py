@@ -1,28 +1,20 @@
-import numpy as np
-from .op_base import OpBase
+import re
 
-__all__ = ['im', 'ip', 'jm', 'jp', 'km', 'kp']
+import numpy as np
+from .op_base import OpBase, infer_context
 
-class ShapeKeeper(object):
-    def __init__(self, shape):
-        self.shape = shape
-        self.ip = self
-        self.im = self
-        self.jp = self
-        self.jm = self
-        self.kp = self
-        self.km = self
+__all__ = ['im', 'ip', 'jm', 'jp', 'km', 'kp', 'shift']
 
 def stencil_op(op_name, shift, axis):
     def op(a):
         return getattr(a, op_name)
     def __init__(self, a):
-        OpBase.__init__(self, op, (a,), access_neighbor=True,
-                        shape_keeper=ShapeKeeper, name=op_name)
-    def c_code(self, input_var_names, output_var_name):
-        return 'const double * {0} = {1}_{2};\n'.format(
-                output_var_name, input_var_names[0], op_name)
-    return type(op_name, (OpBase,), {'__init__': __init__, 'c_code': c_code})
+        OpBase.__init__(self, op, (a,), access_neighbor=True, name=op_name)
+    def infer_shape(self, input_shape):
+        return input_shape
+    return type(op_name, (OpBase,), {'__slots__': (), '__init__': __init__,
+                                     'infer_shape': infer_shape,
+                                     'linear': True})
 
 im = stencil_op('im', +1, 0)
 ip = stencil_op('ip', -1, 0)
@@ -30,3 +22,55 @@ jm = stencil_op('jm', +1, 1)
 jp = stencil_op('jp', -1, 1)
 km = stencil_op('km', +1, 2)
 kp = stencil_op('kp', -1, 2)
+
+# ============================================================================ #
+#                               general offsets                                #
+# ============================================================================ #
+
+# The name of a neighbor access encodes its offset (di, dj, dk): for each
+# axis with a nonzero offset, the axis, p or m for its sign, and its
+# magnitude if larger than one, e.g., 'ip' for (1, 0, 0) and 'im2jp' for
+# (-2, 1, 0).  The name is also the suffix of the C variables holding
+# values at the neighbor.
+
+_ACCESS_NAME = re.compile('([ijk])([pm])([0-9]*)')
+
+def access_name(offset):
+    '''
+    The name of the neighbor access at offset, see access_offset
+    '''
+    name = ''
+    for axis, d in zip('ijk', offset):
+        if d:
+            name += axis + ('p' if d > 0 else 'm') + (
+                    str(abs(d)) if abs(d) > 1 else '')
+    return name
+
+def access_offset(name):
+    '''
+    The offset (di, dj, dk) of the neighbor access name, e.g., (0, -1, 0)
+    for 'jm'; (0, 0, 0) for the empty name of the grid point itself
+    '''
+    offset = [0, 0, 0]
+    for axis, sign, n in _ACCESS_NAME.findall(name):
+        offset['ijk'.index(axis)] = (1 if sign == 'p' else -1) * int(n or 1)
+    return tuple(offset)
+
+class shift(OpBase):
+    '''
+    The value at the grid point offset by (di, dj, dk), which generalizes
+    the nearest neighbor accesses, e.g., ip is the offset (1, 0, 0)
+    '''
+    __slots__ = ('offset',)
+    key_attrs = ('offset',)
+    linear = True
+
+    def __init__(self, a, offset):
+        self.offset = tuple([int(d) for d in offset])
+        assert len(self.offset) == 3 and any(self.offset)
+        op = lambda a: infer_context(a).shift(a, *self.offset)
+        OpBase.__init__(self, op, (a,), access_neighbor=True,
+                        name=access_name(self.offset))
+
+    def infer_shape(self, input_shape):
+        return input_shape
@@ -0,0 +1,88 @@
+import numpy as np
+
+from .analysis import stage_flops, stage_bytes
+
+# ============================================================================ #
+#                              profile report                                  #
+# ============================================================================ #
+
+class ProfileReport(object):
+    '''
+    Timings of a profiled execution
+
+    phases: seconds spent in each phase outside the stages, i.e.,
+            compile, read, layout_in, precompute, layout_out and write,
+            snapshot and snapshot_wait for a program writing snapshots,
+            and mask for a program with an activity mask
+    stages: one dictionary per stage invocation, in the order of invocation
+    '''
+    def __init__(self, phases, stages):
+        self.phases = phases
+        self.stages = stages
+
+    @property
+    def total_seconds(self):
+        return (sum(self.phases.values()) +
+                sum([s['seconds'] for s in self.stages]))
+
+    def to_dict(self):
+        return {'phases': dict(self.phases),
+                'stages': [dict(s) for s in self.stages],
+                'total_seconds': self.total_seconds}
+
+    def __repr__(self):
+        lines = ['Profile report: {0:.6f} seconds'.format(self.total_seconds)]
+        for phase in ['compile', 'read', 'layout_in', 'precompute',
+                      'mask', 'snapshot', 'snapshot_wait', 'layout_out',
+                      'write']:
+            if phase in self.phases:
+                lines.append('  {0:<11s} {1:.6f} s'.format(
+                             phase, self.phases[phase]))
+        for i, s in enumerate(self.stages):
+            lines.append(('  stage_{0:<5d} {1:.6f} s (sync {2:.6f} s), ' +
+                          '{3:.3e} cells/s, {4:.3e} flops/s, ' +
+                          '{5:.3e} bytes/s').format(
+                              s['stage'], s['seconds'], s['sync_seconds'],
+                              s['cells_per_second'], s['flops_per_second'],
+                              s['bytes_per_second']))
+        return '\n'.join(lines)
+
+
+def _per_second(amount, seconds):
+    return amount / seconds if seconds > 0 else float('inf')
+
+def read_profile(profile_file, stages, stage_indices, num_cells,
+                 compile_seconds):
+    '''
+    Parse the timer records written by a program compiled with
+    ENZYME_PROFILE into a ProfileReport
+    '''
+    phases = {'compile': compile_seconds}
+    sync_seconds, sweep_seconds = [], []
+    with open(profile_file) as f:
+        for line in f:
+            phase, seconds = line.split()
+            if phase == 'sync':
+                sync_seconds.append(float(seconds))
+            elif phase == 'sweep':
+                sweep_seconds.append(float(seconds))
+            else:
+                phases[phase] = phases.get(phase, 0.) + float(seconds)
+    assert len(sync_seconds) == len(sweep_seconds) == len(stage_indices)
+    stage_reports = []
+    for i, t_sync, t_sweep in zip(stage_indices, sync_seconds, sweep_seconds):
+        seconds = t_sync + t_sweep
+        flops = stage_flops(stages[i]) * num_cells
+        bytes_moved = stage_bytes(stages[i]) * num_cells
+        stage_reports.append({
+            'stage': i,
+            'sync_seconds': t_sync,
+            'sweep_seconds': t_sweep,
+            'seconds': seconds,
+            'cells_per_second': _per_second(num_cells, seconds),
+            'flops': flops,
+            'flops_per_second': _per_second(flops, seconds),
+            'bytes': bytes_moved,
+            'bytes_per_second': _per_second(bytes_moved, seconds),
+        })
+    return ProfileReport(phases, stage_reports)
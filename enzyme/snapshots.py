@@ -0,0 +1,56 @@
+import os
+import re
+
+import numpy as np
+
+# ============================================================================ #
+#                                  snapshots                                   #
+# ============================================================================ #
+
+SNAPSHOT_FILE = re.compile(r'^snapshot_(\d+)\.npy$')
+
+def snapshot_path(snapshot_dir, step):
+    return os.path.join(snapshot_dir, 'snapshot_{0:08d}.npy'.format(step))
+
+class Snapshots(object):
+    '''
+    The snapshots in a directory written by execute, indexed by the step
+    after which each was taken.  A snapshot is mapped from its file when
+    accessed; its data is read from disk only when used.
+    '''
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+        self.steps = sorted([int(m.group(1)) for m in
+                             map(SNAPSHOT_FILE.match, os.listdir(snapshot_dir))
+                             if m])
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def __contains__(self, step):
+        return step in self.steps
+
+    def __getitem__(self, step):
+        if step not in self.steps:
+            raise KeyError(step)
+        return np.load(snapshot_path(self.snapshot_dir, step), mmap_mode='r')
+
+    def items(self):
+        return [(step, self[step]) for step in self.steps]
+
+    def __repr__(self):
+        return 'Snapshots({0!r}, steps {1})'.format(self.snapshot_dir,
+                                                    self.steps)
+
+
+def load_snapshots(snapshot_dir):
+    '''
+    The snapshots in snapshot_dir, see Snapshots, written by
+    execute(..., snapshot_every=n, snapshot_dir=snapshot_dir): the state
+    after every n steps, written by a background thread while the next
+    steps run.  Snapshots are not supported out of core.
+    '''
+    return Snapshots(snapshot_dir)
@@ -18,7 +18,9 @@ def _is_like_sa_value(a):
     '''
     Check attributes of stencil array value
     '''
-    if hasattr(a, 'owner'):
+    if isinstance(a, stencil_array_value):
+        return True
+    elif hasattr(a, 'owner'):
         return a.owner is None or hasattr(a.owner, 'access_neighbor')
     else:
         return False
@@ -28,9 +30,15 @@ def _is_like_sa_value(a):
 # ============================================================================ #
 
 class stencil_array_value(object):
+    __slots__ = ('shape', 'size', 'owner')
+
     def __init__(self, shape=(), owner=None):
         self.shape = tuple(shape)
         self.owner = owner
+        size = 1
+        for n in self.shape:
+            size *= n
+        self.size = int(size)
 
     def __repr__(self):
         if self.owner:
@@ -45,14 +53,44 @@ class stencil_array_value(object):
     def ndim(self):
         return len(self.shape)
 
-    @property
-    def size(self):
-        return int(np.prod(self.shape))
-
     def __len__(self):
         return 1 if not self.shape else self.shape[0]
 
 
+class parameter_value(stencil_array_value):
+    '''
+    Independent value set at run time, the same at every grid point.
+    Parameters with the same name hold the same value.
+    '''
+    __slots__ = ('name',)
+
+    def __init__(self, name, shape=()):
+        stencil_array_value.__init__(self, shape)
+        self.name = name
+
+    def __repr__(self):
+        return 'Parameter {0} of shape {1}'.format(self.name, self.shape)
+
+
+class reduction(object):
+    '''
+    Sum, maximum or minimum over the grid of each element of a value,
+    computed by a stage that computes the value
+    '''
+    KINDS = ('sum', 'max', 'min')
+    __slots__ = ('name', 'kind', 'value')
+
+    def __init__(self, name, kind, value):
+        assert kind in self.KINDS
+        self.name = name
+        self.kind = kind
+        self.value = value
+
+    def __repr__(self):
+        return 'Reduction {0}: global {1} of {2}'.format(
+                self.name, self.kind, self.value)
+
+
 class builtin:
     ZERO = stencil_array_value()
     I = stencil_array_value()
@@ -67,15 +105,16 @@ class builtin:
 def discover_values(source_values, sink_values):
     discovered_values = []
     discovered_triburary_values = []
+    visited = set(source_values)
     def discover_values_from(v):
         if not hasattr(v, 'owner'):
             return
-        if v in source_values:
+        if v in visited:
             return
+        visited.add(v)
         if v.owner is None:
-            if v not in discovered_triburary_values:
-                discovered_triburary_values.append(v)
-        elif v not in discovered_values:
+            discovered_triburary_values.append(v)
+        else:
             discovered_values.append(v)
             for v_inp in v.owner.inputs:
                 discover_values_from(v_inp)
@@ -84,34 +123,44 @@ def discover_values(source_values, sink_values):
     return discovered_values, discovered_triburary_values
 
 def sort_values(sorted_values, unsorted_values):
+    computed = set(sorted_values)
     def is_computable(v):
         return (not _is_like_sa_value(v) or
-                v in sorted_values or
+                v in computed or
                 v.owner is None)
     while len(unsorted_values):
         removed_any = False
-        for v in unsorted_values:
+        for v in list(unsorted_values):
             if all([is_computable(v_inp) for v_inp in v.owner.inputs]):
                 unsorted_values.remove(v)
                 sorted_values.append(v)
+                computed.add(v)
                 removed_any = True
         assert removed_any
 
 class AtomicStage(object):
     '''
-    Immutable compact stage
+    Immutable compact stage.  Besides its sink values, the stage computes
+    the reductions, see reduction.
     '''
-    def __init__(self, source_values, sink_values):
+    def __init__(self, source_values, sink_values, reductions=()):
         sorted_values = copymodule.copy(source_values)
         unsorted_values, self.triburary_values = discover_values(
-                source_values, sink_values)
+                source_values, list(sink_values) +
+                               [r.value for r in reductions])
         sort_values(sorted_values, unsorted_values)
         assert unsorted_values == []
         self.source_values = sorted_values[:len(source_values)]
         self.sorted_values = sorted_values[len(source_values):]
         self.sink_values = copymodule.copy(sink_values)
+        self.reductions = list(reductions)
+        self._structural_key = None
 
-    def __call__(self, source_values, triburary):
+    def __call__(self, source_values, triburary, with_reductions=False):
+        '''
+        The sink values computed from source_values, and if with_reductions,
+        also the values reduced
+        '''
         if not isinstance(source_values, (tuple, list)):
             source_values = [source_values]
         source_values = list(source_values)
@@ -122,49 +171,117 @@ class AtomicStage(object):
             triburary_values = [triburary[v] for v in self.triburary_values]
         values = self.source_values + self.triburary_values
         tmp_values = source_values + triburary_values
-        # _tmp attributes are assigned to inputs
         assert len(values) == len(tmp_values)
-        for v, v_tmp in zip(values, tmp_values):
-            assert not hasattr(v, '_tmp')
-            v._tmp = v_tmp
-        # _tmp attributes are computed to each value
-        _tmp = lambda v : v._tmp if _is_like_sa_value(v) else v
+        # the result of each value is kept in a table local to this call
+        tmp = dict(zip(values, tmp_values))
+        _tmp = lambda v : tmp[v] if _is_like_sa_value(v) else v
         for v in self.sorted_values:
-            assert not hasattr(v, '_tmp')
             inputs_tmp = [_tmp(v_inp) for v_inp in v.owner.inputs]
-            v._tmp = v.owner.perform(inputs_tmp)
-        # _tmp attributes are extracted from outputs then deleted from all
-        sink_values = tuple(v._tmp for v in self.sink_values)
-        values += self.sorted_values
-        for v in values:
-            del v._tmp
-        return sink_values
+            tmp[v] = v.owner.perform(inputs_tmp)
+        sinks = tuple(tmp[v] for v in self.sink_values)
+        if with_reductions:
+            return sinks, tuple(tmp[r.value] for r in self.reductions)
+        return sinks
+
+    # ------------------------ structural identity ------------------------ #
+
+    @property
+    def structural_key(self):
+        '''
+        Hashable description of the computation of the stage, independent
+        of the identity of its values.  Stages traced separately from the
+        same function have the same key.
+        '''
+        if self._structural_key is None:
+            refs = {}
+            for i, v in enumerate(self.source_values):
+                refs[v] = ('source', i, v.shape)
+            for v in self.triburary_values:
+                refs[v] = _triburary_key(v)
+            ops = []
+            for i, v in enumerate(self.sorted_values):
+                refs[v] = ('value', i)
+                op_type, access_neighbor, shape, attrs, inputs = \
+                        v.owner.structural_key()
+                inputs = tuple(refs[v_inp] if _is_like_sa_value(v_inp)
+                               else key
+                               for v_inp, key in zip(v.owner.inputs, inputs))
+                ops.append((op_type, access_neighbor, shape, attrs, inputs))
+            sinks = tuple(refs[v] for v in self.sink_values)
+            reductions = tuple((r.name, r.kind, refs[r.value])
+                               for r in self.reductions)
+            self._structural_key = (tuple(ops), sinks, reductions)
+        return self._structural_key
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, AtomicStage):
+            return NotImplemented
+        return self.structural_key == other.structural_key
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
 
     def __hash__(self):
-        return id(self)
+        return hash(self.structural_key)
+
+def _triburary_key(v):
+    for name in ['ZERO', 'I', 'J', 'K']:
+        if v is getattr(builtin, name):
+            return ('builtin', name)
+    if isinstance(v, parameter_value):
+        return ('parameter', v.name, v.shape)
+    return ('triburary', id(v))
 
 # ============================================================================ #
 #                                decomposition                                 #
 # ============================================================================ #
 
 def build_graph(all_values):
-    weights = []
-    for i, v in enumerate(all_values):
-        v._value_id = i
-        weights.append(v.size)
+    value_ids = dict((v, i) for i, v in enumerate(all_values))
+    weights = [v.size for v in all_values]
     weights.append(1)
     edges = []
     for i, v in enumerate(all_values):
         if not v.owner: continue
         for v_inp in v.owner.inputs:
-            if hasattr(v_inp, '_value_id'):
-                e = (v_inp._value_id, v._value_id, v.owner.access_neighbor)
+            if _is_like_sa_value(v_inp) and v_inp in value_ids:
+                e = (value_ids[v_inp], i, v.owner.access_neighbor)
                 edges.append(e)
-    for v in all_values:
-        del v._value_id
     return np.array(weights, int), np.array(edges, int)
 
-def decompose_graph(weights, edges, comp_graph_output_file=None):
+# resolution of the recompute costs relative to a double carried between stages
+RECOMPUTE_COST_SCALE = 100
+
+def recompute_costs(all_values, op_cost=None):
+    '''
+    The cost of computing each value at the six neighbors of a grid point
+    instead of storing it, in units of one double carried between stages,
+    given op_cost(op), the cost of computing op once in the same units,
+    see analysis.recompute_op_cost; all zero if op_cost is None
+    '''
+    costs = []
+    for v in all_values:
+        cost = op_cost(v.owner) if op_cost and v.owner else 0
+        costs.append(6 * cost)
+    return np.array(costs)
+
+def decompose_graph(weights, edges, comp_graph_output_file=None,
+                    recompute_costs=None):
+    '''
+    Solve for the stage in which each value is computed (c) and discarded
+    (d) with quarkflow.  Without recompute_costs, the doubles carried
+    between stages are minimized; with them, the sum of the doubles carried
+    and of the cost of the values recomputed at neighbors is minimized.
+    '''
+    if recompute_costs is not None and np.any(recompute_costs):
+        scale = RECOMPUTE_COST_SCALE
+        weights = np.array(weights) * scale
+        recompute_costs = np.round(np.array(recompute_costs) * scale)
+    else:
+        recompute_costs = None
     my_path = os.path.dirname(os.path.abspath(__file__))
     bin_path = os.path.abspath(os.path.join(my_path, '..', 'bin'))
     quarkflow_bin = os.path.join(bin_path, 'quarkflow')
@@ -172,27 +289,231 @@ def decompose_graph(weights, edges, comp_graph_output_file=None):
     first_line = '{0} {1}'.format(len(weights) - 1, len(edges))
     weights = ['{0}'.format(w) for w in weights]
     edges = ['{0} {1} {2}'.format(i, j, s) for i, j, s in edges]
-    inp = '\n'.join([first_line] + weights + edges)
+    costs = []
+    if recompute_costs is not None:
+        costs = ['{0}'.format(int(r)) for r in recompute_costs]
+    inp = '\n'.join([first_line] + weights + edges + costs)
     if comp_graph_output_file:
         open(comp_graph_output_file, 'w').write(inp)
     out, err = p.communicate(inp.encode())
     assert len(err.strip()) == 0
-    return np.loadtxt(BytesIO(out), int).T
+    return np.loadtxt(BytesIO(out), int, ndmin=2).T
 
-def decompose(source_values, sink_values, comp_graph_output_file=None):
+def decompose(source_values, sink_values, comp_graph_output_file=None,
+              op_cost=None, coarsen=True, reductions=()):
+    '''
+    Each reduction is computed by a stage that can compute its value.
+    If no stage can, the value is made a sink of the decomposition, and
+    the last stage computes the reduction instead of the sink.
+    '''
+    args = (comp_graph_output_file, op_cost, coarsen)
+    stages = decompose_values(source_values, sink_values, *args)
+    unplaced = [r for r in reductions
+                if not reduction_stages(stages, source_values, r)]
+    if unplaced:
+        stages = decompose_values(source_values, tuple(sink_values) +
+                                  tuple(r.value for r in unplaced), *args)
+        stages[-1] = AtomicStage(stages[-1].source_values, list(sink_values))
+    return place_reductions(stages, source_values, reductions)
+
+def decompose_values(source_values, sink_values, comp_graph_output_file=None,
+                     op_cost=None, coarsen=True):
+    all_values, weights, edges = build_decomposition_graph(
+            source_values, sink_values)
+    costs = recompute_costs(all_values, op_cost)
+    if coarsen:
+        coarse = coarsen_decomposition_graph(all_values, sink_values,
+                                             weights, edges, costs)
+        cde = decompose_graph(coarse.weights, coarse.edges,
+                              comp_graph_output_file, coarse.costs)
+        c, d, e = coarse.project(*cde)
+    else:
+        c, d, e = decompose_graph(weights, edges, comp_graph_output_file,
+                                  costs)
+    return build_stages(all_values, source_values, sink_values, c, d)
+
+# ============================================================================ #
+#                                  reductions                                  #
+# ============================================================================ #
+
+def computable_in_stage(value, stage_sources, graph_sources):
+    '''
+    Whether a stage with stage_sources can compute value of a graph with
+    graph_sources: value depends on no other graph source, and no path to
+    it has more than one neighbor access
+    '''
+    depth = dict((v, 0) for v in stage_sources)
+    stack = [value]
+    while stack:
+        v = stack[-1]
+        if v in depth:
+            stack.pop()
+        elif v.owner is None:
+            if v in graph_sources:
+                return False
+            depth[v] = 0
+            stack.pop()
+        else:
+            inputs = [v_inp for v_inp in v.owner.inputs
+                      if _is_like_sa_value(v_inp)]
+            pending = [v_inp for v_inp in inputs if v_inp not in depth]
+            if pending:
+                stack.extend(pending)
+                continue
+            depth[v] = (max([depth[v_inp] for v_inp in inputs] + [0]) +
+                        int(v.owner.access_neighbor))
+            if depth[v] > 1:
+                return False
+            stack.pop()
+    return True
+
+def reduction_stages(stages, graph_sources, r):
+    '''
+    Indices of the stages that can compute the reduction r, those that
+    compute its value anyway first
+    '''
+    graph_sources = set(graph_sources)
+    candidates = [k for k, s in enumerate(stages)
+                  if computable_in_stage(r.value, s.source_values,
+                                         graph_sources)]
+    computed = [k for k in candidates
+                if r.value in set(stages[k].source_values +
+                                  stages[k].sorted_values)]
+    return computed + [k for k in candidates if k not in computed]
+
+def place_reductions(stages, graph_sources, reductions):
+    placed = [[] for s in stages]
+    for r in reductions:
+        placed[reduction_stages(stages, graph_sources, r)[0]].append(r)
+    return [AtomicStage(s.source_values, s.sink_values, s.reductions + p)
+            if p else s for s, p in zip(stages, placed)]
+
+# ============================================================================ #
+#                               graph coarsening                               #
+# ============================================================================ #
+
+class CoarseGraph(object):
+    '''
+    Decomposition graph with chains of pointwise ops collapsed.
+    group maps each vertex of the fine graph to its vertex in the coarse
+    graph, and is_tail whether it is the last vertex of its chain.
+    '''
+    def __init__(self, weights, edges, costs, group, is_tail):
+        self.weights = weights
+        self.edges = edges
+        self.costs = costs
+        self.group = group
+        self.is_tail = is_tail
+
+    def project(self, c, d, e):
+        '''
+        Assignments of the fine graph from those of the coarse graph;
+        vertices before the tail of a chain are discarded where computed
+        '''
+        c, e = c[self.group], e[self.group]
+        d = np.where(self.is_tail, d[self.group], c)
+        return c, d, e
+
+def coarsen_decomposition_graph(all_values, sink_values, weights, edges,
+                                costs=None):
+    value_ids = dict((v, i) for i, v in enumerate(all_values))
+    sink_ids = [value_ids[v] for v in sink_values if v in value_ids]
+    return coarsen_graph(weights, edges, costs, sink_ids)
+
+def carried_doubles(weights, c, d):
+    '''
+    The objective of the decomposition, the sum over stage boundaries of
+    the doubles carried across
+    '''
+    return int((np.asarray(weights)[:-1] * (d - c)).sum())
+
+def coarsen_graph(weights, edges, costs=None, protected=()):
+    '''
+    Collapse each edge i -> j without neighbor access where j is the only
+    consumer of i, i is the only input of j, and j is not larger than i.
+    Computing j in the same stage as i is then never worse than carrying
+    i to a later stage, so the coarse graph has the same optimum.
+    Vertices in protected, e.g., the sinks, are kept as tails of chains.
+    '''
+    num_vertices = len(weights) - 1
+    edges = np.array(edges, int).reshape([-1, 3])
+    protected = set(protected)
+    out_degree = np.bincount(edges[:,0], minlength=num_vertices)
+    in_degree = np.bincount(edges[:,1], minlength=num_vertices)
+    is_tail = np.ones(num_vertices, bool)
+    successor = -np.ones(num_vertices, int)
+    has_predecessor = np.zeros(num_vertices, bool)
+    for i, j, is_swept in edges:
+        if (not is_swept and out_degree[i] == 1 and in_degree[j] == 1 and
+                weights[j] <= weights[i] and i not in protected):
+            successor[i] = j
+            has_predecessor[j] = True
+            is_tail[i] = False
+    group = -np.ones(num_vertices, int)
+    tails = []
+    for head in np.nonzero(~has_predecessor)[0]:
+        i = head
+        while successor[i] >= 0:
+            group[i] = len(tails)
+            i = successor[i]
+        group[i] = len(tails)
+        tails.append(i)
+    assert (group >= 0).all()
+    tails = np.array(tails, int)
+    coarse_weights = np.hstack([weights[tails], weights[-1:]])
+    merged = successor[edges[:,0]] == edges[:,1]
+    coarse_edges = edges[~merged].copy()
+    coarse_edges[:,:2] = group[coarse_edges[:,:2]]
+    coarse_costs = None
+    if costs is not None:
+        coarse_costs = np.bincount(group, costs, len(tails))
+    return CoarseGraph(coarse_weights, coarse_edges, coarse_costs,
+                       group, is_tail)
+
+def source_dependent_values(source_values, values):
+    '''
+    The values, in the order given, computed from any of the source values
+    '''
+    dependent = dict((v, True) for v in source_values)
+    for v_root in values:
+        stack = [v_root]
+        while stack:
+            v = stack[-1]
+            if v in dependent:
+                stack.pop()
+            elif v.owner is None:
+                dependent[v] = False
+                stack.pop()
+            else:
+                inputs = [v_inp for v_inp in v.owner.inputs
+                          if _is_like_sa_value(v_inp)]
+                pending = [v_inp for v_inp in inputs if v_inp not in dependent]
+                if pending:
+                    stack.extend(pending)
+                else:
+                    dependent[v] = any([dependent[v_inp] for v_inp in inputs])
+                    stack.pop()
+    return [v for v in values if dependent[v]]
+
+def build_decomposition_graph(source_values, sink_values):
+    '''
+    Values that do not depend on the source values are left out of the
+    graph; each stage computes the ones it uses, or reads them from the
+    precomputed workspace, instead of receiving them from previous stages
+    '''
     values, _ = discover_values(source_values, sink_values)
+    values = source_dependent_values(source_values, values)
     all_values = list(values) + list(source_values)
     weights, edges = build_graph(all_values)
-    c, d, e = decompose_graph(weights, edges, comp_graph_output_file)
+    return all_values, weights, edges
+
+def build_stages(all_values, source_values, sink_values, c, d):
     num_stages = d.max()
-    for i, v in enumerate(all_values):
-        v.create_stage = c[i]
-        v.discard_stage = d[i]
     stages = []
     stage_source = list(source_values)
     for k in range(1, num_stages):
-        next_stage_source = [v for v in all_values
-                               if v.create_stage <= k and v.discard_stage > k]
+        next_stage_source = [v for i, v in enumerate(all_values)
+                               if c[i] <= k and d[i] > k]
         stages.append(AtomicStage(stage_source, next_stage_source))
         stage_source = next_stage_source
     stages.append(AtomicStage(stage_source, list(sink_values)))
@@ -11,12 +11,18 @@ import numpy as np
 from . import operators
 from . import symbolic_value
 from .symbolic_value import _is_like_sa_value, stencil_array_value
+from .symbolic_value import parameter_value
 from .symbolic_value import builtin as builtin_values
-from .symbolic_value import AtomicStage
+from .symbolic_value import AtomicStage, reduction
+from .analysis import recompute_op_cost
 
 __all__ = ['stencil_array', 'decompose', 'im', 'ip', 'km', 'kp', 'jm', 'jp',
+           'shift',
            'transpose', 'reshape', 'roll', 'copy', 'sin', 'cos', 'exp',
-           'sum', 'mean', 'builtin', 'ones', 'zeros']
+           'sqrt', 'abs', 'log', 'tanh', 'minimum', 'maximum', 'less',
+           'less_equal', 'greater', 'greater_equal', 'equal', 'not_equal',
+           'where', 'sum', 'mean', 'builtin', 'ones', 'zeros', 'parameter',
+           'global_sum', 'global_max', 'global_min', 'tangent_stages']
 
 # ============================================================================ #
 
@@ -33,6 +39,7 @@ def _is_like_sa(a):
 class stencil_array(object):
 
     __context__ = sys.modules[__name__]
+    __slots__ = ('value',)
 
     def __init__(self, init=()):
         if _is_like_sa_value(init):
@@ -133,6 +140,24 @@ class stencil_array(object):
     def __neg__(self):
         return stencil_array(operators.neg(self.value).output)
 
+    def __abs__(self):
+        return abs(self)
+
+    # comparisons are 1.0 where true and 0.0 where false; == and != keep
+    # comparing identity, see equal and not_equal
+
+    def __lt__(self, a):
+        return less(self, a)
+
+    def __le__(self, a):
+        return less_equal(self, a)
+
+    def __gt__(self, a):
+        return greater(self, a)
+
+    def __ge__(self, a):
+        return greater_equal(self, a)
+
     # ------------------------- neighbor access --------------------------- #
 
     @property
@@ -205,6 +230,21 @@ def kp(a):
 def km(a):
     return stencil_array(operators.km(a.value).output)
 
+def shift(a, di=0, dj=0, dk=0):
+    '''
+    The value of a at the grid point offset by (di, dj, dk), e.g.,
+    shift(u, 2) is u two grid points up along i.  A stage reads the offset
+    source directly, so a wide stencil is a single sweep, with a halo as
+    wide as the largest offset.
+    '''
+    offset = (int(di), int(dj), int(dk))
+    if not any(offset):
+        return a
+    nearest = operators.stencil.access_name(offset)
+    if nearest in operators.stencil.__all__:
+        return stencil_array(getattr(operators, nearest)(a.value).output)
+    return stencil_array(operators.shift(a.value, offset).output)
+
 # ============================================================================ #
 #                             data transformations                             #
 # ============================================================================ #
@@ -242,6 +282,61 @@ def exp(a):
     assert _is_like_sa(a)
     return stencil_array(operators.exp(a.value).output)
 
+def sqrt(a):
+    assert _is_like_sa(a)
+    return stencil_array(operators.sqrt(a.value).output)
+
+def abs(a):
+    assert _is_like_sa(a)
+    return stencil_array(operators.abs(a.value).output)
+
+def log(a):
+    assert _is_like_sa(a)
+    return stencil_array(operators.log(a.value).output)
+
+def tanh(a):
+    assert _is_like_sa(a)
+    return stencil_array(operators.tanh(a.value).output)
+
+def _elementwise(op, *args):
+    '''
+    Apply op to args, at least one of which is a stencil array, the
+    others constants
+    '''
+    assert any([_is_like_sa(a) for a in args])
+    args = [a.value if _is_like_sa(a) else a for a in args]
+    return stencil_array(op(*args).output)
+
+def minimum(a, b):
+    return _elementwise(operators.minimum, a, b)
+
+def maximum(a, b):
+    return _elementwise(operators.maximum, a, b)
+
+def less(a, b):
+    return _elementwise(operators.less, a, b)
+
+def less_equal(a, b):
+    return _elementwise(operators.less_equal, a, b)
+
+def greater(a, b):
+    return _elementwise(operators.greater, a, b)
+
+def greater_equal(a, b):
+    return _elementwise(operators.greater_equal, a, b)
+
+def equal(a, b):
+    return _elementwise(operators.equal, a, b)
+
+def not_equal(a, b):
+    return _elementwise(operators.not_equal, a, b)
+
+def where(condition, a, b):
+    '''
+    a where condition is nonzero, e.g., a comparison, and b elsewhere
+    '''
+    return _elementwise(operators.where, condition, a, b)
+
 def sum(a, axis=None):
     assert _is_like_sa(a)
     return stencil_array(operators.sum(a.value, axis).output)
@@ -267,6 +362,42 @@ def ones(shape=()):
 def zeros(shape=()):
     return builtin.ZERO + np.zeros(shape)
 
+def parameter(name, shape=()):
+    '''
+    A scalar (or small array) uniform in space whose value is given when
+    the stages are executed, e.g., execute(stages, x, params={'dt': 0.1}).
+    Unlike a constant, changing its value does not change the C code.
+    '''
+    if isinstance(shape, int):
+        shape = (shape,)
+    return stencil_array(parameter_value(name, shape))
+
+# ============================================================================ #
+#                              global reductions                               #
+# ============================================================================ #
+
+def global_sum(a):
+    '''
+    The sum over the grid of each element of a.  Reductions are returned
+    by the traced function in a dictionary after its outputs, e.g.,
+    return u, {'mass': global_sum(u)}, and computed in the stage sweeps.
+    '''
+    assert _is_like_sa(a)
+    return reduction(None, 'sum', a.value)
+
+def global_max(a):
+    '''
+    The maximum over the grid of each element of a, see global_sum
+    '''
+    assert _is_like_sa(a)
+    return reduction(None, 'max', a.value)
+
+def global_min(a):
+    '''
+    The minimum over the grid of each element of a, see global_sum
+    '''
+    assert _is_like_sa(a)
+    return reduction(None, 'min', a.value)
 
 # ============================================================================ #
 #                                decomposition                                 #
@@ -284,9 +415,11 @@ def _stack_source(stage):
         source_arrays.append(array_slice.reshape(v.shape))
         i_ptr += v.size
     # construct stage based on stacked source values
-    sink_arrays = stage(source_arrays, stencil_array)
+    sink_arrays, reduced_arrays = stage(source_arrays, stencil_array, True)
     sink_values = [a.value for a in sink_arrays]
-    return AtomicStage([stacked_source_value], sink_values)
+    reductions = [reduction(r.name, r.kind, a.value)
+                  for r, a in zip(stage.reductions, reduced_arrays)]
+    return AtomicStage([stacked_source_value], sink_values, reductions)
 
 def _stack_sink(stage):
     sink_total_size = np.sum([v.size for v in stage.sink_values], dtype=int)
@@ -296,10 +429,20 @@ def _stack_sink(stage):
         sink_array_slice = stencil_array(v).reshape((v.size,))
         stacked_sink_array[i_ptr:i_ptr+v.size] = sink_array_slice
         i_ptr += v.size
-    return AtomicStage(stage.source_values, [stacked_sink_array.value])
+    return AtomicStage(stage.source_values, [stacked_sink_array.value],
+                       stage.reductions)
 
-def decompose(func, inputs=stencil_array(), stack_source_sink=True,
-              comp_graph_output_file=None):
+def trace(func, inputs=stencil_array()):
+    source_values, sink_values, reductions = trace_reductions(func, inputs)
+    if reductions:
+        raise ValueError('Use trace_reductions for a function with reductions')
+    return source_values, sink_values
+
+def trace_reductions(func, inputs=stencil_array()):
+    '''
+    The source and sink values of func, and its reductions, returned in
+    a dictionary after the outputs of func, with their names
+    '''
     if not isinstance(inputs, (tuple, list)):
         inputs = (inputs,)
     inputs = tuple([stencil_array(inp.shape) for inp in inputs])
@@ -307,14 +450,96 @@ def decompose(func, inputs=stencil_array(), stack_source_sink=True,
     outputs = func(*inputs)
     if not isinstance(outputs, tuple):
         outputs = (outputs,)
+    reductions = []
+    if outputs and isinstance(outputs[-1], dict):
+        for name in sorted(outputs[-1]):
+            r = outputs[-1][name]
+            if not isinstance(r, reduction):
+                raise TypeError('{0} is not a global reduction'.format(name))
+            reductions.append(reduction(name, r.kind, r.value))
+        outputs = outputs[:-1]
     sink_values = tuple(out.value for out in outputs)
+    return source_values, sink_values, reductions
+
+def stack_stages(stages):
+    '''
+    The stages with the sinks of each, but the last, packed into a single
+    sink value, and the sources of each, but the first, unpacked from it
+    '''
+    stages = list(stages)
+    for k in range(len(stages) - 1):
+        stages[k] = _stack_sink(stages[k])
+    for k in range(1, len(stages)):
+        stages[k] = _stack_source(stages[k])
+    return stages
+
+def _tangent_stage(stage, num_directions):
+    sources = [stencil_array(v.shape) for v in stage.source_values]
+    tangent_sources = [[stencil_array(v.shape) for v in stage.source_values]
+                       for d in range(num_directions)]
+    primal = dict(zip(stage.source_values, sources))
+    primal.update((v, stencil_array(v)) for v in stage.triburary_values)
+    tangents = [dict(zip(stage.source_values, t)) for t in tangent_sources]
+    # the primal of each value and the partials of each op are computed
+    # once and shared by all directions
+    _primal = lambda v: primal[v] if _is_like_sa_value(v) else v
+    for v in stage.sorted_values:
+        op = v.owner
+        inputs = [_primal(v_inp) for v_inp in op.inputs]
+        primal[v] = op.perform(inputs)
+        partials = op.partials(inputs, primal[v])
+        for t in tangents:
+            t[v] = op.tangent(partials, [t.get(v_inp) for v_inp in op.inputs])
+    sinks = [primal[v] for v in stage.sink_values]
+    for t in tangents:
+        sinks += [zeros(v.shape) if t[v] is None else t[v]
+                  for v in stage.sink_values]
+    for t in tangent_sources:
+        sources += t
+    reductions = [reduction(r.name, r.kind, primal[r.value].value)
+                  for r in stage.reductions]
+    return AtomicStage([a.value for a in sources], [a.value for a in sinks],
+                       reductions)
+
+def tangent_stages(stages, num_directions=1):
+    '''
+    Stages that compute, in the same sweep as the sinks of stages, their
+    forward-mode derivatives in num_directions directions at once.
+    Each stage reads its sources followed by their tangents in the first
+    direction, then in the second, and so on, and writes its sinks and
+    their tangents in the same order, e.g.,
+    execute(tangent_stages(stages, 2), [u, du1, du2]) returns the
+    solution and its derivatives in the directions du1 and du2.
+    Parameters and constants are not differentiated, and the reductions
+    are those of the primal values.
+    '''
+    return [_tangent_stage(s, num_directions) for s in stages]
+
+def decompose(func, inputs=stencil_array(), stack_source_sink=False,
+              comp_graph_output_file=None, recompute_cost=0, coarsen=True):
+    '''
+    Decompose func into stages, minimizing the doubles carried between
+    stages plus recompute_cost times the weighted flops of the values
+    recomputed at neighbors.  recompute_cost is the time of one flop
+    relative to carrying one double, i.e., writing and reading 16 bytes,
+    e.g., peak_bandwidth / (16 * peak_flops); 0 minimizes storage only.
+    If coarsen is True, chains of pointwise ops are collapsed into one
+    vertex before the graph is solved; this is narrower than collapsing
+    all unit size values, and gives the same doubles carried as the fine
+    graph for the heat and Euler schemes in the tests, faster.
+    Reductions returned by func, see global_sum, are computed by the
+    stages, and returned by execute.
+    Each stage reads and writes its fields in place; if stack_source_sink
+    is True, the fields are instead packed into a single source and sink
+    value by each stage, see stack_stages.
+    '''
+    source_values, sink_values, reductions = trace_reductions(func, inputs)
     stages = symbolic_value.decompose(source_values, sink_values,
-                                      comp_graph_output_file)
+                                      comp_graph_output_file,
+                                      recompute_op_cost(recompute_cost),
+                                      coarsen, reductions)
     if stack_source_sink:
-        for k in range(len(stages) - 1):
-            stages[k] = _stack_sink(stages[k])
-        for k in range(1, len(stages)):
-            stages[k] = _stack_source(stages[k])
+        stages = stack_stages(stages)
     return stages
 
 ################################################################################
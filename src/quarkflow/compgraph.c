@@ -27,6 +27,17 @@ void comp_graph_read(comp_graph_t * g, FILE * f)
                                            &g->edges[i].is_swept), 3);
     }
 
+    // optional cost of recomputing each vertex at the neighbors
+    g->recompute_cost = (int*) calloc(g->num_vertices, sizeof(int));
+    g->has_recompute_cost = 0;
+    for (int i = 0; i < g->num_vertices; ++i)
+    {
+        int ret = fscanf(f, "%d", &g->recompute_cost[i]);
+        if (i == 0 && ret == EOF) break;
+        check_result(ret, 1);
+        g->has_recompute_cost |= (g->recompute_cost[i] != 0);
+    }
+
     g->swept_in_degree = (int*) calloc(g->num_vertices, sizeof(int));
     g->in_degree = (int*) calloc(g->num_vertices, sizeof(int));
     g->out_degree = (int*) calloc(g->num_vertices, sizeof(int));
@@ -37,6 +48,7 @@ void comp_graph_free(comp_graph_t * g)
 {
     free(g->edges);
     free(g->cutting_cost);
+    free(g->recompute_cost);
     free(g->swept_in_degree);
     free(g->in_degree);
     free(g->out_degree);
@@ -11,6 +11,7 @@ typedef struct {
 typedef struct {
     int num_vertices, num_edges;
     int * cutting_cost;
+    int * recompute_cost, has_recompute_cost;
     comp_graph_edge_t * edges;
     int * swept_in_degree, * in_degree, * out_degree;
     int (*cde)[3];
@@ -41,9 +41,23 @@ glp_arc * _quarkflow_arc_create(glp_graph * glp, int i0, int i1,
     return a;
 }
 
+// With recompute costs, each vertex i also has a potential q_i, the earliest
+// stage in which i is read through a neighbor access without being stored,
+// capped at c_i + 1.  Vertex i is recomputed at the neighbors if q_i == c_i,
+// which costs recompute_cost[i] * (c_i + 1 - q_i).
+int _quarkflow_q(const comp_graph_t * g, int i_vertex)
+{
+    return 3 * g->num_vertices + 2 + i_vertex;
+}
+
+int _quarkflow_num_vertices(const comp_graph_t * g)
+{
+    return (3 + g->has_recompute_cost) * g->num_vertices + 2;
+}
+
 void _quarkflow_vertices_assemble(const comp_graph_t * g, glp_graph * glp)
 {
-    glp_add_vertices(glp, 3 * g->num_vertices + 2);
+    glp_add_vertices(glp, _quarkflow_num_vertices(g));
     int w_K = g->cutting_cost[g->num_vertices];
     glp_vertex * v_0 = glp->v[1];
     glp_vertex * v_K = glp->v[glp->nv];
@@ -77,6 +91,13 @@ void _quarkflow_vertices_assemble(const comp_graph_t * g, glp_graph * glp)
         _quarkflow_arc_create(glp, c_i, d_i, 0, INT_MAX/4, cd_cost);
         _quarkflow_arc_create(glp, c_i, e_i, 0, INT_MAX/4, ce_cost);
         _quarkflow_arc_create(glp, e_i, c_i, 0, INT_MAX/4, ec_cost);
+        if (g->has_recompute_cost) {
+            int q_i = _quarkflow_q(g, i_vertex);
+            int r_i = g->recompute_cost[i_vertex];
+            _quarkflow_vertex_assign(v_c, g->cutting_cost[i_vertex] - r_i);
+            _quarkflow_vertex_assign(glp->v[q_i], r_i);
+            _quarkflow_arc_create(glp, q_i, c_i, 0, INT_MAX/4, 1);
+        }
     }
 }
 
@@ -93,6 +114,12 @@ void _quarkflow_edges_assemble(const comp_graph_t * g, glp_graph * glp)
         _quarkflow_arc_create(glp, c_i, c_j, 0, INT_MAX/4, 0);
         _quarkflow_arc_create(glp, c_j, d_i, 0, INT_MAX/4, 0);
         _quarkflow_arc_create(glp, e_i, e_j, 0, INT_MAX/4, ee_cost);
+        if (g->has_recompute_cost) {
+            int q_i = _quarkflow_q(g, e->from_node);
+            int q_j = _quarkflow_q(g, e->to_node);
+            _quarkflow_arc_create(glp, q_i, e->is_swept ? c_j : q_j,
+                                  0, INT_MAX/4, 0);
+        }
     }
 }
 
@@ -0,0 +1,44 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import enzyme
+from enzyme.analysis import StageCost, evaluation_points, roofline_report
+
+def test_single_stage_cost():
+    def update(u):
+        return enzyme.ip(enzyme.sin(u)) + enzyme.im(u) * 2
+    G, = enzyme.decompose(update, stack_source_sink=False)
+    points = evaluation_points(G)
+    assert points[G.source_values[0]] == set(['ip', 'im'])
+    assert points[G.sink_values[0]] == set([''])
+
+    cost = StageCost(G)
+    assert cost.flops == {'sin': 1, 'add': 1, 'mul': 1}
+    assert cost.transcendental == 1
+    assert cost.bytes_read == 2 * 8
+    assert cost.bytes_written == 8
+    assert cost.recompute_factor == 1
+
+def test_recompute_factor():
+    def update(u):
+        v = enzyme.exp(u) * u
+        return enzyme.ip(v) - enzyme.im(v)
+    G, = enzyme.decompose(update, stack_source_sink=False)
+    cost = StageCost(G)
+    assert cost.flops == {'exp': 2, 'mul': 2, 'sub': 1}
+    assert cost.unique_flops == {'exp': 1, 'mul': 1, 'sub': 1}
+    assert abs(cost.recompute_factor - 5. / 3) < 1E-12
+
+def test_roofline():
+    def update(u):
+        return u * 2
+    G, = enzyme.decompose(update, stack_source_sink=False)
+    slow_memory, = roofline_report([G], peak_bandwidth=1E9, peak_flops=1E12)
+    assert slow_memory['bound'] == 'bandwidth'
+    assert slow_memory['seconds_per_cell'] == 16 / 1E9
+    slow_compute, = roofline_report([G], peak_bandwidth=1E12, peak_flops=1E6)
+    assert slow_compute['bound'] == 'compute'
+    assert slow_compute['seconds_per_cell'] == 1 / 1E6
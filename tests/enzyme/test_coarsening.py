@@ -0,0 +1,46 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import enzyme
+from enzyme import symbolic_value
+from enzyme.symbolic_variable import trace
+
+def heat_midpoint(u):
+    dx, dt = 0.1, 0.01
+    uh = u + 0.5 * dt / dx**2 * (enzyme.im(u) + enzyme.ip(u) - 2 * u +
+                                 enzyme.jm(u) + enzyme.jp(u) - 2 * u)
+    return u + dt / dx**2 * (enzyme.im(uh) + enzyme.ip(uh) - 2 * uh +
+                             enzyme.jm(uh) + enzyme.jp(uh) - 2 * uh)
+
+def test_coarsen_pointwise_chain():
+    # 0 -> 1 -> 2 pointwise, 2 -> 3 swept
+    weights = np.array([1, 1, 1, 1, 2])
+    edges = [[0, 1, 0], [1, 2, 0], [2, 3, 1]]
+    coarse = symbolic_value.coarsen_graph(weights, edges, protected=[3])
+    assert len(coarse.weights) == 3
+    assert coarse.edges.tolist() == [[0, 1, 1]]
+    assert coarse.group.tolist() == [0, 0, 0, 1]
+    assert coarse.is_tail.tolist() == [False, False, True, True]
+
+def test_coarsening_keeps_the_optimum():
+    source_values, sink_values = trace(heat_midpoint)
+    all_values, weights, edges = symbolic_value.build_decomposition_graph(
+            source_values, sink_values)
+    c0, d0, e0 = symbolic_value.decompose_graph(weights, edges)
+    coarse = symbolic_value.coarsen_decomposition_graph(
+            all_values, sink_values, weights, edges)
+    assert len(coarse.weights) < len(weights)
+    c1, d1, e1 = coarse.project(*symbolic_value.decompose_graph(
+            coarse.weights, coarse.edges))
+    assert (symbolic_value.carried_doubles(weights, c0, d0) ==
+            symbolic_value.carried_doubles(weights, c1, d1))
+
+    stages0 = enzyme.decompose(heat_midpoint, coarsen=False)
+    stages1 = enzyme.decompose(heat_midpoint)
+    assert len(stages0) == len(stages1)
+    u0 = np.random.random([8, 4, 3])
+    assert abs(enzyme.execute(stages0, u0) -
+               enzyme.execute(stages1, u0)).max() < 1E-12
@@ -0,0 +1,31 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import enzyme
+from enzyme.c_code import define_constant, generate_c_code, SUFFIX_MARK
+from enzyme.operators.op_base import broadcast_indices
+
+def test_constant_static_initializer():
+    c_code = define_constant([[1., 2.], [3., 0.5]], 'var_0')
+    assert c_code == 'static const double var_0[4] = {1.0, 2.0, 3.0, 0.5};\n'
+
+def test_broadcast_indices_memoized():
+    ind_a, ind_b = broadcast_indices((3, 1), (2,))
+    assert ind_a == (0, 0, 1, 1, 2, 2) and ind_b == (0, 1, 0, 1, 0, 1)
+    assert broadcast_indices((3, 1), (2,)) is broadcast_indices((3, 1), (2,))
+
+def test_neighbor_variants_specialized():
+    def smooth(u):
+        v = u * np.array([1., 2.]) + 1
+        return enzyme.ip(v) + enzyme.im(v)
+    G, = enzyme.decompose(smooth, enzyme.zeros([2]))
+    c_code = generate_c_code(G)
+    assert SUFFIX_MARK not in c_code
+    assert 'var_1_ip[1] = ' in c_code and 'var_1_im[1] = ' in c_code
+    u = np.random.random([8, 4, 3, 2])
+    v = u * np.array([1., 2.]) + 1
+    y = enzyme.execute(G, u)
+    assert abs(y - np.roll(v, -1, 0) - np.roll(v, 1, 0)).max() < 1E-12
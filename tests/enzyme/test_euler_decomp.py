@@ -10,6 +10,8 @@ sys.path.append(os.path.join(my_path, '..', '..'))
 
 import numpy as np
 import enzyme
+from enzyme import symbolic_value
+from enzyme.symbolic_variable import trace
 
 def test_euler_rk4():
     DISS_COEFF = 0.0025
@@ -122,6 +124,18 @@ def test_euler_rk4():
                               comp_graph_output_file=None)
     w1 = enzyme.execute(stages, w0)
 
+    # coarsening the pointwise chains keeps the decomposition objective
+    source_values, sink_values = trace(step, enzyme.stencil_array(5))
+    all_values, weights, edges = symbolic_value.build_decomposition_graph(
+            source_values, sink_values)
+    fine = symbolic_value.decompose_graph(weights, edges)
+    coarse = symbolic_value.coarsen_decomposition_graph(
+            all_values, sink_values, weights, edges)
+    projected = coarse.project(*symbolic_value.decompose_graph(
+            coarse.weights, coarse.edges))
+    assert (symbolic_value.carried_doubles(weights, *fine[:2]) ==
+            symbolic_value.carried_doubles(weights, *projected[:2]))
+
     I, J, K = np.meshgrid(range(Ni), range(Nj), range(Nk), indexing='ij')
     x = (I + 0.5) * dx - 0.2 * Lx
     y = (J + 0.5) * dy - 0.5 * Ly
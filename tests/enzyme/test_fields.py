@@ -0,0 +1,64 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import pytest
+import enzyme
+from enzyme.c_code import peak_scratch_doubles
+
+def wave(u, v):
+    du = 0.1 * v
+    dv = 0.1 * (enzyme.im(u) + enzyme.ip(u) + enzyme.jm(u) + enzyme.jp(u)
+                - 4 * u)
+    return u + du, v + dv
+
+def wave_np(u, v):
+    du = 0.1 * v
+    dv = 0.1 * (np.roll(u, 1, 0) + np.roll(u, -1, 0) +
+                np.roll(u, 1, 1) + np.roll(u, -1, 1) - 4 * u)
+    return u + du, v + dv
+
+def two_stage(u, c):
+    w = enzyme.ip(u) - enzyme.im(u) + c[0] * c[1]
+    return enzyme.ip(w) * c, enzyme.im(w)
+
+def test_fields_in_place():
+    stages = enzyme.decompose(wave, (enzyme.stencil_array(),
+                                     enzyme.stencil_array()))
+    u0, v0 = np.random.random([6, 5, 3]), np.random.random([6, 5, 3])
+    u1, v1 = enzyme.execute(stages, (u0, v0), steps=3)
+    u, v = u0, v0
+    for step in range(3):
+        u, v = wave_np(u, v)
+    assert abs(u1 - u).max() < 1E-12
+    assert abs(v1 - v).max() < 1E-12
+
+def test_fields_between_stages(tmpdir):
+    inputs = (enzyme.stencil_array(), enzyme.stencil_array([2]))
+    stages = enzyme.decompose(two_stage, inputs)
+    assert len(stages) == 2
+    # the stages read and write the fields without packing them
+    assert [len(s.sink_values) for s in stages] == [2, 2]
+    stacked = enzyme.decompose(two_stage, inputs, stack_source_sink=True)
+    assert peak_scratch_doubles(stages[0]) < peak_scratch_doubles(stacked[0])
+
+    u0, c0 = np.random.random([5, 4, 3]), np.random.random([5, 4, 3, 2])
+    w = np.roll(u0, -1, 0) - np.roll(u0, 1, 0) + c0[..., 0] * c0[..., 1]
+    y0, y1 = enzyme.execute(stages, [u0, c0])
+    assert abs(y0 - np.roll(w, -1, 0)[..., None] * c0).max() < 1E-12
+    assert abs(y1 - np.roll(w, 1, 0)).max() < 1E-12
+    z0, z1 = enzyme.execute(stages, [u0, c0], out_of_core=True,
+                            scratch_dir=str(tmpdir))
+    assert isinstance(z0, np.memmap)
+    assert z0.shape == (5, 4, 3, 2) and z1.shape == (5, 4, 3)
+    assert abs(z0 - y0).max() == 0 and abs(z1 - y1).max() == 0
+
+def test_fields_checked():
+    stages = enzyme.decompose(wave, (enzyme.stencil_array(),
+                                     enzyme.stencil_array()))
+    with pytest.raises(ValueError):
+        enzyme.execute(stages, np.zeros([4, 4, 4]))
+    with pytest.raises(ValueError):
+        enzyme.execute(stages, (np.zeros([4, 4, 4]), np.zeros([4, 4, 3])))
@@ -0,0 +1,42 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import enzyme
+from enzyme.c_code import source_halo
+from enzyme.executor import contiguous_runs
+
+def mixed(u):
+    v = enzyme.stencil_array(3)
+    v[0] = enzyme.ip(u[0]) * u[1] + enzyme.jm(u[2])
+    v[1] = u[1]
+    v[2] = u[2] * 2
+    return v
+
+def test_halo_of_neighbor_access():
+    G, = enzyme.decompose(mixed, enzyme.stencil_array(3))
+    assert source_halo(G) == {'ip': [0], 'jm': [2]}
+
+def test_no_halo_for_pointwise_stage():
+    G, = enzyme.decompose(lambda u: enzyme.sin(u) + 1,
+                          enzyme.stencil_array(3))
+    assert source_halo(G) == {}
+
+def test_contiguous_runs():
+    assert contiguous_runs([0, 1, 2, 5, 7, 8]) == [(0, 3), (5, 1), (7, 2)]
+    assert contiguous_runs([]) == []
+
+def test_execute_with_selective_halo():
+    stages = enzyme.decompose(lambda u: mixed(mixed(u)),
+                              enzyme.stencil_array(3))
+    u0 = np.random.random([4, 3, 2, 3])
+    def mixed_np(u):
+        v = u.copy()
+        v[...,0] = (np.roll(u[...,0], -1, axis=0) * u[...,1] +
+                    np.roll(u[...,2], 1, axis=1))
+        v[...,2] = u[...,2] * 2
+        return v
+    u1 = enzyme.execute(stages, u0)
+    assert abs(u1 - mixed_np(mixed_np(u0))).max() < 1E-12
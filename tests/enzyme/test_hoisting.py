@@ -0,0 +1,32 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import enzyme
+from enzyme.analysis import hoistable_values
+
+def test_hoist_spatially_varying_field():
+    I, J, K = enzyme.builtin.I, enzyme.builtin.J, enzyme.builtin.K
+    ip, im = enzyme.ip, enzyme.im
+    def diffuse(u):
+        kappa = enzyme.exp(-((I - 4.)**2 + (J - 2.)**2 + 0.5 * K))
+        cheap = 2. * I
+        return u + 0.1 * (ip(kappa * u) + im(kappa * u) - 2 * kappa * u) + cheap
+    G, = enzyme.decompose(diffuse)
+    hoisted = hoistable_values(G)
+    assert len(hoisted) == 1
+    assert hoisted[0].owner.name == 'exp'
+
+    u0 = np.random.random([8, 4, 3])
+    u1 = enzyme.execute((G,), u0)
+    u2 = enzyme.execute((G,), u0, hoist=False)
+    assert abs(u1 - u2).max() == 0
+
+def test_no_hoisting_of_cheap_or_uniform_fields():
+    I = enzyme.builtin.I
+    def scale(u):
+        return u * enzyme.exp(enzyme.builtin.ZERO + 1.) + 3. * I
+    G, = enzyme.decompose(scale)
+    assert hoistable_values(G) == []
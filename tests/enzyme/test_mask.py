@@ -0,0 +1,62 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import pytest
+import enzyme
+from enzyme.executor import MASK_BLOCK
+
+def laplacian(u):
+    return (enzyme.im(u) + enzyme.ip(u) + enzyme.jm(u) + enzyme.jp(u) +
+            enzyme.km(u) + enzyme.kp(u) - 6 * u)
+
+def two_stage_step(u):
+    return u + 0.1 * laplacian(u + 0.05 * laplacian(enzyme.sin(u)))
+
+def active_blocks(active):
+    blocks = np.zeros(active.shape, bool)
+    B = MASK_BLOCK
+    for i, j, k in zip(*np.nonzero(active)):
+        blocks[i//B*B:(i//B+1)*B, j//B*B:(j//B+1)*B, k//B*B:(k//B+1)*B] = True
+    return blocks
+
+def test_static_mask_updates_active_blocks():
+    G = enzyme.decompose(two_stage_step)
+    assert len(G) == 2
+    u = np.random.random([21, 19, 17])
+    active = np.zeros(u.shape, bool)
+    active[0, 3, 16] = active[12, 10, 5] = True
+    blocks = active_blocks(active)
+    y = enzyme.execute(G, u, steps=3, active=active)
+    expected = u
+    for step in range(3):
+        expected = np.where(blocks, enzyme.execute(G, expected), expected)
+    assert abs(y - expected).max() < 1E-12
+
+def test_threshold_tracks_disturbance():
+    G, = enzyme.decompose(lambda u: u + 0.1 * laplacian(u))
+    u = np.zeros([40, 40, 8])
+    u[4:8,4:8,2:6] = 1
+    y = enzyme.execute(G, u, steps=12, threshold=1E-14, mask_every=3)
+    assert abs(y - enzyme.execute(G, u, steps=12)).max() < 1E-12
+
+def wave(u, v):
+    return u + 0.1 * v, v + 0.1 * laplacian(u)
+
+def test_mask_with_two_fields():
+    stages = enzyme.decompose(wave, (enzyme.stencil_array(),
+                                     enzyme.stencil_array()))
+    u, v = np.random.random([8, 8, 8]), np.random.random([8, 8, 8])
+    y0, y1 = enzyme.execute(stages, (u, v), steps=3)
+    z0, z1 = enzyme.execute(stages, (u, v), steps=3,
+                            active=np.ones([8, 8, 8], bool))
+    assert abs(z0 - y0).max() < 1E-12 and abs(z1 - y1).max() < 1E-12
+
+def test_mask_rejects_reductions():
+    def step(u):
+        return u, {'total': enzyme.global_sum(u)}
+    G, = enzyme.decompose(step)
+    with pytest.raises(ValueError):
+        enzyme.execute(G, np.ones([8, 8, 8]), threshold=0.)
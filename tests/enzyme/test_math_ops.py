@@ -0,0 +1,65 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import enzyme
+from enzyme.c_code import generate_c_code
+
+def minmod(a, b):
+    # branchless slope limiter, generic in numpy and enzyme
+    ctx = enzyme.operators.infer_context(a)
+    s = ctx.where(a * b > 0, 1., 0.)
+    return s * ctx.where(abs(a) < abs(b), a, b)
+
+def limited_update(u):
+    ctx = enzyme.operators.infer_context(u)
+    if ctx is np:
+        du = minmod(np.roll(u, -1, 0) - u, u - np.roll(u, 1, 0))
+    else:
+        du = minmod(enzyme.ip(u) - u, u - enzyme.im(u))
+    return (ctx.sqrt(abs(u)) + ctx.log(1 + u * u) + ctx.tanh(u) +
+            ctx.maximum(u, 0.5) - ctx.minimum(u, 0.5) + du +
+            (u >= 0.5) - (u <= 0.25) + ctx.equal(u, 0.) +
+            ctx.not_equal(u, 1.))
+
+def test_math_ops_match_numpy():
+    G, = enzyme.decompose(limited_update)
+    u = np.random.random([8, 6, 4]) * 2 - 1
+    u[0,0,0] = 0
+    y = enzyme.execute(G, u)
+    assert abs(y - limited_update(u)).max() < 1E-12
+
+def test_stage_call_matches_numpy():
+    u = np.random.random([8, 6, 4]) * 2 - 1
+    # the stage evaluates its ops on numpy arrays, here without neighbors
+    def pointwise(u):
+        return (enzyme.where(u > 0, enzyme.sqrt(abs(u)), -u) +
+                enzyme.maximum(u, 0.))
+    G, = enzyme.decompose(pointwise)
+    y, = G(u, lambda v: 0.)
+    assert abs(y - (np.where(u > 0, np.sqrt(abs(u)), -u) +
+                    np.maximum(u, 0.))).max() < 1E-12
+
+def test_branchless_c_code():
+    def f(u):
+        return enzyme.where(u < 0, -u, enzyme.minimum(abs(u), 1.))
+    G, = enzyme.decompose(f)
+    c_code = generate_c_code(G)
+    assert 'fabs(' in c_code and 'fmin(' in c_code and ' ? ' in c_code
+    assert 'if' not in c_code and 'pow(' not in c_code
+
+def test_comparisons_are_floats_on_numpy():
+    def sign(u):
+        return (u > 0) - (u < 0), -(u <= 0) + enzyme.equal(u, 0.), u >= 0
+    G, = enzyme.decompose(sign)
+    u = np.random.random([8, 6, 4]) * 2 - 1
+    u[0,0,0] = 0
+    y0, y1, y2 = G(u, lambda v: 0.)
+    assert y2.dtype == np.float64
+    assert abs(y0 - np.sign(u)).max() == 0
+    assert abs(y1 - (-1. * (u <= 0) + (u == 0))).max() == 0
+    z0, z1, z2 = enzyme.execute(G, u)
+    assert abs(z0 - y0).max() == 0 and abs(z1 - y1).max() == 0
+    assert abs(z2 - y2).max() == 0
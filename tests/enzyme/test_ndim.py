@@ -0,0 +1,59 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import pytest
+import enzyme
+from enzyme.c_code import generate_c_code, source_halo
+from enzyme.executor import grid_ndim
+
+def laplacian(u):
+    return (enzyme.im(u) + enzyme.ip(u) + enzyme.jm(u) + enzyme.jp(u) +
+            enzyme.km(u) + enzyme.kp(u) - 6 * u)
+
+def heat(u):
+    uh = u + 0.01 * laplacian(u)
+    return u + 0.02 * laplacian(uh)
+
+def test_grid_ndim():
+    assert grid_ndim((8, 4, 3)) == 3
+    assert grid_ndim((8, 4, 1)) == 2
+    assert grid_ndim((8, 1, 1)) == 1
+    assert grid_ndim((8, 1, 1), 3) == 3
+    with pytest.raises(ValueError):
+        grid_ndim((8, 4, 3), 2)
+
+def test_2d_code_has_no_k_neighbors():
+    G = enzyme.decompose(heat)[0]
+    assert sorted(source_halo(G, ndim=2)) == ['im', 'ip', 'jm', 'jp']
+    assert '_km' not in generate_c_code(G, ndim=2)
+    assert '_jp' not in generate_c_code(G, ndim=1)
+
+@pytest.mark.parametrize('shape', [(8, 4, 1), (8, 1, 1)])
+def test_reduced_ndim_matches_3d(shape):
+    stages = enzyme.decompose(heat)
+    u0 = np.random.random(shape)
+    u1 = enzyme.execute(stages, u0)
+    u2 = enzyme.execute(stages, u0, ndim=3)
+    assert abs(u1 - u2).max() < 1E-12
+    u3 = enzyme.execute(stages, u0, fixed_grid=False)
+    assert abs(u1 - u3).max() < 1E-12
+
+def index_stencil(u):
+    K, J = enzyme.builtin.K, enzyme.builtin.J
+    return (u + enzyme.kp(u * K) + enzyme.jp(J * 1.0) +
+            enzyme.km(enzyme.exp(enzyme.sin(0.3 * K + enzyme.builtin.I))))
+
+@pytest.mark.parametrize('shape', [(4, 3, 1), (5, 1, 1)])
+def test_index_across_missing_axis(shape):
+    # the index along a missing axis still changes across an access on it
+    G = enzyme.decompose(index_stencil)
+    u = np.random.random(shape)
+    for hoist in (True, False):
+        y = enzyme.execute(G, u, hoist=hoist)
+        y3 = enzyme.execute(G, u, ndim=3, hoist=hoist)
+        assert abs(y - y3).max() < 1E-12
+    # while the grid data is read without ghost cells along it
+    assert source_halo(G[0], ndim=2) == {}
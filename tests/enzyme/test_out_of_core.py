@@ -0,0 +1,55 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import pytest
+import enzyme
+from enzyme import executor
+from enzyme.symbolic_variable import builtin
+
+def mixed(u):
+    v = enzyme.stencil_array(3)
+    v[0] = (enzyme.ip(u[0]) * u[1] + enzyme.jm(u[2]) +
+            enzyme.exp(enzyme.sin(builtin.I * 0.3)))
+    v[1] = enzyme.km(u[1]) - enzyme.im(u[0])
+    v[2] = u[2] * 2
+    return v
+
+@pytest.mark.parametrize('shape', [(5, 4, 3), (1, 3, 2), (6, 4, 1)])
+def test_out_of_core_matches_in_core(shape, tmpdir):
+    stages = enzyme.decompose(lambda u: mixed(mixed(u)),
+                              enzyme.stencil_array(3))
+    u0 = np.random.random(shape + (3,))
+    y0 = enzyme.execute(stages, u0)
+    y1 = enzyme.execute(stages, u0, out_of_core=True, scratch_dir=str(tmpdir))
+    assert isinstance(y1, np.memmap)
+    assert os.path.dirname(y1.filename) == str(tmpdir)
+    assert abs(y0 - y1).max() == 0
+
+def test_out_of_core_reads_mapped_input(tmpdir):
+    G, = enzyme.decompose(lambda u: enzyme.ip(u) - enzyme.im(u))
+    x = np.memmap(str(tmpdir.join('x')), np.float64, 'w+', shape=(8, 4, 3))
+    x[:] = np.random.random(x.shape)
+    x.flush()
+    y, report = enzyme.execute(G, x, profile=True, out_of_core=True,
+                               scratch_dir=str(tmpdir))
+    assert abs(y - (np.roll(x, -1, 0) - np.roll(x, 1, 0))).max() < 1E-12
+    assert len(report.stages) == 1
+    # only the input and the output remain in the scratch directory
+    assert len(tmpdir.listdir()) == 2
+
+def test_out_of_core_failure_leaves_no_files(tmpdir):
+    G, = enzyme.decompose(lambda u: enzyme.ip(u) - enzyme.im(u))
+    # a program that fails the way a crashing stage would
+    program_dir = tmpdir.mkdir('program')
+    program = program_dir.join('main')
+    program.write('#!/bin/sh\necho failed >&2\n')
+    program.chmod(0o755)
+    scratch_dir = tmpdir.mkdir('scratch')
+    with pytest.raises(AssertionError):
+        executor.run_out_of_core(str(program_dir), [G],
+                                 np.random.random([4, 3, 2]),
+                                 scratch_dir=str(scratch_dir))
+    assert scratch_dir.listdir() == []
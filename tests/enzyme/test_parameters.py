@@ -0,0 +1,64 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import pytest
+import enzyme
+from enzyme import executor
+
+def heat(u):
+    dt, dx = enzyme.parameter('dt'), enzyme.parameter('dx')
+    kappa = enzyme.exp(-enzyme.parameter('c', 2)[0] * enzyme.builtin.I)
+    return u + dt / dx**2 * kappa * (enzyme.im(u) + enzyme.ip(u) - 2 * u)
+
+def heat_numpy(u, dt, dx, c):
+    kappa = np.exp(-c[0] * np.arange(u.shape[0]))[:,np.newaxis,np.newaxis]
+    return u + dt / dx**2 * kappa * (np.roll(u,1,0) + np.roll(u,-1,0) - 2 * u)
+
+def test_parameter_values():
+    G, = enzyme.decompose(heat)
+    u0 = np.random.random([8, 4, 3])
+    for dt in [0.001, 0.002]:
+        params = {'dt': dt, 'dx': 0.1, 'c': [0.5, 0.]}
+        u1 = enzyme.execute(G, u0, params=params)
+        u2 = heat_numpy(u0, dt, 0.1, [0.5, 0.])
+        assert abs(u1 - u2).max() < 1E-12
+
+def test_program_reused_across_parameter_values():
+    G, = enzyme.decompose(heat)
+    u0 = np.random.random([8, 4, 3])
+    params = {'dt': 0.001, 'dx': 0.1, 'c': [0.5, 0.]}
+    stages, stage_indices = executor.unique_stages((G,))
+    path = executor.build(stages, stage_indices, u0)
+    assert os.path.basename(path).startswith('build-')
+    param_vector = executor.parameter_vector(
+            *executor.parameter_offsets(stages), params=params)
+    u1 = executor.run(path, stages, u0, param_vector)
+    assert abs(u1 - heat_numpy(u0, 0.001, 0.1, [0.5, 0.])).max() < 1E-12
+    # the parameter values do not change the program
+    params['dt'] = 0.003
+    assert executor.build(stages, stage_indices, u0) == path
+    param_vector = executor.parameter_vector(
+            *executor.parameter_offsets(stages), params=params)
+    u2 = executor.run(path, stages, u0, param_vector)
+    assert abs(u2 - heat_numpy(u0, 0.003, 0.1, [0.5, 0.])).max() < 1E-12
+    assert abs(u2 - enzyme.execute(G, u0, params=params)).max() == 0
+
+def test_program_rebuilt_if_missing():
+    G, = enzyme.decompose(heat)
+    stages, stage_indices = executor.unique_stages((G,))
+    u0 = np.random.random([8, 4, 3])
+    path = executor.build(stages, stage_indices, u0)
+    os.remove(os.path.join(path, 'main'))
+    assert executor.build(stages, stage_indices, u0) == path
+    assert os.path.exists(os.path.join(path, 'main'))
+
+def test_missing_or_misshaped_parameter():
+    G, = enzyme.decompose(heat)
+    u0 = np.random.random([8, 4, 3])
+    with pytest.raises(ValueError):
+        enzyme.execute(G, u0, params={'dt': 0.001, 'c': [0.5, 0.]})
+    with pytest.raises(ValueError):
+        enzyme.execute(G, u0, params={'dt': 0.001, 'dx': 0.1, 'c': 0.5})
@@ -0,0 +1,57 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import enzyme
+from enzyme import executor
+
+def laplacian(u):
+    return (enzyme.im(u) + enzyme.ip(u) + enzyme.jm(u) + enzyme.jp(u) +
+            enzyme.km(u) + enzyme.kp(u) - 6 * u)
+
+def test_pgo_matches_plain_build():
+    G, = enzyme.decompose(laplacian)
+    u = np.random.random([24, 20, 4])
+    y = enzyme.execute(G, u, pgo=True)
+    assert abs(y - enzyme.execute(G, u)).max() < 1E-12
+
+def test_profile_cached_with_program():
+    # a constant of its own keeps the program out of the cache of other runs
+    c = np.random.random()
+    G, = enzyme.decompose(lambda u: laplacian(u) * c)
+    trained = []
+    def train(path):
+        trained.append(path)
+        executor.run(path, stages, u[:4,:4,:4])
+    stages, stage_indices = executor.unique_stages((G,))
+    u = np.random.random([12, 10, 8])
+    path = executor.build(stages, stage_indices, u, fixed_grid=False,
+                          train=train)
+    assert os.path.exists(os.path.join(path, 'main.gcda'))
+    assert executor.build(stages, stage_indices, np.random.random([6, 6, 6]),
+                          fixed_grid=False, train=train) == path
+    assert trained and len(trained) == 1
+    y = executor.run(path, stages, u)
+    assert abs(y - enzyme.execute(G, u)).max() < 1E-12
+
+def test_pgo_with_snapshots(tmpdir):
+    c = np.random.random()
+    G, = enzyme.decompose(lambda u: u + 0.01 * c * laplacian(u))
+    u = np.random.random([20, 18, 4])
+    snapshot_dir = str(tmpdir.join('snapshots'))
+    y = enzyme.execute(G, u, steps=4, snapshot_every=2,
+                       snapshot_dir=snapshot_dir, pgo=True)
+    assert abs(y - enzyme.execute(G, u, steps=4)).max() < 1E-12
+    snapshots = enzyme.load_snapshots(snapshot_dir)
+    assert len(snapshots) == 2
+
+def test_pgo_out_of_core_leaves_only_result(tmpdir):
+    c = np.random.random()
+    G, = enzyme.decompose(lambda u: laplacian(u) * c)
+    u = np.random.random([20, 18, 4])
+    y = enzyme.execute(G, u, out_of_core=True, scratch_dir=str(tmpdir),
+                       pgo=True)
+    assert abs(y - enzyme.execute(G, u)).max() < 1E-12
+    assert os.listdir(str(tmpdir)) == [os.path.basename(y.filename)]
@@ -0,0 +1,36 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import enzyme
+
+def test_profile_heat_midpoint():
+    im, ip = enzyme.im, enzyme.ip
+    jm, jp = enzyme.jm, enzyme.jp
+    km, kp = enzyme.km, enzyme.kp
+    def heat_midpoint(u):
+        dx, dt = 0.1, 0.01
+        uh = u + 0.5 * dt / dx**2 * (im(u) + ip(u) - 2 * u +
+                                     jm(u) + jp(u) - 2 * u +
+                                     km(u) + kp(u) - 2 * u)
+        return u + dt / dx**2 * (im(uh) + ip(uh) - 2 * uh +
+                                 jm(uh) + jp(uh) - 2 * uh +
+                                 km(uh) + kp(uh) - 2 * uh)
+    Ni, Nj, Nk = 8, 4, 3
+    u0 = np.random.random([Ni, Nj, Nk])
+    G1, G2 = enzyme.decompose(heat_midpoint)
+    u1 = enzyme.execute((G1, G2), u0)
+    u3, report = enzyme.execute((G1, G2), u0, profile=True)
+    assert abs(u1 - u3).max() == 0
+
+    for phase in ['compile', 'read', 'layout_in', 'layout_out', 'write']:
+        assert report.phases[phase] >= 0
+    assert [s['stage'] for s in report.stages] == [0, 1]
+    for s in report.stages:
+        assert s['seconds'] == s['sync_seconds'] + s['sweep_seconds']
+        assert s['flops'] > 0 and s['bytes'] > 0
+        assert s['cells_per_second'] > 0
+    assert report.total_seconds >= report.phases['compile']
+    assert 'stage_1' in repr(report)
@@ -0,0 +1,29 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import enzyme
+from enzyme.analysis import StageCost
+
+def heat_midpoint(u):
+    dx, dt = 0.1, 0.01
+    uh = u + 0.5 * dt / dx**2 * (enzyme.im(u) + enzyme.ip(u) - 2 * u +
+                                 enzyme.jm(u) + enzyme.jp(u) - 2 * u)
+    return u + dt / dx**2 * (enzyme.im(uh) + enzyme.ip(uh) - 2 * uh +
+                             enzyme.jm(uh) + enzyme.jp(uh) - 2 * uh)
+
+def test_recompute_cost_reduces_flops():
+    stages0 = enzyme.decompose(heat_midpoint)
+    stages1 = enzyme.decompose(heat_midpoint, recompute_cost=1)
+    carried = lambda stages: [sum([v.size for v in s.sink_values])
+                              for s in stages[:-1]]
+    flops = lambda stages: sum([StageCost(s).total_flops for s in stages])
+    assert carried(stages1) == carried(stages0)
+    assert flops(stages1) < flops(stages0)
+
+    u0 = np.random.random([8, 4, 3])
+    u1 = enzyme.execute(stages0, u0)
+    u2 = enzyme.execute(stages1, u0)
+    assert abs(u1 - u2).max() < 1E-12
@@ -0,0 +1,76 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import pytest
+import enzyme
+
+def heat(u):
+    return u + 0.1 * (enzyme.im(u) + enzyme.ip(u) +
+                      enzyme.jm(u) + enzyme.jp(u) - 4 * u)
+
+def heat_np(u):
+    return u + 0.1 * (np.roll(u, 1, 0) + np.roll(u, -1, 0) +
+                      np.roll(u, 1, 1) + np.roll(u, -1, 1) - 4 * u)
+
+def heat_diagnostics(u):
+    v = heat(u)
+    return v, {'mass': enzyme.global_sum(v), 'peak': enzyme.global_max(v),
+               'low': enzyme.global_min(u - enzyme.ip(u))}
+
+def test_reductions_of_each_step():
+    stages = enzyme.decompose(heat_diagnostics)
+    u0 = np.random.random([6, 5, 3])
+    y, reduced = enzyme.execute(stages, u0, steps=3)
+    assert sorted(reduced) == ['low', 'mass', 'peak']
+    u = u0
+    for step in range(3):
+        low = (u - np.roll(u, -1, 0)).min()
+        u = heat_np(u)
+        assert abs(reduced['mass'][step] - u.sum()) < 1E-10
+        assert reduced['peak'][step] == u.max()
+        assert reduced['low'][step] == low
+    assert abs(y - u).max() < 1E-12
+
+def test_reductions_without_output(tmpdir):
+    stages = enzyme.decompose(heat_diagnostics)
+    u0 = np.random.random([6, 5, 3])
+    reduced = enzyme.execute(stages, u0, output=False)
+    assert reduced['peak'].shape == (1,)
+    assert reduced['peak'][0] == heat_np(u0).max()
+    reduced = enzyme.execute(stages, u0, output=False, out_of_core=True,
+                             scratch_dir=str(tmpdir))
+    assert reduced['peak'][0] == heat_np(u0).max()
+    assert os.listdir(str(tmpdir)) == []
+    with pytest.raises(ValueError):
+        enzyme.execute(enzyme.decompose(heat), u0, output=False)
+
+def test_vector_reduction_out_of_core(tmpdir):
+    def advect(u):
+        return u - 0.1 * (enzyme.ip(u) - enzyme.im(u)), \
+               {'total': enzyme.global_sum(u * u)}
+    stages = enzyme.decompose(advect, enzyme.stencil_array([2]))
+    u0 = np.random.random([5, 4, 3, 2])
+    y0, reduced0 = enzyme.execute(stages, u0, steps=2)
+    y1, reduced1 = enzyme.execute(stages, u0, steps=2, out_of_core=True,
+                                  scratch_dir=str(tmpdir))
+    assert reduced0['total'].shape == (2, 2)
+    assert abs((u0 * u0).sum(axis=(0, 1, 2)) -
+               reduced0['total'][0]).max() < 1E-10
+    assert (reduced0['total'] == reduced1['total']).all()
+    assert abs(y0 - y1).max() == 0
+
+def test_reduction_no_stage_computes():
+    # two nested neighbor accesses are computed by no single stage of
+    # the decomposition of the sinks alone
+    def two_heat_steps(u):
+        shifted = enzyme.ip(enzyme.ip(u))
+        return heat(heat(u)), {'correlation': enzyme.global_sum(u * shifted)}
+    stages = enzyme.decompose(two_heat_steps)
+    u0 = np.random.random([6, 5, 3])
+    y, reduced = enzyme.execute(stages, u0)
+    correlation = (u0 * np.roll(u0, -2, 0)).sum()
+    assert abs(reduced['correlation'][0] - correlation) < 1E-10
+    assert abs(y - heat_np(heat_np(u0))).max() < 1E-12
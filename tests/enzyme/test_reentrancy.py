@@ -0,0 +1,36 @@
+import os
+import sys
+import threading
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import pytest
+import enzyme
+from enzyme.c_code import generate_c_code
+
+def heat(u):
+    return u + 0.1 * (enzyme.im(u) + enzyme.ip(u) - 2 * u) \
+             + enzyme.builtin.I * enzyme.ones(u.shape)
+
+def test_concurrent_code_generation():
+    G, = enzyme.decompose(heat, enzyme.stencil_array(3))
+    expected = generate_c_code(G)
+    results = [None] * 8
+    def generate(i):
+        results[i] = generate_c_code(G)
+    threads = [threading.Thread(target=generate, args=(i,))
+               for i in range(len(results))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [expected] * len(results)
+
+def test_evaluation_after_exception():
+    G, = enzyme.decompose(heat, stack_source_sink=False)
+    with pytest.raises(AttributeError):
+        # fails half way, at the first neighbor access
+        G(np.ones(3), enzyme.stencil_array)
+    v, = G(enzyme.stencil_array(), enzyme.stencil_array)
+    assert v.shape == ()
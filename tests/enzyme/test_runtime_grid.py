@@ -0,0 +1,38 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import pytest
+import enzyme
+from enzyme import executor
+
+def laplacian(u):
+    return (enzyme.im(u) + enzyme.ip(u) + enzyme.jm(u) + enzyme.jp(u) +
+            enzyme.km(u) + enzyme.kp(u) - 6 * u + enzyme.builtin.I)
+
+def laplacian_numpy(u):
+    I = np.arange(u.shape[0])[:,np.newaxis,np.newaxis]
+    return sum([np.roll(u, s, axis) for s in [1,-1] for axis in [0,1,2]]) \
+            - 6 * u + I
+
+def test_one_program_for_all_grid_sizes():
+    G, = enzyme.decompose(laplacian)
+    paths = set()
+    for shape in [(8, 4, 3), (5, 7, 2), (16, 16, 16)]:
+        u = np.random.random(shape)
+        stages, stage_indices = executor.unique_stages((G,))
+        paths.add(executor.build(stages, stage_indices, u, fixed_grid=False))
+        y = enzyme.execute(G, u, fixed_grid=False)
+        assert abs(y - laplacian_numpy(u)).max() < 1E-12
+    assert len(paths) == 1
+
+def test_fixed_grid_program_rejects_other_grid_size():
+    G, = enzyme.decompose(laplacian)
+    u = np.random.random([8, 4, 3])
+    stages, stage_indices = executor.unique_stages((G,))
+    path = executor.build(stages, stage_indices, u)
+    executor.run(path, stages, u)
+    with pytest.raises(AssertionError):
+        executor.run(path, stages, np.random.random([4, 4, 3]))
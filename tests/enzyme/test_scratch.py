@@ -0,0 +1,33 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import enzyme
+from enzyme.c_code import Step, allocate_scratch, peak_scratch_doubles
+
+def test_allocate_scratch_reuses_dead_arrays():
+    steps = [Step('', (), 'a', 4),
+             Step('', ('a',), 'b', 2),
+             Step('', ('b',), 'c', 4),
+             Step('', ('a', 'c'), 'd', 1)]
+    offsets, peak = allocate_scratch(steps, ['d'])
+    # b is dead after c is computed, c may not overlap b or a
+    assert offsets['a'] == 0 and offsets['b'] == 4
+    assert offsets['c'] == 6 and offsets['d'] == 4
+    assert peak == 10
+
+def test_chain_needs_two_arrays():
+    def chain(u):
+        for i in range(20):
+            u = enzyme.sin(u) + 1
+        return u
+    G, = enzyme.decompose(chain, enzyme.stencil_array(3))
+    # two arrays, computed only at the grid point in a pointwise stage
+    assert peak_scratch_doubles(G) == 2 * 3
+    u0 = np.random.random([4, 3, 2, 3])
+    u1 = u0
+    for i in range(20):
+        u1 = np.sin(u1) + 1
+    assert abs(enzyme.execute(G, u0) - u1).max() < 1E-12
@@ -0,0 +1,48 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import pytest
+import enzyme
+from enzyme.operators.op_base import broadcast_shapes, getitem_shape
+from enzyme.operators.op_base import reshape_shape, transpose_shape, sum_shape
+
+def test_broadcast():
+    for shapes in [((), (3,)), ((4,1), (3,)), ((2,1,3), (5,1)), ((3,), (3,))]:
+        expected = (np.ones(shapes[0]) + np.ones(shapes[1])).shape
+        assert broadcast_shapes(*shapes) == expected
+    with pytest.raises(ValueError):
+        broadcast_shapes((2,), (3,))
+
+def test_getitem():
+    shape = (5, 4, 3)
+    a = np.ones(shape)
+    for ind in [0, -1, slice(1, None), (slice(None), 2), (Ellipsis, 1),
+                (None, 1), (1, None, slice(None, None, -2)), (1, Ellipsis),
+                [0, 2], (slice(1, 3), np.array([0, 1]))]:
+        assert getitem_shape(shape, ind) == a[ind].shape
+    for ind in [5, (0, 0, 0, 0), -6]:
+        with pytest.raises(IndexError):
+            getitem_shape(shape, ind)
+
+def test_shape_transformations():
+    assert reshape_shape((4, 3), (2, -1)) == (2, 6)
+    assert reshape_shape((4, 3), 12) == (12,)
+    with pytest.raises(ValueError):
+        reshape_shape((4, 3), (5, -1))
+    assert transpose_shape((4, 3, 2), None) == (2, 3, 4)
+    assert transpose_shape((4, 3, 2), (1, 0, 2)) == (3, 4, 2)
+    assert sum_shape((4, 3, 2), -1) == (4, 3)
+    assert sum_shape((4, 3, 2), None) == ()
+
+def test_traced_shapes():
+    u = enzyme.stencil_array((5, 3))
+    assert (u * np.ones(3)).shape == (5, 3)
+    assert u[1:3].shape == (2, 3)
+    assert u.reshape((3, -1)).shape == (3, 5)
+    assert u.T.shape == (3, 5)
+    assert enzyme.sum(u, 0).shape == (3,)
+    assert enzyme.ip(u[0]).shape == (3,)
+    assert len(list(u)) == 5
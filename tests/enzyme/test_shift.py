@@ -0,0 +1,60 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import enzyme
+from enzyme.c_code import source_halo
+from enzyme.executor import halo_faces, grid_halo
+
+def laplace4(u):
+    s = enzyme.shift
+    return u + 0.01 * (-s(u, 2) + 16 * s(u, 1) - 30 * u + 16 * s(u, -1)
+                       - s(u, -2) - s(u, 0, 2) + 16 * s(u, 0, 1) - 30 * u
+                       + 16 * s(u, 0, -1) - s(u, 0, -2)) / 12
+
+def laplace4_np(u):
+    s = lambda u, di, dj=0: np.roll(np.roll(u, -di, 0), -dj, 1)
+    return u + 0.01 * (-s(u, 2) + 16 * s(u, 1) - 30 * u + 16 * s(u, -1)
+                       - s(u, -2) - s(u, 0, 2) + 16 * s(u, 0, 1) - 30 * u
+                       + 16 * s(u, 0, -1) - s(u, 0, -2)) / 12
+
+def cross(u):
+    return enzyme.shift(u, 1, 1) - enzyme.shift(u, 1, -1) \
+         - enzyme.shift(u, -1, 1) + enzyme.shift(u, -1, -1) \
+         + enzyme.shift(u, 0, 0, -3)
+
+def cross_np(u):
+    s = lambda di, dj, dk=0: np.roll(u, (-di, -dj, -dk), (0, 1, 2))
+    return s(1, 1) - s(1, -1) - s(-1, 1) + s(-1, -1) + s(0, 0, -3)
+
+def test_shift_names():
+    u = enzyme.stencil_array()
+    assert enzyme.shift(u) is u
+    assert enzyme.shift(u, 1).value.owner.name == 'ip'
+    assert enzyme.shift(u, 0, 0, -1).value.owner.name == 'km'
+    assert enzyme.shift(u, -2, 1).value.owner.name == 'im2jp'
+
+def test_fourth_order_in_one_sweep(tmpdir):
+    stages = enzyme.decompose(laplace4)
+    assert len(stages) == 1
+    assert halo_faces(source_halo(stages[0])) == dict(
+            (face, (2, [0])) for face in ['im', 'ip', 'jm', 'jp'])
+    assert grid_halo(stages) == [2, 2, 1]
+    u0 = np.random.random([7, 6, 3])
+    u1 = enzyme.execute(stages, u0, steps=2)
+    assert abs(u1 - laplace4_np(laplace4_np(u0))).max() < 1E-12
+    u2 = enzyme.execute(stages, u0, steps=2, out_of_core=True,
+                        scratch_dir=str(tmpdir))
+    assert abs(u2 - u1).max() == 0
+    u3 = enzyme.execute(stages, u0[:, :, :1], steps=2)
+    assert abs(u3 - laplace4_np(laplace4_np(u0[:, :, :1]))).max() < 1E-12
+
+def test_diagonal_and_wide_offsets(tmpdir):
+    stages = enzyme.decompose(cross)
+    assert len(stages) == 1
+    u0 = np.random.random([5, 4, 6])
+    assert abs(enzyme.execute(stages, u0) - cross_np(u0)).max() < 1E-12
+    u1 = enzyme.execute(stages, u0, out_of_core=True, scratch_dir=str(tmpdir))
+    assert abs(u1 - cross_np(u0)).max() < 1E-12
@@ -0,0 +1,46 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import pytest
+import enzyme
+
+def heat(u):
+    return u + 0.1 * (enzyme.im(u) + enzyme.ip(u) +
+                      enzyme.jm(u) + enzyme.jp(u) - 4 * u)
+
+def heat_np(u):
+    return u + 0.1 * (np.roll(u, 1, 0) + np.roll(u, -1, 0) +
+                      np.roll(u, 1, 1) + np.roll(u, -1, 1) - 4 * u)
+
+def test_snapshots_every_m_steps(tmpdir):
+    stages = enzyme.decompose(heat)
+    u0 = np.random.random([6, 5, 3])
+    y = enzyme.execute(stages, u0, steps=7, snapshot_every=3,
+                       snapshot_dir=str(tmpdir))
+    snapshots = enzyme.load_snapshots(str(tmpdir))
+    assert list(snapshots) == [3, 6]
+    u = u0
+    for step in range(1, 8):
+        u = heat_np(u)
+        if step in snapshots:
+            assert isinstance(snapshots[step], np.memmap)
+            assert abs(snapshots[step] - u).max() < 1E-12
+    assert abs(y - u).max() < 1E-12
+
+def test_steps_out_of_core(tmpdir):
+    stages = enzyme.decompose(heat)
+    u0 = np.random.random([6, 5, 3])
+    y = enzyme.execute(stages, u0, steps=4, out_of_core=True,
+                       scratch_dir=str(tmpdir))
+    u = u0
+    for step in range(4):
+        u = heat_np(u)
+    assert abs(y - u).max() < 1E-12
+
+def test_snapshot_requires_dir():
+    with pytest.raises(ValueError):
+        enzyme.execute(enzyme.decompose(heat), np.zeros([4, 4, 4]),
+                       steps=2, snapshot_every=1)
@@ -0,0 +1,43 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import enzyme
+from enzyme.executor import unique_stages
+
+def heat_midpoint(u):
+    dx, dt = 0.1, 0.01
+    uh = u + 0.5 * dt / dx**2 * (enzyme.im(u) + enzyme.ip(u) - 2 * u)
+    return u + dt / dx**2 * (enzyme.im(uh) + enzyme.ip(uh) - 2 * uh)
+
+def test_stages_traced_twice_are_equal():
+    G1, G2 = enzyme.decompose(heat_midpoint)
+    H1, H2 = enzyme.decompose(heat_midpoint)
+    assert G1 == H1 and hash(G1) == hash(H1)
+    assert G2 == H2 and hash(G2) == hash(H2)
+    assert G1 != G2
+    unique, stage_indices = unique_stages([G1, G2, H1, H2])
+    assert len(unique) == 2
+    assert stage_indices == [0, 1, 0, 1]
+
+    u0 = np.random.random([8, 4, 3])
+    u2 = enzyme.execute([G1, G2, H1, H2], u0)
+    u1 = enzyme.execute([G1, G2], u0)
+    assert abs(u2 - enzyme.execute([G1, G2], u1)).max() == 0
+
+def test_stages_with_different_constants_or_indices_differ():
+    G, = enzyme.decompose(lambda u: 2 * enzyme.ip(u))
+    H, = enzyme.decompose(lambda u: 3 * enzyme.ip(u))
+    assert G != H
+    a = enzyme.stencil_array(3)
+    G, = enzyme.decompose(lambda u: enzyme.ip(u)[:2], a)
+    H, = enzyme.decompose(lambda u: enzyme.ip(u)[1:], a)
+    assert G != H
+    G, = enzyme.decompose(lambda u: enzyme.ip(u) * enzyme.builtin.I)
+    H, = enzyme.decompose(lambda u: enzyme.ip(u) * enzyme.builtin.J)
+    assert G != H
+    G, = enzyme.decompose(lambda u: enzyme.ip(u) * enzyme.parameter('a'))
+    H, = enzyme.decompose(lambda u: enzyme.ip(u) * enzyme.parameter('b'))
+    assert G != H
@@ -0,0 +1,65 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import enzyme
+from enzyme.c_code import generate_c_code
+
+def smooth_update(u):
+    dx = enzyme.ip(u) - enzyme.im(u)
+    flux = enzyme.exp(-u * u) * dx / enzyme.sqrt(1 + dx ** 2)
+    return (u + 0.1 * (enzyme.jp(flux) - flux) + enzyme.sin(u) ** 3 +
+            enzyme.log(2 + enzyme.tanh(u)) * enzyme.cos(dx) +
+            enzyme.maximum(u, 0.3) * enzyme.where(u > 0.5, u, 2 * u) +
+            enzyme.minimum(abs(dx - 2), 1.5))
+
+def two_field(u, c):
+    w = enzyme.ip(u) * c[0] - enzyme.im(u) / (2 + c[1] * c[1])
+    return enzyme.jp(w) + u * enzyme.sum(c), c * enzyme.sin(w)
+
+def test_tangent_matches_finite_difference():
+    G = enzyme.decompose(smooth_update)
+    T = enzyme.tangent_stages(G)
+    u = np.random.random([8, 6, 3])
+    du = np.random.random([8, 6, 3])
+    y, dy = enzyme.execute(T, [u, du])
+    assert abs(y - enzyme.execute(G, u)).max() < 1E-12
+    eps = 1E-6
+    dy_fd = (enzyme.execute(G, u + eps * du) -
+             enzyme.execute(G, u - eps * du)) / (2 * eps)
+    assert abs(dy - dy_fd).max() < 1E-6
+
+def test_tangent_directions_and_steps():
+    inputs = (enzyme.stencil_array(), enzyme.stencil_array([2]))
+    G = enzyme.decompose(two_field, inputs)
+    T = enzyme.tangent_stages(G, 2)
+    assert len(T) == len(G)
+    u, c = np.random.random([5, 4, 3]), np.random.random([5, 4, 3, 2])
+    du1, dc1 = np.random.random([5, 4, 3]), np.zeros([5, 4, 3, 2])
+    du2, dc2 = np.zeros([5, 4, 3]), np.random.random([5, 4, 3, 2])
+    y = enzyme.execute(T, [u, c, du1, dc1, du2, dc2], steps=2)
+    y0 = enzyme.execute(G, [u, c], steps=2)
+    assert abs(y[0] - y0[0]).max() < 1E-12
+    assert abs(y[1] - y0[1]).max() < 1E-12
+    eps = 1E-6
+    for d, (du, dc) in enumerate([(du1, dc1), (du2, dc2)]):
+        yp = enzyme.execute(G, [u + eps * du, c + eps * dc], steps=2)
+        ym = enzyme.execute(G, [u - eps * du, c - eps * dc], steps=2)
+        for i in range(2):
+            dy_fd = (yp[i] - ym[i]) / (2 * eps)
+            assert abs(y[2 + 2 * d + i] - dy_fd).max() < 1E-6
+
+def test_primal_shared_by_directions():
+    def f(u):
+        return enzyme.exp(enzyme.ip(u)) * enzyme.sin(u) + u ** 2.5
+    G, = enzyme.decompose(f)
+    T1, = enzyme.tangent_stages([G], 1)
+    T3, = enzyme.tangent_stages([G], 3)
+    assert len(T3.source_values) == len(T3.sink_values) == 4
+    # the primal and the partials are computed once for all directions
+    c_code = generate_c_code(T3)
+    assert c_code.count('exp(') == generate_c_code(G).count('exp(')
+    assert c_code.count('sin(') == 1 and c_code.count('cos(') == 1
+    assert c_code.count('pow(') == generate_c_code(T1).count('pow(') == 2
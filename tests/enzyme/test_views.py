@@ -0,0 +1,44 @@
+import os
+import sys
+my_path = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(my_path, '..', '..'))
+
+import numpy as np
+import enzyme
+from enzyme.c_code import generate_c_code
+
+def check(func, func_numpy, shape):
+    G, = enzyme.decompose(func, enzyme.stencil_array(shape))
+    x = np.random.random((4, 3, 2) + shape)
+    assert abs(enzyme.execute(G, x) - func_numpy(x)).max() == 0
+    return G
+
+def test_transpose():
+    check(lambda u: enzyme.transpose(u, (1, 2, 0)),
+          lambda u: u.transpose(0, 1, 2, 4, 5, 3), (2, 3, 4))
+
+def test_roll():
+    check(lambda u: enzyme.roll(u, 1, 2),
+          lambda u: np.roll(u, 1, 5), (2, 3, 4))
+
+def test_getitem_setitem():
+    def f(u):
+        u = u.copy()
+        u[0,1:] = enzyme.ip(u)[1,:2] * 2
+        u[1,0,0] = 5.
+        return u
+    def f_numpy(u):
+        u = u.copy()
+        u[:,:,:,0,1:] = np.roll(u, -1, 0)[:,:,:,1,:2] * 2
+        u[:,:,:,1,0,0] = 5.
+        return u
+    check(f, f_numpy, (2, 3, 4))
+
+def test_views_generate_no_copies():
+    G = check(lambda u: enzyme.ip(u.reshape((6, 4)).T[1:3]),
+              lambda u: np.roll(u.reshape(u.shape[:3] + (6, 4))
+                                 .transpose(0, 1, 2, 4, 3)[:,:,:,1:3], -1, 0),
+              (2, 3, 4))
+    c_code = generate_c_code(G)
+    assert 'double var' not in c_code
+    assert 'sink[0] = source_ip[1];' in c_code